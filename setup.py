@@ -38,5 +38,8 @@ setup(
     install_requires=['attrs', 'psycopg2'],
     extras_require={
         'django':  ['django>=1.11'],
+        'zstd': ['zstandard'],
+        'lz4': ['lz4'],
+        'asyncpg': ['asyncpg'],
     }
 )
@@ -0,0 +1,282 @@
+# coding: utf-8
+import json
+import resource
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from unittest.mock import patch
+
+import attr
+import pytest
+
+from ..conftest import DATABASE
+
+
+INSERT_TEMPLATE = '''
+INSERT INTO {table_name} ({columns})
+WITH RECURSIVE series(value) AS (
+  SELECT 1
+  UNION ALL
+  SELECT value + 1 FROM series WHERE value < {rows}
+)
+SELECT {values} FROM series
+'''
+# Multiplier to spread foreign key values over the referenced table
+SPREAD = 7919
+DUMP_PHASES = (
+    'write_initial_setup', 'add_related_data', 'write_full_tables', 'write_partial_tables', 'write_tables_concurrently'
+)
+LOAD_PHASES = ('initial_setup', 'load_data', 'load_data_concurrently', 'final_setup')
+RESULTS = {}
+
+
+@attr.s(frozen=True)
+class Scenario:
+    """
+    Describes a synthetic schema.
+
+    Every level consists of ``fan_out`` tables, each of them references all tables on the previous level.
+    The first level contains fully dumped tables, the last one - partially dumped tables, that select every 10th row.
+    Other levels are filled with related rows automatically.
+    """
+    name = attr.ib()
+    rows = attr.ib(default=1000)
+    depth = attr.ib(default=2)
+    fan_out = attr.ib(default=1)
+    self_references = attr.ib(default=False)
+
+    def get_level(self, level):
+        return ['level{0}_{1}'.format(level, number) for number in range(self.fan_out)]
+
+    @property
+    def tables(self):
+        return [table for level in range(self.depth + 1) for table in self.get_level(level)]
+
+    @property
+    def full_tables(self):
+        return self.get_level(0)
+
+    @property
+    def partial_tables(self):
+        return {table: 'SELECT * FROM {0} WHERE id % 10 = 0'.format(table) for table in self.get_level(self.depth)}
+
+    def get_foreign_keys(self, level):
+        foreign_keys = []
+        if level:
+            foreign_keys.extend(self.get_level(level - 1))
+        return foreign_keys
+
+    def get_schema(self):
+        statements = []
+        for level in range(self.depth + 1):
+            for table in self.get_level(level):
+                columns = [
+                    'id INTEGER NOT NULL PRIMARY KEY',
+                    'payload TEXT NOT NULL',
+                    'amount NUMERIC NOT NULL',
+                ]
+                columns.extend(
+                    '{0}_id INTEGER NOT NULL REFERENCES {0} (id)'.format(parent)
+                    for parent in self.get_foreign_keys(level)
+                )
+                if self.self_references:
+                    columns.append('parent_id INTEGER NULL REFERENCES {0} (id)'.format(table))
+                statements.append('CREATE TABLE {0} (\n  {1}\n)'.format(table, ',\n  '.join(columns)))
+        return statements
+
+    def get_data(self, scale=1):
+        rows = max(int(self.rows * scale), 1)
+        statements = []
+        for level in range(self.depth + 1):
+            for table in self.get_level(level):
+                columns = ['id', 'payload', 'amount']
+                values = ['value', "'Payload #' || value", 'value * 1.5']
+                for parent in self.get_foreign_keys(level):
+                    columns.append('{0}_id'.format(parent))
+                    values.append('1 + (value * {0}) % {1}'.format(SPREAD, rows))
+                if self.self_references:
+                    columns.append('parent_id')
+                    values.append('CASE WHEN value > 1 THEN value / 2 END')
+                statements.append(
+                    INSERT_TEMPLATE.format(
+                        table_name=table, columns=', '.join(columns), values=', '.join(values), rows=rows
+                    )
+                )
+        return statements
+
+
+@pytest.fixture
+def synthetic_schema(request, cursor):
+    """
+    Creates the schema and the data for the given scenario.
+    """
+
+    def creator(scenario):
+        for statement in scenario.get_schema():
+            cursor.execute(statement)
+        for statement in scenario.get_data(request.config.getoption('benchmark_scale')):
+            cursor.execute(statement)
+
+    return creator
+
+
+def get_current_rss():
+    """
+    Resident set size of the current process in bytes. Available on Linux only.
+    """
+    try:
+        with open('/proc/self/statm') as fd:
+            return int(fd.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def get_max_rss():
+    """
+    Peak resident set size of the whole process in bytes.
+    """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        # Linux reports kilobytes
+        max_rss *= 1024
+    return max_rss
+
+
+class RSSSampler(threading.Thread):
+    """
+    Tracks the peak RSS during the measured operation.
+    ``ru_maxrss`` could not be reset, that's why the current RSS is sampled periodically.
+    """
+
+    def __init__(self, interval=0.01):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = get_current_rss()
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            self.peak = max(self.peak, get_current_rss())
+
+    def stop(self):
+        self.done.set()
+        self.join()
+        self.peak = max(self.peak, get_current_rss())
+        return self.peak
+
+
+@attr.s(cmp=False)
+class Measurement:
+    phases = attr.ib(default=attr.Factory(lambda: defaultdict(float)))
+    seconds = attr.ib(default=0)
+    peak_rss = attr.ib(default=None)
+
+    def wrap(self, phase, function):
+
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.phases[phase] += time.perf_counter() - start
+
+        return wrapper
+
+
+@contextmanager
+def measure(backend, phases):
+    """
+    Measures total time, time of every phase and peak memory usage of the wrapped operation.
+    """
+    measurement = Measurement()
+    patches = [patch.object(backend, phase, measurement.wrap(phase, getattr(backend, phase))) for phase in phases]
+    for item in patches:
+        item.start()
+    sampler = RSSSampler() if get_current_rss() is not None else None
+    if sampler is not None:
+        sampler.start()
+    start = time.perf_counter()
+    try:
+        yield measurement
+    finally:
+        measurement.seconds = time.perf_counter() - start
+        measurement.peak_rss = sampler.stop() if sampler is not None else get_max_rss()
+        for item in patches:
+            item.stop()
+
+
+def get_baseline_path(config):
+    """
+    Absolute throughput depends on the machine, therefore baselines are stored locally and are not shared.
+    """
+    path = config.getoption('benchmark_baseline')
+    return Path(path) if path else None
+
+
+def load_baseline(path):
+    if path is not None and path.exists():
+        with path.open('r') as fd:
+            return json.load(fd)
+    return {}
+
+
+@pytest.fixture
+def benchmark(request):
+    """
+    Records the results and compares them with the baseline, that is given via ``--benchmark-baseline``.
+    """
+    config = request.config
+
+    def recorder(name, measurement, stats):
+        rows, size = stats.rows, stats.size
+        seconds = measurement.seconds or sys.float_info.epsilon
+        result = {
+            'rows': rows,
+            'bytes': size,
+            'seconds': measurement.seconds,
+            'rows_per_second': rows / seconds,
+            'bytes_per_second': size / seconds,
+            'peak_rss': measurement.peak_rss,
+            'phases': dict(measurement.phases),
+        }
+        RESULTS.setdefault(DATABASE, {})[name] = result
+        expected = load_baseline(get_baseline_path(config)).get(DATABASE, {}).get(name)
+        if expected and not config.getoption('benchmark_save'):
+            minimum = expected['rows_per_second'] * (1 - config.getoption('benchmark_tolerance'))
+            assert result['rows_per_second'] >= minimum, (
+                '{0}: {1:.0f} rows/s is slower than the baseline {2:.0f} rows/s'.format(
+                    name, result['rows_per_second'], expected['rows_per_second']
+                )
+            )
+        return result
+
+    return recorder
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not RESULTS:
+        return
+    terminalreporter.section('benchmark')
+    for database, results in sorted(RESULTS.items()):
+        for name, result in sorted(results.items()):
+            phases = ', '.join('{0}={1:.3f}s'.format(phase, value) for phase, value in sorted(result['phases'].items()))
+            terminalreporter.write_line(
+                '{0} {1}: {2:.3f}s, {3:.0f} rows/s, {4:.0f} bytes/s, peak RSS {5} bytes ({6})'.format(
+                    database, name, result['seconds'], result['rows_per_second'], result['bytes_per_second'],
+                    result['peak_rss'], phases
+                )
+            )
+
+
+def pytest_sessionfinish(session):
+    path = get_baseline_path(session.config)
+    if RESULTS and path is not None and session.config.getoption('benchmark_save'):
+        baseline = load_baseline(path)
+        for database, results in RESULTS.items():
+            baseline.setdefault(database, {}).update(results)
+        with path.open('w') as fd:
+            json.dump(baseline, fd, indent=2, sort_keys=True)
+            fd.write('\n')
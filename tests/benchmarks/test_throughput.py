@@ -0,0 +1,49 @@
+# coding: utf-8
+import pytest
+
+from .conftest import DUMP_PHASES, LOAD_PHASES, Scenario, measure
+
+
+pytestmark = pytest.mark.benchmark
+
+SCENARIOS = (
+    Scenario('small'),
+    Scenario('deep', depth=5),
+    Scenario('wide', fan_out=4),
+    Scenario('self-references', self_references=True),
+    Scenario('large', rows=50000, fan_out=2),
+)
+WORKERS = (
+    1,
+    pytest.param(4, marks=pytest.mark.postgres),
+)
+
+
+@pytest.fixture(params=SCENARIOS, ids=lambda scenario: scenario.name)
+def scenario(request, synthetic_schema):
+    synthetic_schema(request.param)
+    return request.param
+
+
+def dump(backend, scenario, archive_filename, **kwargs):
+    return backend.dump(archive_filename, scenario.full_tables, scenario.partial_tables, **kwargs)
+
+
+@pytest.mark.parametrize('workers', WORKERS)
+@pytest.mark.parametrize('materialize', (False, True))
+def test_dump(backend, scenario, archive_filename, benchmark, materialize, workers):
+    if materialize and workers > 1:
+        pytest.skip('Materialized tables are not visible to other connections')
+    with measure(backend, DUMP_PHASES) as measurement:
+        stats = dump(backend, scenario, archive_filename, materialize=materialize, workers=workers)
+    name = '{0}-dump-{1}-workers-{2}'.format(scenario.name, 'materialize' if materialize else 'sql', workers)
+    benchmark(name, measurement, stats)
+
+
+@pytest.mark.parametrize('workers', WORKERS)
+def test_load(backend, scenario, archive_filename, benchmark, workers):
+    dump(backend, scenario, archive_filename)
+    backend.recreate_database()
+    with measure(backend, LOAD_PHASES) as measurement:
+        stats = backend.load(archive_filename, workers=workers)
+    benchmark('{0}-load-workers-{1}'.format(scenario.name, workers), measurement, stats)
@@ -1,9 +1,10 @@
 import os
 import sqlite3
+import threading
 import zipfile
 from contextlib import contextmanager
 from pathlib import Path
-from unittest.mock import patch
+from unittest.mock import DEFAULT, patch
 
 import attr
 import pytest
@@ -74,11 +75,16 @@ class BackendWrapper:
 
         class ConcurrentInsertEmulator:
             is_loaded = False
+            # Tables could be exported from multiple threads
+            lock = threading.Lock()
 
             def insert(self, *args, **kwargs):
-                if not self.is_loaded:
-                    self._insert()
-                    self.is_loaded = True
+                with self.lock:
+                    if not self.is_loaded:
+                        self._insert()
+                        self.is_loaded = True
+                # Proceed with the wrapped call
+                return DEFAULT
 
             def _insert(self):
                 cursor.execute(query)
@@ -88,7 +94,7 @@ class BackendWrapper:
     @contextmanager
     def concurrent_insert(self, query):
         concurrent_insert = self._get_concurrent_insert_class(query)()
-        with patch.object(self.backend, 'export_to_csv', wraps=self.backend.export_to_csv,
+        with patch.object(self.backend, 'export_to_file', wraps=self.backend.export_to_file,
                           side_effect=concurrent_insert.insert):
             yield
 
@@ -134,12 +140,15 @@ class PostgreSQLWrapper(BackendWrapper):
         )[0]['exists']
 
     def assert_namelist(self, archive):
+        # Setup files are dumped in the background while the data is exported
         assert archive.namelist() == [
-            'dump/schema.sql', 'dump/sequences.sql', 'dump/data/groups.csv', 'dump/data/employees.csv',
+            'dump/data/groups.csv', 'dump/data/employees.csv', 'dump/schema.sql', 'dump/post_data.sql',
+            'dump/sequences.sql', 'dump/manifest.json',
         ]
 
     def assert_unused_sequences(self, archive):
-        assert "SELECT pg_catalog.setval('groups_id_seq', 1, false);".encode() in archive.read('dump/sequences.sql')
+        expected = "SELECT pg_catalog.setval('public.groups_id_seq', 1, false);".encode()
+        assert expected in archive.read('dump/sequences.sql')
 
     def get_tables_count(self):
         return self.backend.run(
@@ -156,7 +165,9 @@ class SQLiteWrapper(BackendWrapper):
         return Path(dbname).exists()
 
     def assert_namelist(self, archive):
-        assert archive.namelist() == ['dump/schema.sql', 'dump/data/groups.csv', 'dump/data/employees.csv']
+        assert archive.namelist() == [
+            'dump/schema.sql', 'dump/data/groups.csv', 'dump/data/employees.csv', 'dump/manifest.json'
+        ]
 
     def get_tables_count(self):
         return self.backend.run(
@@ -257,9 +268,36 @@ def data(execute_file):
         execute_file('sql/sqlite_data.sql')
 
 
+@pytest.fixture
+def cycle(execute_file):
+    """
+    Tables, that reference each other.
+    """
+    execute_file('sql/cycle.sql')
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('benchmark')
+    group.addoption('--benchmark', action='store_true', help='Run benchmarks.')
+    group.addoption(
+        '--benchmark-baseline', default=None,
+        help='JSON file with results of a previous run on the same machine to compare with.'
+    )
+    group.addoption(
+        '--benchmark-save', action='store_true', help='Store benchmark results as a new baseline.'
+    )
+    group.addoption(
+        '--benchmark-tolerance', type=float, default=0.5,
+        help='Allowed relative slowdown compared to the baseline.'
+    )
+    group.addoption('--benchmark-scale', type=float, default=1, help='Multiplier for the number of generated rows.')
+
+
 def pytest_runtest_setup(item):
     if isinstance(item, item.Function) and not item.get_marker(DATABASE) and ALL.intersection(item.keywords):
         pytest.skip('Cannot run on {0}'.format(DATABASE))
+    if item.get_marker('benchmark') and not item.config.getoption('benchmark'):
+        pytest.skip('Benchmarks are enabled with --benchmark')
 
 
 @pytest.fixture
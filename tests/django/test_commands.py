@@ -1,7 +1,12 @@
 # coding: utf-8
+import re
+import zipfile
+
 import pytest
 from django.core.management import call_command
+from django.core.management.base import CommandError
 
+from xdump.budget import Budget, BudgetExceeded
 from xdump.postgresql import PostgreSQLBackend
 from xdump.sqlite import SQLiteBackend
 
@@ -55,8 +60,106 @@ def test_custom_backend_via_config(settings, db_helper, archive_filename):
     db_helper.assert_dump(archive_filename)
 
 
-def test_xload(archive_filename, db_helper):
+@pytest.mark.postgres
+def test_xdump_workers(archive_filename, db_helper):
+    call_command('xdump', archive_filename, workers=2)
+    archive = zipfile.ZipFile(archive_filename)
+    db_helper.assert_groups(archive)
+    db_helper.assert_employees(archive)
+
+
+@pytest.mark.postgres
+def test_xdump_binary(backend, archive_filename):
+    call_command('xdump', archive_filename, format='binary')
+    archive = zipfile.ZipFile(archive_filename)
+    assert 'dump/data/groups.bin' in archive.namelist()
+    assert backend.read_manifest(archive)['format'] == 'binary'
+
+
+def test_xdump_compression(archive_filename):
+    pytest.importorskip('zstandard')
+    call_command('xdump', archive_filename, compression='zstd', compression_level=10)
+    archive = zipfile.ZipFile(archive_filename)
+    assert archive.getinfo('dump/data/groups.csv').compress_type == zipfile.ZIP_STORED
+    assert b'"compression": "zstd"' in archive.read('dump/manifest.json')
+
+
+def test_xdump_stats(archive_filename, capsys):
+    call_command('xdump', archive_filename, stats=True, progress=True)
+    out = capsys.readouterr()[0]
+    assert 'Started related_data' in out
+    assert 'groups: 2 rows' in out
+    assert 'Total: 6 rows' in out
+
+
+def test_xdump_cache(archive_filename, tmpdir, capsys, db_helper):
+    cache = str(tmpdir.join('cache'))
+    call_command('xdump', archive_filename, cache=cache, cache_size=10 ** 6)
+    call_command('xdump', archive_filename, stats=True, cache=cache)
+    lines = capsys.readouterr()[0].splitlines()
+    groups = [line for line in lines if line.startswith('groups: ')]
+    assert groups[0].endswith(' (cached)')
+    db_helper.assert_groups(zipfile.ZipFile(archive_filename))
+
+
+def test_xdump_budget(settings, archive_filename):
+    settings.XDUMP['BUDGET'] = Budget(rows=5, estimate='count')
+    message = 'Dump exceeds the budget of 5 rows on table employees: 6 (estimated)'
+    with pytest.raises(BudgetExceeded, match=re.escape(message)):
+        call_command('xdump', archive_filename)
+
+
+def test_xload_stats(archive_filename, capsys):
+    call_command('xdump', archive_filename)
+    call_command('xload', archive_filename, stats=True)
+    out = capsys.readouterr()[0]
+    assert 'final_setup: ' in out
+    assert 'employees: 4 rows' in out
+
+
+def test_xload(archive_filename, db_helper, backend):
     call_command('xdump', archive_filename)
     assert db_helper.get_tickets_count() == 5
     call_command('xload', archive_filename)
+    # Connections of other backend instances are not affected
+    backend.close()
     assert db_helper.get_tickets_count() == 0
+
+
+def test_xload_incremental(settings, archive_filename, tmpdir, cursor, db_helper):
+    settings.XDUMP['FULL_TABLES'] = ('groups', 'tickets')
+    settings.XDUMP['WATERMARKS'] = {'tickets': 'id'}
+    base_filename = str(tmpdir.join('base.zip'))
+    call_command('xdump', base_filename)
+    cursor.execute("INSERT INTO tickets (id, author_id, subject, message) VALUES (6, 3, 'Sub 6', 'Message 6')")
+    call_command('xdump', archive_filename, base=base_filename)
+    cursor.execute('DELETE FROM tickets WHERE id = 6')
+    # The database is not recreated
+    call_command('xload', archive_filename)
+    assert db_helper.get_tickets_count() == 6
+
+
+def test_xload_template(archive_filename, db_helper, backend):
+    call_command('xdump', archive_filename)
+    try:
+        call_command('xload', archive_filename, template=True)
+        assert db_helper.get_tickets_count() == 0
+        assert len(backend.get_templates()) == 1
+    finally:
+        for template in backend.get_templates():
+            backend.drop_template(template)
+
+
+@pytest.mark.parametrize('option', ('tables', 'exclude'))
+def test_xload_template_tables(archive_filename, option):
+    call_command('xdump', archive_filename)
+    with pytest.raises(CommandError, match='--table and --exclude are not supported'):
+        call_command('xload', archive_filename, template=True, **{option: ['groups']})
+
+
+def test_xload_tables(archive_filename, capsys):
+    call_command('xdump', archive_filename)
+    call_command('xload', archive_filename, tables=['groups'], stats=True)
+    out = capsys.readouterr()[0]
+    assert 'groups: 2 rows' in out
+    assert 'employees: ' not in out
@@ -0,0 +1,14 @@
+CREATE TABLE authors (
+  id                        INTEGER                  NOT NULL PRIMARY KEY,
+  name                      TEXT                     NOT NULL
+);
+CREATE TABLE books (
+  id                        INTEGER                  NOT NULL PRIMARY KEY,
+  title                     TEXT                     NOT NULL,
+  author_id                 INTEGER                  NULL REFERENCES authors (id)
+);
+ALTER TABLE authors ADD COLUMN favourite_book_id INTEGER NULL REFERENCES books (id);
+INSERT INTO authors (id, name) VALUES (1, 'First'), (2, 'Second'), (3, 'Third');
+INSERT INTO books (id, title, author_id) VALUES (1, 'Book 1', 1), (2, 'Book 2', 2), (3, 'Book 3', 3);
+UPDATE authors SET favourite_book_id = 2 WHERE id = 1;
+UPDATE authors SET favourite_book_id = 1 WHERE id = 2;
@@ -0,0 +1,117 @@
+# coding: utf-8
+import asyncio
+import re
+import subprocess
+import time
+import zipfile
+from unittest.mock import patch
+
+import pytest
+
+from .conftest import EMPLOYEES_SQL
+
+
+asyncpg = pytest.importorskip('asyncpg')
+pytestmark = [pytest.mark.postgres, pytest.mark.usefixtures('schema', 'data')]
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+@pytest.fixture
+def make_backend(request, backend, loop):
+
+    def factory():
+        from xdump.aiopostgresql import AsyncPostgreSQLBackend
+
+        async_backend = AsyncPostgreSQLBackend(
+            dbname=backend.dbname, user=backend.user, password=backend.password, host=backend.host, port=backend.port
+        )
+        request.addfinalizer(lambda: loop.run_until_complete(async_backend.aclose()))
+        return async_backend
+
+    return factory
+
+
+@pytest.fixture
+def async_backend(make_backend):
+    return make_backend()
+
+
+def test_dump(async_backend, loop, archive_filename, db_helper):
+    stats = loop.run_until_complete(async_backend.dump(archive_filename, ['groups'], {'employees': EMPLOYEES_SQL}))
+    archive = zipfile.ZipFile(archive_filename)
+    db_helper.assert_namelist(archive)
+    db_helper.assert_groups(archive)
+    db_helper.assert_employees(archive)
+    assert stats.tables['groups'].rows == 2
+    assert async_backend.read_manifest(archive)['tables'][0]['name'] == 'groups'
+    async_backend.verify(archive_filename, checksums=True)
+
+
+@pytest.mark.parametrize('format', ('csv', 'binary'))
+def test_load(async_backend, loop, archive_filename, format):
+    loop.run_until_complete(async_backend.dump(archive_filename, ['groups', 'employees', 'tickets'], format=format))
+    loop.run_until_complete(async_backend.recreate_database())
+    stats = loop.run_until_complete(async_backend.load(archive_filename))
+    assert stats.tables['tickets'].rows == 5
+    assert list(stats.phases) == ['initial_setup', 'data', 'final_setup']
+    result = loop.run_until_complete(async_backend.run_async("SELECT COUNT(*) FROM pg_constraint WHERE contype = 'f'"))
+    assert result == [{'count': 4}]
+
+
+def test_concurrent_dumps(make_backend, loop, tmpdir):
+    """
+    Every dump has its own backend instance.
+    """
+    filenames = [str(tmpdir.join('{0}.zip'.format(number))) for number in range(3)]
+    loop.run_until_complete(
+        asyncio.gather(*[make_backend().dump(filename, ['groups', 'employees']) for filename in filenames])
+    )
+    contents = [zipfile.ZipFile(filename).read('dump/data/employees.csv') for filename in filenames]
+    assert contents[0] == contents[1] == contents[2]
+
+
+@pytest.mark.usefixtures('cycle')
+def test_cycle(async_backend, loop, archive_filename):
+    message = 'Tables referencing each other are not supported by the async backend: authors, books'
+    with pytest.raises(ValueError, match=re.escape(message)):
+        loop.run_until_complete(async_backend.dump(archive_filename, [], {'authors': 'SELECT * FROM authors'}))
+    # Not selected tables could reference each other
+    loop.run_until_complete(async_backend.dump(archive_filename, ['groups']))
+
+
+def test_setup_files_failure(async_backend, loop, archive_filename):
+    with patch.object(async_backend, 'get_dump_command', return_value=('false', )):
+        with pytest.raises(subprocess.CalledProcessError):
+            loop.run_until_complete(async_backend.dump(archive_filename, ['groups']))
+
+
+def test_failure(async_backend, loop, archive_filename):
+    """
+    Running ``pg_dump`` processes are killed if the dump fails.
+    """
+    start = time.perf_counter()
+    with patch.object(async_backend, 'get_dump_command', return_value=('sleep', '10')):
+        with pytest.raises(asyncpg.PostgresError):
+            loop.run_until_complete(async_backend.dump(archive_filename, [], {'groups': 'SELECT * FROM unknown'}))
+    assert time.perf_counter() - start < 5
+
+
+@pytest.mark.parametrize('method, args, message', (
+    ('load_template', ('dump.zip', ), 'Template databases are not supported by the async backend'),
+    ('create_template', ('dump.zip', ), 'Template databases are not supported by the async backend'),
+    ('ensure_loaded', ('groups', ), 'Lazy loading is not supported by the async backend'),
+    ('run', ('SELECT 1', ), 'Synchronous queries are not supported by the async backend'),
+    ('execute', ('SELECT 1', ), 'Synchronous queries are not supported by the async backend'),
+    ('close', (), 'Synchronous connections are not supported by the async backend'),
+))
+def test_unsupported_methods(async_backend, method, args, message):
+    with pytest.raises(ValueError, match=message):
+        getattr(async_backend, method)(*args)
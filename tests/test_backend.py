@@ -1,8 +1,19 @@
 # coding: utf-8
+import gc
+import hashlib
+import json
+import os
+import weakref
 import zipfile
+from pathlib import Path
+from unittest.mock import patch
 
+import attr
 import pytest
 
+from xdump.stats import Stats
+from xdump.utils import copy_archive_member
+
 from .conftest import DATABASE, EMPLOYEES_SQL
 
 
@@ -111,6 +122,17 @@ def test_write_partial_tables(backend, archive, db_helper):
     db_helper.assert_employees(archive)
 
 
+@pytest.mark.usefixtures('schema', 'data')
+def test_write_data_file(backend, archive, db_helper):
+    """
+    Data should be streamed to the archive member without building the whole output in memory.
+    """
+    with patch.object(backend, 'export_to_csv') as export_to_csv:
+        backend.write_data_file(archive, 'groups', 'SELECT * FROM groups')
+    assert not export_to_csv.called
+    db_helper.assert_groups(archive)
+
+
 @pytest.mark.usefixtures('schema', 'data')
 def test_write_full_tables(backend, archive, db_helper):
     backend.write_full_tables(archive, ['groups'])
@@ -118,6 +140,497 @@ def test_write_full_tables(backend, archive, db_helper):
     assert archive.namelist() == ['dump/data/groups.csv']
 
 
+@pytest.mark.usefixtures('schema', 'data')
+def test_materialize_related_data(backend):
+    partial_tables = {'tickets': 'SELECT * FROM tickets WHERE id = 1'}
+    backend.add_related_data([], partial_tables, materialize=True)
+    assert partial_tables == {
+        'tickets': 'SELECT * FROM tickets WHERE (id) IN (SELECT id FROM xdump_tickets)',
+        'employees': 'SELECT * FROM employees WHERE (id) IN (SELECT id FROM xdump_employees)',
+        'groups': 'SELECT * FROM groups WHERE (id) IN (SELECT id FROM xdump_groups)',
+    }
+    # Only primary keys and columns of self-referencing foreign keys are stored
+    assert backend.run('SELECT * FROM xdump_employees') == [
+        {'id': 1, 'manager_id': None, 'referrer_id': None, 'xdump_step': 0}
+    ]
+
+
+@pytest.mark.usefixtures('schema', 'data')
+def test_materialize_referenced_rows(backend):
+    """
+    Rows, that are referenced by the selected ones, are added in the following rounds.
+    """
+    partial_tables = {'tickets': 'SELECT * FROM tickets WHERE id = 5'}
+    backend.add_related_data([], partial_tables, materialize=True)
+    rows = backend.run('SELECT id, xdump_step FROM xdump_employees ORDER BY id')
+    assert [row['id'] for row in rows] == [1, 3]
+    assert rows[0]['xdump_step'] > 0
+    assert rows[1]['xdump_step'] == 0
+
+
+@pytest.mark.usefixtures('schema', 'data', 'cycle')
+def test_materialize_unreached_tables(backend):
+    """
+    Tables, that are not reached by the selection, don't get temporary tables.
+    """
+    partial_tables = {'tickets': 'SELECT * FROM tickets WHERE id = 1'}
+    backend.add_related_data([], partial_tables, materialize=True)
+    assert set(partial_tables) == {'tickets', 'employees', 'groups'}
+    with pytest.raises(backend.database_error):
+        backend.run('SELECT * FROM xdump_books')
+    # Primary keys are looked up only for reached tables and are cached until ``cache_clear``
+    assert set(backend.primary_keys) == {'tickets', 'employees', 'groups'}
+    backend.cache_clear()
+    assert backend.primary_keys == {}
+
+
+def test_materialize_with_workers(backend, archive_filename):
+    with pytest.raises(ValueError):
+        backend.dump(archive_filename, [], {}, workers=2, materialize=True)
+
+
+@pytest.mark.parametrize('materialize', (False, True))
+@pytest.mark.usefixtures('schema', 'data', 'cycle')
+def test_cyclic_relations(backend, archive_filename, db_helper, materialize):
+    """
+    Tables, that reference each other, are processed until no new rows are selected.
+    """
+    backend.dump(archive_filename, [], {'books': 'SELECT * FROM books WHERE id = 1'}, materialize=materialize)
+    archive = zipfile.ZipFile(archive_filename)
+    db_helper.assert_content(archive, 'books', {b'id,title,author_id', b'1,Book 1,1', b'2,Book 2,2'})
+    db_helper.assert_content(archive, 'authors', {b'id,name,favourite_book_id', b'1,First,2', b'2,Second,1'})
+    assert 'groups' not in partial_tables_names(archive)
+
+
+@pytest.mark.postgres
+@pytest.mark.usefixtures('schema', 'data', 'cycle')
+def test_cyclic_relations_json(backend, archive_filename, cursor):
+    """
+    Columns without equality operators are not compared while related rows are added.
+    """
+    cursor.execute("ALTER TABLE books ADD COLUMN details JSON NOT NULL DEFAULT '{}'")
+    stats = backend.dump(archive_filename, [], {'books': 'SELECT * FROM books WHERE id = 1'})
+    assert (stats.tables['books'].rows, stats.tables['authors'].rows) == (2, 2)
+
+
+def partial_tables_names(archive):
+    return {Path(name).stem for name in archive.namelist() if name.startswith('dump/data/')}
+
+
+@pytest.mark.usefixtures('schema', 'data')
+def test_add_related_data(backend):
+    """
+    Every table is processed once, all self-referencing foreign keys are handled by a single recursive query.
+    """
+    partial_tables = {'tickets': 'SELECT * FROM tickets WHERE id = 1'}
+    with patch.object(backend, 'get_related_data_sql', wraps=backend.get_related_data_sql) as get_related_data_sql:
+        assert backend.add_related_data([], partial_tables) == []
+    assert get_related_data_sql.call_count == 2
+    assert partial_tables['employees'].count('WITH RECURSIVE') == 1
+
+
+@pytest.mark.usefixtures('schema', 'data')
+def test_manifest(backend, archive_filename):
+    backend.dump(archive_filename, ['tickets'], {'employees': EMPLOYEES_SQL})
+    archive = zipfile.ZipFile(archive_filename)
+    manifest = backend.read_manifest(archive)
+    assert (manifest['format'], manifest['compression']) == ('csv', 'deflate')
+    assert manifest['server_version']
+    assert manifest['options'] == {
+        'full_tables': ['tickets'],
+        'partial_tables': {'employees': EMPLOYEES_SQL},
+        'workers': 1,
+        'materialize': False,
+        'compression_level': None,
+        'sequences': 'all',
+    }
+    # Referenced tables go first
+    assert [table['name'] for table in manifest['tables']] == ['groups', 'employees', 'tickets']
+    groups = manifest['tables'][0]
+    info = archive.getinfo('dump/data/groups.csv')
+    assert groups == {
+        'name': 'groups',
+        'filename': 'dump/data/groups.csv',
+        'rows': 2,
+        'size': info.file_size,
+        'compressed_size': info.compress_size,
+        'checksum': 'sha256:' + hashlib.sha256(b'id,name\n1,Admin\n2,User\n').hexdigest(),
+        'references': [],
+    }
+    assert manifest['tables'][2]['references'] == ['employees']
+
+
+def test_get_tables_order(backend):
+    assert backend.get_tables_order(['tickets', 'unknown', 'groups', 'employees']) == [
+        'groups', 'employees', 'tickets', 'unknown'
+    ]
+
+
+@pytest.mark.usefixtures('schema', 'data', 'dump')
+class TestSelectiveLoading:
+
+    @pytest.fixture
+    def dump(self, backend, archive_filename):
+        backend.dump(archive_filename, ['groups', 'employees', 'tickets'])
+        backend.recreate_database()
+
+    def get_counts(self, backend):
+        return {
+            table: backend.run('SELECT COUNT(*) AS count FROM {0}'.format(table))[0]['count']
+            for table in ('groups', 'employees', 'tickets')
+        }
+
+    @pytest.mark.parametrize('kwargs, expected', (
+        ({'tables': ['groups']}, {'groups': 2, 'employees': 0, 'tickets': 0}),
+        # Referenced tables are loaded as well
+        ({'tables': ['tickets']}, {'groups': 2, 'employees': 5, 'tickets': 5}),
+        ({'exclude': ['tickets']}, {'groups': 2, 'employees': 5, 'tickets': 0}),
+    ))
+    def test_load(self, backend, archive_filename, kwargs, expected):
+        stats = backend.load(archive_filename, **kwargs)
+        assert self.get_counts(backend) == expected
+        assert set(stats.tables) == {table for table, count in expected.items() if count}
+
+    @pytest.mark.parametrize('kwargs, message', (
+        ({'tables': ['unknown']}, 'Tables are not in the archive: unknown'),
+        ({'exclude': ['groups']}, 'Table groups is referenced by employees, therefore it could not be excluded'),
+    ))
+    def test_invalid(self, backend, archive_filename, kwargs, message):
+        with pytest.raises(ValueError) as exc:
+            backend.load(archive_filename, **kwargs)
+        assert str(exc.value) == message
+
+    def test_lazy(self, backend, archive_filename):
+        stats = backend.load(archive_filename, lazy=True)
+        assert self.get_counts(backend) == {'groups': 0, 'employees': 0, 'tickets': 0}
+        backend.ensure_loaded('employees')
+        assert self.get_counts(backend) == {'groups': 2, 'employees': 5, 'tickets': 0}
+        backend.ensure_loaded('tickets', 'groups')
+        assert self.get_counts(backend) == {'groups': 2, 'employees': 5, 'tickets': 5}
+        # Tables are loaded only once
+        assert list(stats.tables) == ['groups', 'employees', 'tickets']
+
+    def test_not_lazy(self, backend, archive_filename):
+        backend.load(archive_filename)
+        with pytest.raises(ValueError, match='No archive is loaded lazily'):
+            backend.ensure_loaded('groups')
+
+
+@pytest.mark.usefixtures('schema', 'data', 'dump')
+class TestTemplates:
+
+    @pytest.fixture
+    def dump(self, request, backend, archive_filename):
+        backend.dump(archive_filename, ['groups', 'employees'])
+
+        def drop_templates():
+            for template in backend.get_templates():
+                backend.drop_template(template)
+
+        request.addfinalizer(drop_templates)
+
+    def get_count(self, backend):
+        return backend.run('SELECT COUNT(*) AS count FROM employees')[0]['count']
+
+    def test_load_template(self, backend, archive_filename):
+        stats = backend.load_template(archive_filename)
+        assert list(stats.phases) == ['initial_setup', 'data', 'final_setup', 'template', 'clone']
+        assert len(backend.get_templates()) == 1
+        backend.run('DELETE FROM employees')
+        # The template is not loaded again
+        stats = backend.load_template(archive_filename)
+        assert list(stats.phases) == ['template', 'clone']
+        assert not stats.tables
+        assert self.get_count(backend) == 5
+
+    def test_eviction(self, backend, archive_filename, tmpdir):
+        backend.load_template(archive_filename)
+        first = set(backend.get_templates())
+        other = str(tmpdir.join('other.zip'))
+        backend.dump(other, ['groups'])
+        backend.load_template(other, max_templates=1)
+        templates = backend.get_templates()
+        assert len(templates) == 1
+        assert not first & set(templates)
+        assert self.get_count(backend) == 0
+
+    def test_incremental(self, backend, archive_filename, tmpdir):
+        incremental = str(tmpdir.join('incremental.zip'))
+        backend.dump(incremental, ['groups'], base=archive_filename)
+        with pytest.raises(ValueError, match='Incremental dumps could not be used as templates'):
+            backend.load_template(incremental)
+
+    def test_parallel_loading(self, backend, archive_filename):
+        """
+        Every process loads the template into its own temporary database, the first loaded one is kept.
+        """
+        with patch.object(backend, 'create_template', wraps=backend.create_template) as create_template:
+            backend.load_template(archive_filename)
+        template, temporary = create_template.call_args[0][:2]
+        assert temporary.endswith('_{0}'.format(os.getpid()))
+        with patch.object(backend, 'drop_template', wraps=backend.drop_template) as drop_template:
+            backend.create_template(template, temporary + '0', archive_filename, 1, Stats())
+        drop_template.assert_called_with(temporary + '0')
+        assert list(backend.get_templates()) == [template]
+
+
+class TestVerify:
+
+    @pytest.fixture
+    def dump(self, backend, archive_filename):
+        backend.dump(archive_filename, ['groups', 'tickets'])
+
+    @pytest.fixture
+    def damage(self, backend, archive_filename, tmpdir):
+        """
+        Copies the archive without the given member and with the given changes of the groups entry in the manifest.
+        """
+        filename = str(tmpdir.join('damaged.zip'))
+
+        def damager(exclude=None, **changes):
+            with zipfile.ZipFile(archive_filename) as source, zipfile.ZipFile(filename, 'w') as target:
+                manifest = backend.read_manifest(source)
+                manifest['tables'][0].update(changes)
+                for name in source.namelist():
+                    if name == backend.manifest_filename:
+                        target.writestr(name, json.dumps(manifest))
+                    elif name != exclude:
+                        copy_archive_member(source, name, target)
+            return filename
+
+        return damager
+
+    @pytest.mark.usefixtures('schema', 'data', 'dump')
+    def test_valid(self, backend, archive_filename):
+        backend.verify(archive_filename, checksums=True)
+
+    @pytest.mark.parametrize('kwargs, checksums, message', (
+        ({'exclude': 'dump/data/groups.csv'}, False, 'dump/data/groups.csv: missing'),
+        ({'compressed_size': 1}, False, 'dump/data/groups.csv: size'),
+        ({'checksum': 'sha256:0'}, True, 'dump/data/groups.csv: checksum does not match'),
+    ))
+    @pytest.mark.usefixtures('schema', 'data', 'dump')
+    def test_damaged(self, backend, damage, kwargs, checksums, message):
+        filename = damage(**kwargs)
+        with pytest.raises(ValueError) as exc:
+            backend.verify(filename, checksums=checksums)
+        assert message in str(exc.value)
+
+    @pytest.mark.usefixtures('schema', 'data', 'dump')
+    def test_checksums_are_optional(self, backend, damage):
+        backend.verify(damage(checksum='sha256:0'))
+
+
+def test_manifest_missing(backend, archive):
+    """
+    Archives made by previous versions have no manifest.
+    """
+    archive.writestr('dump/schema.sql', '')
+    assert backend.read_manifest(archive) == {}
+
+
+@pytest.mark.parametrize('format', (
+    'xml',
+    pytest.param('binary', marks=pytest.mark.sqlite),
+))
+def test_unsupported_format(backend, archive_filename, format):
+    with pytest.raises(ValueError, match='Unsupported data format'):
+        backend.dump(archive_filename, ['groups'], format=format)
+
+
+def test_unsupported_sequences_option(backend, archive_filename):
+    with pytest.raises(ValueError, match='Unsupported sequences option'):
+        backend.dump(archive_filename, ['groups'], sequences='tables')
+
+
+@pytest.mark.parametrize('compression, compress_type', (
+    ('stored', zipfile.ZIP_STORED),
+    ('deflate', zipfile.ZIP_DEFLATED),
+    ('bzip2', zipfile.ZIP_BZIP2),
+    ('lzma', zipfile.ZIP_LZMA),
+    ('zstd', zipfile.ZIP_STORED),
+    ('lz4', zipfile.ZIP_STORED),
+))
+@pytest.mark.usefixtures('schema', 'data')
+def test_compression(backend, archive_filename, compression, compress_type):
+    if compression in ('zstd', 'lz4'):
+        pytest.importorskip({'zstd': 'zstandard', 'lz4': 'lz4.frame'}[compression])
+    stats = backend.dump(archive_filename, ['groups'], compression=compression)
+    archive = zipfile.ZipFile(archive_filename)
+    assert archive.getinfo('dump/data/groups.csv').compress_type == compress_type
+    assert backend.read_manifest(archive)['compression'] == compression
+    assert stats.tables['groups'].size == len(b'id,name\n1,Admin\n2,User\n')
+    backend.recreate_database()
+    stats = backend.load(archive_filename)
+    assert stats.tables['groups'].size == len(b'id,name\n1,Admin\n2,User\n')
+    assert backend.run('SELECT name FROM groups') == [{'name': 'Admin'}, {'name': 'User'}]
+
+
+@pytest.mark.parametrize('compression, level', (
+    ('unknown', None),
+    ('stored', 1),
+    ('lzma', 1),
+))
+def test_invalid_compression(backend, archive_filename, compression, level):
+    with pytest.raises(ValueError):
+        backend.dump(archive_filename, ['groups'], compression=compression, compression_level=level)
+
+
+class TestStats:
+
+    @pytest.fixture
+    def dump(self, backend, archive_filename):
+        return backend.dump(archive_filename, ['groups'], {'employees': EMPLOYEES_SQL})
+
+    @pytest.mark.usefixtures('schema', 'data')
+    def test_dump(self, dump, archive_filename):
+        assert list(dump.phases) == ['initial_setup', 'related_data', 'data']
+        assert list(dump.tables) == ['groups', 'employees']
+        groups = dump.tables['groups']
+        assert groups.sql == 'SELECT * FROM groups'
+        assert groups.rows == 2
+        info = zipfile.ZipFile(archive_filename).getinfo('dump/data/groups.csv')
+        assert (groups.size, groups.compressed_size) == (info.file_size, info.compress_size)
+        assert dump.tables['employees'].rows == 4
+        assert dump.rows == 6
+        assert dump.queries
+
+    @pytest.mark.usefixtures('schema', 'data')
+    def test_load(self, backend, dump, archive_filename):
+        backend.recreate_database()
+        stats = backend.load(archive_filename)
+        assert list(stats.phases) == ['initial_setup', 'data', 'final_setup']
+        assert {name: table.rows for name, table in stats.tables.items()} == {'groups': 2, 'employees': 4}
+        assert stats.size == dump.size
+
+    @pytest.mark.usefixtures('schema', 'data')
+    def test_callback(self, backend, archive_filename):
+        events = []
+        stats = Stats(callback=lambda event, value: events.append((event, getattr(value, 'name', value))))
+        assert backend.dump(archive_filename, ['groups'], stats=stats) is stats
+        assert events == [
+            ('phase_started', 'initial_setup'),
+            ('phase_finished', 'initial_setup'),
+            ('phase_started', 'related_data'),
+            ('phase_finished', 'related_data'),
+            ('phase_started', 'data'),
+            ('table_finished', 'groups'),
+            ('phase_finished', 'data'),
+        ]
+
+
+@pytest.mark.usefixtures('schema', 'data')
+class TestIncremental:
+    tables = ['groups', 'employees', 'tickets']
+    watermarks = {'groups': 'id', 'tickets': 'id'}
+
+    @pytest.fixture
+    def base_filename(self, backend, tmpdir):
+        filename = str(tmpdir.join('base.zip'))
+        backend.dump(filename, self.tables, watermarks=self.watermarks)
+        return filename
+
+    @pytest.fixture
+    def changes(self, cursor):
+        cursor.execute("INSERT INTO groups (id, name) VALUES (3, 'Guest')")
+        cursor.execute("INSERT INTO tickets (id, author_id, subject, message) VALUES (6, 3, 'Sub 6', 'Message 6')")
+        cursor.execute('DELETE FROM tickets WHERE id = 2')
+        cursor.execute("UPDATE employees SET last_name = 'White' WHERE id = 2")
+
+    @pytest.fixture
+    def delta(self, backend, base_filename, changes, archive_filename):
+        return backend.dump(archive_filename, self.tables, watermarks=self.watermarks, base=base_filename)
+
+    def test_base_manifest(self, backend, base_filename):
+        archive = zipfile.ZipFile(base_filename)
+        manifest = backend.read_manifest(archive)
+        assert 'incremental' not in manifest
+        assert {name: str(value['value']) for name, value in manifest['watermarks'].items()} == {
+            'groups': '2', 'tickets': '5'
+        }
+        assert not [name for name in archive.namelist() if name.startswith('dump/keys/')]
+
+    def test_dump(self, backend, delta, archive_filename, db_helper):
+        assert list(delta.phases) == ['initial_setup', 'related_data', 'watermarks', 'data']
+        archive = zipfile.ZipFile(archive_filename)
+        assert 'dump/schema.sql' not in archive.namelist()
+        manifest = backend.read_manifest(archive)
+        assert manifest['incremental'] is True
+        assert str(manifest['watermarks']['tickets']['value']) == '6'
+        # Rows, that were added since the base dump, and the last row from the base dump
+        db_helper.assert_content(
+            archive, 'tickets', {b'id,author_id,subject,message', b'5,3,Sub 5,Message 5', b'6,3,Sub 6,Message 6'}
+        )
+        assert archive.read('dump/keys/tickets.csv') == b'id\n1\n3\n4\n5\n6\n'
+        # Tables without watermarks are exported completely
+        assert delta.tables['employees'].rows == 5
+
+    def test_load(self, backend, base_filename, delta, archive_filename):
+        backend.recreate_database()
+        backend.load(base_filename)
+        assert backend.is_incremental(archive_filename)
+        stats = backend.load(archive_filename)
+        assert {name: table.rows for name, table in stats.tables.items()} == {
+            'groups': 2, 'employees': 5, 'tickets': 2
+        }
+        assert [row['id'] for row in backend.run('SELECT id FROM tickets ORDER BY id')] == [1, 3, 4, 5, 6]
+        assert backend.run('SELECT name FROM groups WHERE id = 3') == [{'name': 'Guest'}]
+        assert backend.run('SELECT last_name FROM employees WHERE id = 2') == [{'last_name': 'White'}]
+
+    def test_unknown_table(self, backend, archive_filename):
+        with pytest.raises(ValueError, match='Table with a watermark is not dumped: tickets'):
+            backend.dump(archive_filename, ['groups'], watermarks={'tickets': 'id'})
+
+    @pytest.mark.parametrize('partial_tables', (None, {'employees': 'SELECT * FROM employees WHERE id > 2'}))
+    def test_partial_table(self, backend, archive_filename, partial_tables):
+        """
+        Rows of related or partial tables could be selected later, while their watermarks are below the stored ones.
+        """
+        with pytest.raises(ValueError, match='Table with a watermark is not dumped completely: employees'):
+            backend.dump(archive_filename, ['tickets'], partial_tables, watermarks={'employees': 'id'})
+
+    def test_get_primary_key(self, backend):
+        assert backend.get_primary_key('tickets') == ['id']
+
+
+class TestRelations:
+
+    def test_get_foreign_keys(self, backend):
+        assert [foreign_key['column_name'] for foreign_key in backend.get_foreign_keys('employees')] == ['group_id']
+        assert backend.get_foreign_keys('employees', ['groups']) == []
+
+    def test_get_recursive_foreign_keys(self, backend):
+        foreign_keys = backend.get_foreign_keys('employees', recursive=True)
+        assert sorted(foreign_key['column_name'] for foreign_key in foreign_keys) == ['manager_id', 'referrer_id']
+        assert {foreign_key['foreign_column_name'] for foreign_key in foreign_keys} == {'id'}
+
+    @pytest.mark.usefixtures('schema', 'data')
+    def test_cache(self, backend, archive_filename):
+        """
+        Foreign keys are loaded from the database only once.
+        """
+        with patch.object(backend, 'get_all_foreign_keys', wraps=backend.get_all_foreign_keys) as get_all_foreign_keys:
+            for _ in range(2):
+                backend.dump(archive_filename, [], {'tickets': 'SELECT * FROM tickets WHERE id = 1'})
+            assert get_all_foreign_keys.call_count == 1
+            backend.cache_clear()
+            backend.get_reverse_relations()
+        assert get_all_foreign_keys.call_count == 2
+
+    def test_cache_per_instance(self, backend):
+        """
+        Foreign keys are not shared between backend instances and don't keep them alive.
+        """
+        other = attr.evolve(backend)
+        other.get_relations()
+        assert backend.relations is None
+        reference = weakref.ref(other)
+        other.close()
+        del other
+        gc.collect()
+        assert reference() is None
+
+
 EMPLOYEES_HEADER = b'id,first_name,last_name,manager_id,referrer_id,group_id'
 TICKETS_HEADER = b'id,author_id,subject,message'
 DOE = b'1,John,Doe,,,1'
@@ -129,10 +642,10 @@ SNOW = b'5,John,Snow,3,4,2'
 
 class TestAutoSelect:
 
-    @pytest.fixture(autouse=True)
+    @pytest.fixture(autouse=True, params=(False, True), ids=('sql', 'materialize'))
     def setup(self, request, backend, archive_filename, db_helper, schema, data):
         config = request.node.get_marker('dump')
-        backend.dump(archive_filename, *config.args)
+        backend.dump(archive_filename, *config.args, materialize=request.param)
         self.archive = zipfile.ZipFile(archive_filename)
         self.db_helper = db_helper
 
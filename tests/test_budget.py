@@ -0,0 +1,104 @@
+# coding: utf-8
+import re
+import zipfile
+from unittest.mock import patch
+
+import pytest
+
+from xdump.budget import Budget, BudgetExceeded, Limit
+
+from .conftest import EMPLOYEES_SQL, IS_POSTGRES
+
+
+def test_invalid_estimate():
+    message = 'Unsupported estimate method: rows. Available methods: explain, count, None'
+    with pytest.raises(ValueError, match=re.escape(message)):
+        Budget(estimate='rows')
+
+
+@pytest.mark.parametrize('exc, expected', (
+    (BudgetExceeded('groups', 'rows', 5, 2), 'Table groups exceeds the budget of 2 rows: 5'),
+    (
+        BudgetExceeded('groups', 'bytes', 500, 100, is_total=True, estimated=True),
+        'Dump exceeds the budget of 100 bytes on table groups: 500 (estimated)'
+    ),
+))
+def test_message(exc, expected):
+    assert str(exc) == expected
+
+
+def test_spend():
+    budget = Budget(rows=10, tables={'groups': Limit(size=100)})
+    budget.spend('groups', size=100)
+    budget.spend('employees', rows=5, size=1000)
+    with pytest.raises(BudgetExceeded) as exc:
+        budget.spend('groups', size=1)
+    assert (exc.value.table_name, exc.value.unit, exc.value.value) == ('groups', 'bytes', 101)
+    assert not exc.value.is_total
+    with pytest.raises(BudgetExceeded) as exc:
+        budget.spend('employees', rows=6)
+    assert (exc.value.unit, exc.value.value, exc.value.is_total) == ('rows', 11, True)
+    budget.reset()
+    budget.spend('employees', rows=10)
+
+
+def test_check_estimates():
+    budget = Budget(size=100)
+    # Unknown sizes are not checked
+    budget.check_estimates({'groups': (2, None), 'employees': (5, 1000)})
+    message = 'Dump exceeds the budget of 100 bytes on table employees: 500 (estimated)'
+    with pytest.raises(BudgetExceeded, match=re.escape(message)):
+        budget.check_estimates({'employees': (5, 500), 'groups': (2, 500)})
+
+
+@pytest.mark.usefixtures('schema', 'data')
+class TestDump:
+
+    def test_within_budget(self, backend, archive_filename):
+        budget = Budget(rows=6, estimate='count')
+        stats = backend.dump(archive_filename, ['groups'], {'employees': EMPLOYEES_SQL}, budget=budget)
+        assert 'budget' in stats.phases
+        assert len(zipfile.ZipFile(archive_filename).namelist()) > 2
+
+    @pytest.mark.parametrize('estimate', (
+        'count',
+        pytest.param('explain', marks=pytest.mark.postgres),
+    ))
+    def test_estimate(self, backend, archive_filename, estimate):
+        budget = Budget(tables={'tickets': Limit(rows=1)}, estimate=estimate)
+        with pytest.raises(BudgetExceeded) as exc:
+            backend.dump(archive_filename, ['tickets'], budget=budget)
+        assert exc.value.estimated
+        # Nothing is exported
+        assert backend.stats.tables == {}
+
+    def test_before_related_data(self, backend, archive_filename):
+        """
+        Selected tables are checked before related rows are selected, related tables are checked afterwards.
+        """
+        budget = Budget(tables={'tickets': Limit(rows=1)}, estimate='count')
+        with patch.object(backend, 'add_related_data') as add_related_data:
+            with pytest.raises(BudgetExceeded):
+                backend.dump(archive_filename, ['tickets'], budget=budget, materialize=True)
+        assert not add_related_data.called
+
+    def test_size(self, backend, archive_filename):
+        budget = Budget(size=10, estimate=None)
+        with pytest.raises(BudgetExceeded) as exc:
+            backend.dump(archive_filename, ['groups', 'tickets'], budget=budget)
+        assert (exc.value.table_name, exc.value.unit, exc.value.is_total) == ('groups', 'bytes', True)
+        assert not exc.value.estimated
+
+    def test_workers(self, backend, archive_filename):
+        kwargs = {'workers': 2} if IS_POSTGRES else {}
+        budget = Budget(tables={'tickets': Limit(rows=4)}, estimate=None)
+        with pytest.raises(BudgetExceeded) as exc:
+            backend.dump(archive_filename, ['groups', 'tickets'], budget=budget, **kwargs)
+        assert str(exc.value) == 'Table tickets exceeds the budget of 4 rows: 5'
+
+    def test_paths(self, backend, archive_filename):
+        budget = Budget(tables={'groups': Limit(rows=0)}, estimate='count')
+        with pytest.raises(BudgetExceeded) as exc:
+            backend.dump(archive_filename, ['tickets'], budget=budget)
+        assert exc.value.paths == ['groups <- employees.group_id <- tickets.author_id']
+        assert str(exc.value).endswith('. Rows are selected via groups <- employees.group_id <- tickets.author_id')
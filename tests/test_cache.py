@@ -0,0 +1,155 @@
+# coding: utf-8
+import os
+import time
+import zipfile
+
+import pytest
+
+from xdump.cache import TableCache
+
+from .conftest import IS_POSTGRES
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return TableCache(str(tmpdir.join('cache')))
+
+
+@pytest.fixture
+def source(tmpdir):
+    with zipfile.ZipFile(str(tmpdir.join('source.zip')), 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('dump/data/groups.csv', b'id,name\n1,Admin\n')
+        yield archive
+
+
+def test_store_and_copy(cache, source, archive):
+    cache.store('key', source, 'dump/data/groups.csv', {'rows': 1})
+    info, metadata = cache.copy('key', 'dump/data/groups.csv', archive)
+    assert metadata == {'rows': 1}
+    assert info.compress_type == zipfile.ZIP_DEFLATED
+    assert archive.read('dump/data/groups.csv') == b'id,name\n1,Admin\n'
+    # No temporary files are left
+    assert os.listdir(str(cache.directory)) == ['key.zip']
+
+
+def test_missing_entry(cache, archive):
+    assert cache.copy('unknown', 'dump/data/groups.csv', archive) is None
+    assert archive.namelist() == []
+
+
+def test_get_key(cache):
+    assert cache.get_key('groups', {'rows': 1}) == cache.get_key('groups', {'rows': 1})
+    assert cache.get_key('groups', {'rows': 1}) != cache.get_key('groups', {'rows': 2})
+
+
+def test_eviction(cache, source, archive):
+    for key in ('first', 'second'):
+        cache.store(key, source, 'dump/data/groups.csv', {})
+    entry_size = cache.get_path('first').stat().st_size
+    # The first entry becomes the most recently used one
+    past = time.time() - 10
+    os.utime(str(cache.get_path('second')), (past, past))
+    cache.copy('first', 'dump/data/groups.csv', archive)
+    cache.max_size = entry_size * 2
+    cache.store('third', source, 'dump/data/groups.csv', {})
+    assert sorted(path.stem for path in cache.directory.iterdir()) == ['first', 'third']
+
+
+@pytest.mark.usefixtures('schema', 'data')
+class TestDump:
+
+    def wait_for_changes(self, backend, fingerprint):
+        """
+        PostgreSQL statistics counters are updated with a delay.
+        """
+        for _ in range(100):
+            if IS_POSTGRES:
+                # Statistics are cached until the end of the transaction
+                backend.rollback()
+            if backend.get_table_fingerprint('groups') != fingerprint:
+                return
+            time.sleep(0.1)
+        pytest.fail('Statistics counters are not updated')
+
+    @pytest.mark.parametrize('workers', (
+        1,
+        pytest.param(2, marks=pytest.mark.postgres),
+    ))
+    def test_cached(self, backend, archive_filename, cache, workers):
+        first = backend.dump(archive_filename, ['groups'], {'employees': 'SELECT * FROM employees'}, cache=cache)
+        assert not first.tables['groups'].cached
+        second = backend.dump(
+            archive_filename, ['groups'], {'employees': 'SELECT * FROM employees'}, cache=cache, workers=workers
+        )
+        groups = second.tables['groups']
+        assert groups.cached
+        assert groups.rows == 2
+        assert (groups.size, groups.checksum) == (first.tables['groups'].size, first.tables['groups'].checksum)
+        # Partial tables are not cached
+        assert not second.tables['employees'].cached
+        archive = zipfile.ZipFile(archive_filename)
+        assert archive.read('dump/data/groups.csv') == b'id,name\n1,Admin\n2,User\n'
+        assert archive.testzip() is None
+        backend.verify(archive_filename, checksums=True)
+
+    def test_changed(self, backend, archive_filename, cache, cursor):
+        backend.dump(archive_filename, ['groups'], cache=cache)
+        fingerprint = backend.get_table_fingerprint('groups')
+        if not IS_POSTGRES:
+            # Modification time of the database file should change
+            time.sleep(0.01)
+        cursor.execute("INSERT INTO groups (id, name) VALUES (3, 'Guest')")
+        if IS_POSTGRES and cursor.connection.server_version >= 150000:
+            # Otherwise pending statistics of an idle connection are reported in 10 seconds
+            cursor.execute('SELECT pg_stat_force_next_flush()')
+        self.wait_for_changes(backend, fingerprint)
+        stats = backend.dump(archive_filename, ['groups'], cache=cache)
+        assert not stats.tables['groups'].cached
+        assert stats.tables['groups'].rows == 3
+
+    @pytest.mark.postgres
+    @pytest.mark.parametrize('sql', (
+        "ALTER TABLE groups ADD COLUMN code TEXT NOT NULL DEFAULT 'code'",
+        'ALTER TABLE groups DROP COLUMN name',
+    ))
+    def test_schema_changed(self, backend, archive_filename, cache, cursor, sql):
+        """
+        Columns could be added or dropped without rewriting the table.
+        """
+        backend.dump(archive_filename, ['groups'], cache=cache)
+        backend.rollback()
+        cursor.execute(sql)
+        stats = backend.dump(archive_filename, ['groups'], cache=cache)
+        assert not stats.tables['groups'].cached
+
+    @pytest.mark.postgres
+    def test_without_statistics(self, backend, archive_filename, cache, cursor, monkeypatch):
+        """
+        The table is scanned if statistics are not collected.
+        """
+        from xdump import postgresql
+
+        sql = postgresql.TABLE_FINGERPRINT_SQL.replace("current_setting('track_counts') = 'on'", 'false')
+        monkeypatch.setattr(postgresql, 'TABLE_FINGERPRINT_SQL', sql)
+        backend.dump(archive_filename, ['groups'], cache=cache)
+        # Changes are visible immediately and the number of rows is the same
+        cursor.execute("UPDATE groups SET name = 'Guest' WHERE id = 1")
+        stats = backend.dump(archive_filename, ['groups'], cache=cache)
+        assert not stats.tables['groups'].cached
+        assert b'1,Guest\n' in zipfile.ZipFile(archive_filename).read('dump/data/groups.csv')
+        # Rows of the transaction, that is started before the latest change, could get a lower ``xmin``
+        cursor.execute('BEGIN')
+        cursor.execute('SELECT txid_current()')
+        try:
+            with backend.transaction():
+                backend.run("UPDATE groups SET name = 'User' WHERE id = 1")
+            assert backend.get_table_fingerprint('groups') is None
+        finally:
+            cursor.execute('ROLLBACK')
+        backend.rollback()
+        assert backend.get_table_fingerprint('groups') is not None
+
+    def test_other_format(self, backend, archive_filename, cache):
+        backend.dump(archive_filename, ['groups'], cache=cache)
+        stats = backend.dump(archive_filename, ['groups'], cache=cache, compression='stored')
+        assert not stats.tables['groups'].cached
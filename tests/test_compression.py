@@ -0,0 +1,78 @@
+# coding: utf-8
+import sys
+import zipfile
+import zlib
+from io import BytesIO
+from unittest.mock import patch
+
+import pytest
+
+from xdump.compression import (
+    CompressedWriter,
+    DecompressedReader,
+    DeflateCompression,
+    ZstdCompression,
+    get_compression,
+)
+
+
+def test_compressed_writer():
+    output = BytesIO()
+    with CompressedWriter(output, zlib.compressobj()) as writer:
+        writer.write(b'first,')
+        writer.write(memoryview(b'second'))
+    assert zlib.decompress(output.getvalue()) == b'first,second'
+    assert writer.uncompressed_size == 12
+    # The underlying file is not closed
+    assert not output.closed
+
+
+def test_decompressed_reader():
+    data = b'id,name\n' * 1000
+    fd = BytesIO(zlib.compress(data))
+    with patch.object(DecompressedReader, 'chunk_size', 16):
+        reader = DecompressedReader(fd, zlib.decompressobj())
+        assert reader.readline() == b'id,name\n'
+        assert reader.read() == data[8:]
+    assert reader.uncompressed_size == len(data)
+
+
+def test_decompressed_reader_small_reads():
+    """
+    A large decompressed chunk is consumed by small reads.
+    """
+    data = bytes(range(256)) * 4096
+    reader = DecompressedReader(BytesIO(zlib.compress(data)), zlib.decompressobj())
+    target = bytearray(1000)
+    result = bytearray()
+    size = reader.readinto(target)
+    while size:
+        result += target[:size]
+        size = reader.readinto(target)
+    assert result == data
+    assert reader.uncompressed_size == len(data)
+
+
+@pytest.mark.skipif(sys.version_info[:2] < (3, 7), reason='Compression levels are supported only on Python 3.7+')
+def test_level(tmpdir):
+    filename = str(tmpdir.join('archive.zip'))
+    with DeflateCompression(9).open_archive(filename) as archive:
+        archive.writestr('test', b'test' * 100)
+    assert zipfile.ZipFile(filename).read('test') == b'test' * 100
+
+
+def test_missing_library():
+    with patch.object(ZstdCompression, 'library', None):
+        with pytest.raises(ValueError, match='zstd compression requires "zstandard" package'):
+            get_compression('zstd')
+
+
+def test_container_roundtrip(tmpdir):
+    pytest.importorskip('zstandard')
+    filename = str(tmpdir.join('archive.zip'))
+    compression = get_compression('zstd', 10)
+    with compression.open_archive(filename) as archive:
+        with compression.open_data_member(archive, 'data.csv') as fd:
+            fd.write(b'id,name\n1,Admin\n')
+    with zipfile.ZipFile(filename) as archive, compression.read_data_member(archive, 'data.csv') as fd:
+        assert fd.read() == b'id,name\n1,Admin\n'
@@ -0,0 +1,105 @@
+# coding: utf-8
+import pytest
+
+from xdump.connections import ConnectionPool
+
+from .conftest import IS_POSTGRES
+
+
+class Connection:
+    closed = False
+    healthy = True
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def pool():
+    return ConnectionPool(Connection, lambda connection: connection.healthy, lambda connection: None)
+
+
+def test_reuse(pool):
+    with pool.connection() as connection:
+        pass
+    assert pool.acquire() is connection
+    assert pool.acquire() is not connection
+
+
+def test_broken(pool):
+    with pool.connection() as connection:
+        connection.healthy = False
+    assert pool.acquire() is not connection
+    assert connection.closed
+
+
+def test_reset_failure(pool):
+
+    def reset(connection):
+        raise ValueError
+
+    pool.reset = reset
+    with pool.connection() as connection:
+        pass
+    assert connection.closed
+    assert pool.idle == []
+
+
+def test_max_idle(pool):
+    pool.max_idle = 1
+    first, second = pool.acquire(), pool.acquire()
+    pool.release(first)
+    pool.release(second)
+    assert pool.idle == [first]
+    assert second.closed
+    pool.close()
+    assert first.closed
+    assert pool.idle == []
+
+
+class TestBackend:
+
+    def test_reuse(self, backend):
+        connection = backend.get_connection()
+        assert backend.get_cursor().connection is connection
+        backend.cache_clear()
+        # The connection is returned to the pool and taken again
+        assert backend.get_connection() is connection
+
+    def test_broken(self, backend):
+        connection = backend.get_connection()
+        backend.cache_clear()
+        connection.close()
+        assert backend.get_connection() is not connection
+        assert backend.run('SELECT 1 AS value') == [{'value': 1}]
+
+    @pytest.mark.postgres
+    def test_terminated(self, backend):
+        connection = backend.get_connection()
+        backend.cache_clear()
+        backend.drop_connections(backend.dbname)
+        assert backend.get_connection() is not connection
+
+    def test_close(self, backend):
+        with backend:
+            connection = backend.get_connection()
+            backend.get_connection('maintenance' if IS_POSTGRES else 'default')
+        assert backend.cursors == {}
+        assert all(not pool.idle for pool in backend.pools.values())
+        with pytest.raises(backend.database_error):
+            connection.cursor()
+
+    @pytest.mark.postgres
+    def test_session_reset(self, backend):
+        backend.run("SELECT pg_catalog.set_config('search_path', '', false)")
+        backend.cache_clear()
+        assert backend.run('SHOW search_path') != [{'search_path': ''}]
+
+    @pytest.mark.postgres
+    @pytest.mark.usefixtures('schema', 'data')
+    def test_workers(self, backend, archive_filename):
+        backend.dump(archive_filename, ['groups', 'employees'], workers=2)
+        # Worker connections are kept for following dumps
+        assert len(backend.get_pool().idle) == 2
+        backend.dump(archive_filename, ['groups', 'employees'], workers=2)
+        assert len(backend.get_pool().idle) == 2
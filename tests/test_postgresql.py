@@ -1,9 +1,16 @@
 # coding: utf-8
+import subprocess
+import zipfile
+from io import BytesIO
 from unittest.mock import patch
 
 import psycopg2
 import pytest
 
+from xdump.postgresql import split_dump
+
+from .conftest import EMPLOYEES_SQL
+
 
 pytestmark = [pytest.mark.postgres, pytest.mark.usefixtures('schema')]
 
@@ -13,6 +20,99 @@ def test_write_sequences(backend, archive, db_helper):
     db_helper.assert_unused_sequences(archive)
 
 
+@pytest.mark.usefixtures('schema', 'data')
+def test_setup_files_snapshot(backend, archive_filename, cursor):
+    """
+    Setup files are dumped in the background and they see the same snapshot as the data.
+    """
+
+    export_snapshot = backend.export_snapshot
+
+    def create_table():
+        snapshot = export_snapshot()
+        cursor.execute('CREATE TABLE late (id INTEGER)')
+        return snapshot
+
+    with patch.object(backend, 'export_snapshot', side_effect=create_table):
+        backend.dump(archive_filename, ['groups'])
+    archive = zipfile.ZipFile(archive_filename)
+    schema = archive.read('dump/schema.sql')
+    assert b'groups' in schema
+    assert b'late' not in schema
+    assert archive.testzip() is None
+
+
+def test_setup_files_failure(backend, archive_filename):
+    with patch.object(backend, 'get_dump_command', return_value=('false', )):
+        with pytest.raises(subprocess.CalledProcessError):
+            backend.dump(archive_filename, ['groups'])
+
+
+def test_setup_files_discarded(backend, archive_filename):
+    """
+    Background ``pg_dump`` processes are stopped and their outputs are removed if the dump fails before they are
+    written.
+    """
+    background_dumps = []
+
+    def fail(*args, **kwargs):
+        background_dumps.extend(backend.background_dumps)
+        raise RuntimeError('Failed')
+
+    with patch.object(backend, 'add_related_data', side_effect=fail):
+        with pytest.raises(RuntimeError, match='Failed'):
+            backend.dump(archive_filename, ['groups'])
+    assert len(background_dumps) == 2
+    assert backend.background_dumps == ()
+    for _, process, future in background_dumps:
+        assert process.poll() is not None
+        assert future.exception() is not None or future.result().closed
+
+
+def test_post_data(backend, archive_filename):
+    """
+    Indexes and constraints are created after the data is loaded.
+    """
+    backend.dump(archive_filename, ['groups'])
+    archive = zipfile.ZipFile(archive_filename)
+    schema = archive.read('dump/schema.sql')
+    post_data = archive.read('dump/post_data.sql')
+    for statement in (b'PRIMARY KEY', b'FOREIGN KEY'):
+        assert statement not in schema
+        assert statement in post_data
+
+
+def test_split_dump():
+    header, entries = split_dump('''SET statement_timeout = 0;
+SET search_path = public, pg_catalog;
+
+--
+-- Name: groups_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY groups
+    ADD CONSTRAINT groups_pkey PRIMARY KEY (id);
+
+
+SET search_path = other, pg_catalog;
+
+--
+-- Name: employees_group_id_fkey; Type: FK CONSTRAINT; Schema: other; Owner: postgres
+--
+
+ALTER TABLE ONLY employees
+    ADD CONSTRAINT employees_group_id_fkey FOREIGN KEY (group_id) REFERENCES public.groups(id);
+''')
+    assert header == 'SET statement_timeout = 0;\nSET search_path = public, pg_catalog;\n\n'
+    assert entries[0] == (
+        'CONSTRAINT',
+        '\nALTER TABLE ONLY groups\n    ADD CONSTRAINT groups_pkey PRIMARY KEY (id);\n\n\n'
+        'SET search_path = other, pg_catalog;\n\n'
+    )
+    assert entries[1][0] == 'FK CONSTRAINT'
+    assert entries[1][1].startswith('SET search_path = other, pg_catalog;\n\nALTER TABLE ONLY employees')
+
+
 def test_handling_error(backend):
     with patch('psycopg2.extras.DictCursorBase.fetchall', side_effect=psycopg2.ProgrammingError), \
             pytest.raises(psycopg2.ProgrammingError):
@@ -25,11 +125,42 @@ def test_handling_error(backend):
 ))
 def test_dump_sequences(backend, cursor, sql, expected):
     cursor.execute(sql)
-    assert "SELECT pg_catalog.setval('groups_id_seq', {0}, true);".format(expected).encode() in backend.dump_sequences()
+    expected = "SELECT pg_catalog.setval('public.groups_id_seq', {0}, true);".format(expected).encode()
+    assert expected in backend.dump_sequences()
 
 
 def test_get_sequences(backend):
-    assert backend.get_sequences() == ['groups_id_seq', 'employees_id_seq', 'tickets_id_seq']
+    assert backend.get_sequences() == ['public.employees_id_seq', 'public.groups_id_seq', 'public.tickets_id_seq']
+
+
+def test_get_sequences_of_tables(backend):
+    assert backend.get_sequences({'groups'}) == ['public.groups_id_seq']
+    assert backend.get_sequences(set()) == []
+    assert backend.dump_sequences(set()) == b''
+
+
+def test_dump_sequences_other_schema(backend, cursor):
+    cursor.execute('CREATE SCHEMA "Other"; CREATE TABLE "Other".items (id SERIAL PRIMARY KEY)')
+    cursor.execute('INSERT INTO "Other".items DEFAULT VALUES')
+    try:
+        assert backend.get_sequences({'items'}) == ['"Other".items_id_seq']
+        assert backend.dump_sequences({'items'}) == b'SELECT pg_catalog.setval(\'"Other".items_id_seq\', 1, true);\n'
+    finally:
+        backend.rollback()
+        cursor.execute('DROP SCHEMA "Other" CASCADE')
+
+
+@pytest.mark.parametrize('sequences, expected', (
+    ('all', [b'groups_id_seq', b'employees_id_seq', b'tickets_id_seq']),
+    ('full_tables', [b'groups_id_seq']),
+    ('dumped', [b'groups_id_seq', b'employees_id_seq']),
+))
+@pytest.mark.usefixtures('schema', 'data')
+def test_dump_selected_sequences(backend, archive_filename, sequences, expected):
+    backend.dump(archive_filename, ['groups'], {'employees': EMPLOYEES_SQL}, sequences=sequences)
+    script = zipfile.ZipFile(archive_filename).read('dump/sequences.sql')
+    assert script.count(b'setval') == len(expected)
+    assert all(name in script for name in expected)
 
 
 def test_run_dump(backend, db_helper):
@@ -46,3 +177,170 @@ def test_run_dump_environment(backend):
 
 def test_run_dump_environment_empty_password(backend):
     assert 'PGPASSWORD' not in backend.run_dump_environment
+
+
+@pytest.mark.usefixtures('schema', 'data')
+def test_dump_workers(backend, archive_filename, db_helper):
+    """
+    Tables are exported concurrently, but all of them should see the same snapshot.
+    """
+    with db_helper.concurrent_insert('INSERT INTO groups (id, name) VALUES (3,\'test\')'):
+        stats = backend.dump(archive_filename, ['groups'], {'employees': EMPLOYEES_SQL}, workers=2)
+    archive = zipfile.ZipFile(archive_filename)
+    db_helper.assert_groups(archive)
+    db_helper.assert_employees(archive)
+    assert {name: table.rows for name, table in stats.tables.items()} == {'groups': 2, 'employees': 4}
+    assert stats.tables['groups'].size == archive.getinfo('dump/data/groups.csv').file_size
+    assert archive.testzip() is None
+    backend.verify(archive_filename, checksums=True)
+
+
+@pytest.mark.parametrize('compression', ('stored', 'lzma', 'zstd'))
+@pytest.mark.usefixtures('schema', 'data')
+def test_dump_workers_compression(backend, archive_filename, db_helper, compression):
+    """
+    Tables are compressed by workers and copied to the archive without recompression.
+    """
+    if compression == 'zstd':
+        pytest.importorskip('zstandard')
+    stats = backend.dump(
+        archive_filename, ['groups'], {'employees': EMPLOYEES_SQL}, workers=2, compression=compression
+    )
+    assert stats.tables['groups'].size == len(b'id,name\n1,Admin\n2,User\n')
+    backend.verify(archive_filename, checksums=True)
+    backend.recreate_database()
+    backend.load(archive_filename, workers=2)
+    backend.cache_clear()
+    assert backend.run('SELECT name FROM groups ORDER BY id') == [{'name': 'Admin'}, {'name': 'User'}]
+
+
+@pytest.mark.usefixtures('schema', 'data')
+def test_load_workers(backend, archive_filename, db_helper):
+    """
+    Tables are loaded concurrently, foreign keys should be re-created afterwards.
+    """
+    backend.dump(archive_filename, ['groups', 'employees', 'tickets'], {})
+    backend.recreate_database()
+    backend.load(archive_filename, workers=2)
+    backend.cache_clear()
+    assert db_helper.get_tickets_count() == 5
+    assert backend.run("SELECT COUNT(*) FROM pg_constraint WHERE contype = 'f'")[0]['count'] == 4
+    assert backend.run(
+        'SELECT COUNT(*) FROM pg_index '
+        "WHERE indisprimary AND indrelid::regclass::text IN ('groups', 'employees', 'tickets')"
+    )[0]['count'] == 3
+
+
+@pytest.mark.usefixtures('schema', 'data')
+def test_load_workers_commit(backend, archive_filename):
+    """
+    The loaded schema is committed via the connection, so ``psycopg2`` starts a new transaction afterwards.
+    """
+    backend.dump(archive_filename, ['groups', 'employees', 'tickets'], {})
+    backend.recreate_database()
+    create_foreign_keys = backend.create_foreign_keys
+    statuses = []
+
+    def check_status(foreign_keys):
+        statuses.append(backend.get_connection().status)
+        create_foreign_keys(foreign_keys)
+
+    with patch.object(backend, 'create_foreign_keys', side_effect=check_status):
+        backend.load(archive_filename, workers=2)
+    assert statuses == [psycopg2.extensions.STATUS_READY]
+
+
+def test_run_setup_file_concurrently(backend, cursor):
+    """
+    Entries, that depend on indexes, are executed after all of them are created.
+    """
+    cursor.execute('CREATE TABLE events (id INTEGER NOT NULL, kind INTEGER)')
+    sql = ''.join(
+        '--\n-- Name: {0}; Type: {1}; Schema: public; Owner: postgres\n--\n\n{2}\n\n'.format(*entry)
+        for entry in (
+            ('events_pkey', 'CONSTRAINT', 'ALTER TABLE ONLY events ADD CONSTRAINT events_pkey PRIMARY KEY (id);'),
+            ('INDEX events_kind_idx', 'COMMENT', "COMMENT ON INDEX events_kind_idx IS 'Kinds';"),
+            ('events_kind_idx', 'INDEX', 'CREATE INDEX events_kind_idx ON events USING btree (kind);'),
+            ('events', 'REPLICA IDENTITY', 'ALTER TABLE ONLY events REPLICA IDENTITY USING INDEX events_pkey;'),
+        )
+    )
+    backend.run_setup_file_concurrently(sql.encode(), 2)
+    assert backend.run("SELECT obj_description('events_kind_idx'::regclass) AS value") == [{'value': 'Kinds'}]
+    assert backend.run("SELECT relreplident FROM pg_class WHERE oid = 'events'::regclass") == [{'relreplident': 'i'}]
+
+
+@pytest.mark.usefixtures('schema', 'data')
+def test_dump_binary(backend, archive_filename):
+    backend.dump(archive_filename, ['groups'], {'employees': EMPLOYEES_SQL}, format='binary')
+    archive = zipfile.ZipFile(archive_filename)
+    assert archive.namelist()[:2] == ['dump/data/groups.bin', 'dump/data/employees.bin']
+    assert archive.read('dump/data/groups.bin').startswith(b'PGCOPY\n\xff\r\n\0')
+    manifest = backend.read_manifest(archive)
+    assert manifest['format'] == 'binary'
+    assert manifest['tables'][0]['filename'] == 'dump/data/groups.bin'
+
+
+@pytest.mark.usefixtures('schema', 'data')
+def test_load_data_file_binary(backend):
+    output = BytesIO()
+    backend.export_to_file('SELECT * FROM groups', output, format='binary')
+    backend.run('CREATE TABLE groups_copy (LIKE groups)')
+    output.seek(0)
+    assert backend.load_data_file('groups_copy', output, format='binary') == 2
+    assert backend.run('SELECT name FROM groups_copy ORDER BY id') == [{'name': 'Admin'}, {'name': 'User'}]
+
+
+@pytest.mark.parametrize('workers', (1, 2))
+@pytest.mark.usefixtures('schema', 'data')
+def test_load_binary(backend, archive_filename, db_helper, workers):
+    backend.dump(archive_filename, ['groups', 'employees', 'tickets'], {}, format='binary')
+    backend.recreate_database()
+    stats = backend.load(archive_filename, workers=workers)
+    assert stats.tables['tickets'].rows == 5
+    backend.cache_clear()
+    assert db_helper.get_tickets_count() == 5
+
+
+@pytest.mark.usefixtures('schema', 'data')
+def test_load_workers_invalid_data(backend, archive_filename, tmpdir):
+    """
+    Loaded data is validated when foreign keys are created again.
+    """
+    backend.dump(archive_filename, ['groups', 'employees', 'tickets'], {})
+    invalid_filename = str(tmpdir.join('invalid.zip'))
+    with zipfile.ZipFile(archive_filename) as source, zipfile.ZipFile(invalid_filename, 'w') as target:
+        for name in source.namelist():
+            data = source.read(name)
+            if name == 'dump/data/tickets.csv':
+                data = data.replace(b'1,1,Sub 1', b'1,42,Sub 1')
+            target.writestr(name, data)
+    backend.recreate_database()
+    with pytest.raises(psycopg2.IntegrityError):
+        backend.load(invalid_filename, workers=2)
+
+
+@pytest.mark.usefixtures('schema', 'data', 'cycle')
+def test_dump_workers_cyclic_relations(backend, archive_filename):
+    with pytest.raises(ValueError):
+        backend.dump(archive_filename, [], {'books': 'SELECT * FROM books WHERE id = 1'}, workers=2)
+
+
+@pytest.mark.usefixtures('schema', 'data')
+def test_dump_xmin_watermark(backend, archive_filename, tmpdir, cursor, db_helper):
+    base_filename = str(tmpdir.join('base.zip'))
+    backend.dump(base_filename, ['tickets'], watermarks={'tickets': 'xmin'})
+    cursor.execute("UPDATE tickets SET subject = 'Updated' WHERE id IN (1, 3)")
+    backend.dump(archive_filename, ['tickets'], watermarks={'tickets': 'xmin'}, base=base_filename)
+    archive = zipfile.ZipFile(archive_filename)
+    expected = {b'1,1,Updated,Message 1', b'3,2,Updated,Message 3'}
+    db_helper.assert_content(archive, 'tickets', {b'id,author_id,subject,message'} | expected)
+    assert 'dump/sequences.sql' in archive.namelist()
+    assert 'dump/schema.sql' not in archive.namelist()
+
+
+@pytest.mark.usefixtures('schema', 'data')
+def test_get_primary_key(backend, cursor):
+    cursor.execute(
+        'CREATE TABLE memberships (employee_id INTEGER, group_id INTEGER, PRIMARY KEY (group_id, employee_id))'
+    )
+    assert backend.get_primary_key('memberships') == ['employee_id', 'group_id']
@@ -0,0 +1,103 @@
+# coding: utf-8
+import csv
+import re
+import zipfile
+from collections import Counter
+from io import StringIO
+
+import pytest
+
+from xdump.sampling import Sample
+
+from .conftest import IS_POSTGRES
+
+
+EVENTS_SQL = '''
+CREATE TABLE events (id INTEGER PRIMARY KEY, kind INTEGER NOT NULL);
+INSERT INTO events (id, kind)
+WITH RECURSIVE numbers(number) AS (SELECT 1 UNION ALL SELECT number + 1 FROM numbers WHERE number < 2000)
+SELECT number, number % 4 FROM numbers;
+INSERT INTO events (id, kind) VALUES (2001, 9);
+'''
+
+
+@pytest.fixture
+def events(cursor):
+    for sql in EVENTS_SQL.split(';')[:-1]:
+        cursor.execute(sql)
+
+
+def read_rows(filename, table_name):
+    data = zipfile.ZipFile(filename).read('dump/data/{0}.csv'.format(table_name)).decode()
+    return list(csv.DictReader(StringIO(data)))
+
+
+@pytest.mark.parametrize('kwargs, message', (
+    ({'percent': 0}, 'Sample percent should be in (0, 100] range: 0'),
+    ({'percent': 101}, 'Sample percent should be in (0, 100] range: 101'),
+    ({'percent': 1, 'method': 'block'}, 'Unsupported sampling method: block. Available methods: system, bernoulli'),
+    ({'percent': 1, 'seed': 0.5}, 'Sample seed should be an integer: 0.5'),
+))
+def test_invalid(kwargs, message):
+    with pytest.raises(ValueError, match=re.escape(message)):
+        Sample(**kwargs)
+
+
+@pytest.mark.parametrize('by, expected', (
+    (None, ()),
+    ('kind', ('kind', )),
+    (['kind', 'id'], ('kind', 'id')),
+))
+def test_by(by, expected):
+    assert Sample(1, by=by).by == expected
+
+
+@pytest.mark.postgres
+@pytest.mark.parametrize('sample, expected', (
+    (Sample(1, method='system'), 'SELECT * FROM events TABLESAMPLE SYSTEM (1)'),
+    (Sample(0.5, seed=42), 'SELECT * FROM events TABLESAMPLE BERNOULLI (0.5) REPEATABLE (42)'),
+))
+def test_table_sample_sql(backend, sample, expected):
+    assert backend.get_sample_sql('events', sample) == expected
+
+
+@pytest.mark.usefixtures('events')
+class TestDump:
+
+    def test_sample(self, backend, archive_filename):
+        stats = backend.dump(archive_filename, [], {'events': Sample(10, seed=42)})
+        assert 100 < stats.tables['events'].rows < 300
+        # The manifest contains the actual query
+        options = backend.read_manifest(zipfile.ZipFile(archive_filename))['options']
+        assert options['partial_tables']['events'] == backend.get_sample_sql('events', Sample(10, seed=42))
+
+    def test_repeatable(self, backend, archive_filename, tmpdir):
+        other_filename = str(tmpdir.join('other.zip'))
+        backend.dump(archive_filename, [], {'events': Sample(10, seed=42)})
+        backend.dump(other_filename, [], {'events': Sample(10, seed=42)})
+        assert read_rows(archive_filename, 'events') == read_rows(other_filename, 'events')
+
+    @pytest.mark.parametrize('seed', (None, 42))
+    def test_stratified(self, backend, archive_filename, seed):
+        backend.dump(archive_filename, [], {'events': Sample(10, seed=seed, by='kind')})
+        rows = read_rows(archive_filename, 'events')
+        # At least one row of every group
+        assert Counter(row['kind'] for row in rows) == {'0': 50, '1': 50, '2': 50, '3': 50, '9': 1}
+
+    def test_stratified_repeatable(self, backend, archive_filename, tmpdir):
+        other_filename = str(tmpdir.join('other.zip'))
+        backend.dump(archive_filename, [], {'events': Sample(10, seed=42, by='kind')})
+        backend.dump(other_filename, [], {'events': Sample(10, seed=42, by='kind')})
+        first = read_rows(archive_filename, 'events')
+        assert first == read_rows(other_filename, 'events')
+        backend.dump(other_filename, [], {'events': Sample(10, seed=43, by='kind')})
+        assert first != read_rows(other_filename, 'events')
+
+
+@pytest.mark.usefixtures('schema', 'data')
+def test_related_data(backend, archive_filename, db_helper):
+    kwargs = {'workers': 2} if IS_POSTGRES else {}
+    backend.dump(archive_filename, [], {'employees': Sample(100, by='group_id')}, **kwargs)
+    archive = zipfile.ZipFile(archive_filename)
+    db_helper.assert_groups(archive)
+    assert len(read_rows(archive_filename, 'employees')) == 5
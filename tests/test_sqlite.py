@@ -0,0 +1,98 @@
+# coding: utf-8
+import sqlite3
+import zipfile
+from io import BytesIO
+from unittest.mock import patch
+
+import pytest
+
+from .conftest import EMPLOYEES_SQL
+
+
+pytestmark = [pytest.mark.sqlite, pytest.mark.usefixtures('schema')]
+
+
+@pytest.mark.usefixtures('schema', 'data')
+def test_export_to_file(backend):
+    backend.export_batch_size = 1
+    output = BytesIO()
+    assert backend.export_to_file('SELECT * FROM groups', output) == 2
+    assert output.getvalue() == b'id,name\n1,Admin\n2,User\n'
+    # The default cursor still returns dictionaries
+    assert backend.run('SELECT name FROM groups WHERE id = 1') == [{'name': 'Admin'}]
+
+
+def test_load_data_file(backend):
+    """
+    Quoted values could contain new lines.
+    """
+    fd = BytesIO(b'id,name\n1,"First\nline"\n2,"Second, line"\n')
+    assert backend.load_data_file('groups', fd) == 2
+    assert backend.run('SELECT name FROM groups ORDER BY id') == [{'name': 'First\nline'}, {'name': 'Second, line'}]
+
+
+def test_load_data_file_batches(backend):
+    backend.load_batch_size = 2
+    fd = BytesIO(b'id,name\n' + b''.join('{0},Group {0}\n'.format(i).encode() for i in range(1, 6)))
+    assert backend.load_data_file('groups', fd) == 5
+    assert backend.run('SELECT COUNT(*) AS count FROM groups')[0]['count'] == 5
+
+
+def test_load_data_file_empty(backend):
+    assert backend.load_data_file('groups', BytesIO(b'')) == 0
+
+
+@pytest.mark.usefixtures('schema', 'data')
+def test_load(backend, archive_filename, dbname):
+    backend.dump(archive_filename, ['groups'], {'employees': EMPLOYEES_SQL})
+    backend.recreate_database()
+    backend.load(archive_filename)
+    # Changed pragmas are restored
+    assert backend.run('PRAGMA journal_mode') == [{'journal_mode': 'delete'}]
+    # Data is committed and visible to other connections
+    connection = sqlite3.connect(dbname)
+    assert connection.execute('SELECT COUNT(*) FROM employees').fetchone() == (4, )
+
+
+@pytest.mark.parametrize('kwargs, expected', (
+    ({}, True),
+    ({'tables': ['employees']}, False),
+    ({'lazy': True}, False),
+))
+@pytest.mark.usefixtures('schema', 'data')
+def test_unsafe_writes(backend, archive_filename, kwargs, expected):
+    """
+    Only loading of all data into the new database is not journaled.
+    """
+    backend.dump(archive_filename, ['groups', 'employees'])
+    backend.recreate_database()
+    with patch.object(backend, 'unsafe_writes', wraps=backend.unsafe_writes) as unsafe_writes:
+        backend.load(archive_filename, **kwargs)
+        if kwargs.get('lazy'):
+            backend.ensure_loaded('employees')
+    assert unsafe_writes.called is expected
+    assert backend.run('SELECT COUNT(*) AS count FROM employees')[0]['count'] == 5
+
+
+@pytest.mark.usefixtures('schema', 'data')
+def test_load_failure(backend, archive_filename, tmpdir):
+    """
+    The transaction is rolled back before pragmas are restored.
+    """
+    backend.dump(archive_filename, ['groups'])
+    broken_filename = str(tmpdir.join('broken.zip'))
+    with zipfile.ZipFile(archive_filename) as source, zipfile.ZipFile(broken_filename, 'w') as target:
+        for info in source.infolist():
+            data = b'id,unknown\n1,2\n' if info.filename == 'dump/data/groups.csv' else source.read(info)
+            target.writestr(info, data)
+    backend.recreate_database()
+    with pytest.raises(sqlite3.OperationalError, match='has no column named unknown'):
+        backend.load(broken_filename)
+    assert not backend.get_cursor().connection.in_transaction
+    assert backend.run('PRAGMA journal_mode') == [{'journal_mode': 'delete'}]
+
+
+def test_dump_workers(backend, archive_filename):
+    with pytest.raises(ValueError, match='parallel export is not supported by SQLite'):
+        backend.dump(archive_filename, ['groups'], workers=2)
+    assert not backend.get_cursor().connection.in_transaction
@@ -1,7 +1,153 @@
-from xdump.utils import make_options
+import hashlib
+import zipfile
+from io import BytesIO
+
+import pytest
+
+from xdump.utils import (
+    HashingWriter,
+    copy_archive_member,
+    get_checksum,
+    make_options,
+    open_archive_member,
+    pipelined,
+    quote_value,
+    strongly_connected_components,
+)
 
 
 def test_make_options():
     assert list(make_options('-t', ['foo', 'bar'])) == [
         '-t', 'foo', '-t', 'bar'
     ]
+
+
+@pytest.mark.parametrize('value, expected', (
+    (5, '5'),
+    (1.5, '1.5'),
+    ('2018-01-01 10:00:00', "'2018-01-01 10:00:00'"),
+    ("O'Brien", "'O''Brien'"),
+))
+def test_quote_value(value, expected):
+    assert quote_value(value) == expected
+
+
+def test_hashing_writer():
+    output = BytesIO()
+    with HashingWriter(output) as writer:
+        writer.write(b'foo')
+        writer.write(b'bar')
+    assert not output.closed
+    assert output.getvalue() == b'foobar'
+    assert writer.checksum == 'sha256:' + hashlib.sha256(b'foobar').hexdigest()
+    assert get_checksum(BytesIO(b'foobar')) == writer.checksum
+
+
+def test_strongly_connected_components():
+    assert strongly_connected_components({
+        'a': {'b'},
+        'b': {'c', 'unknown'},
+        'c': set(),
+        'd': {'d', 'e'},
+        'e': {'d', 'a'},
+    }) == [['c'], ['b'], ['a'], ['d', 'e']]
+
+
+@pytest.mark.parametrize('compression', (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED, zipfile.ZIP_LZMA))
+def test_copy_archive_member(tmpdir, compression):
+    source_filename = str(tmpdir.join('source.zip'))
+    target_filename = str(tmpdir.join('target.zip'))
+    data = b'id,name\n1,Admin\n' * 1000
+    with zipfile.ZipFile(source_filename, 'w', compression) as source:
+        with open_archive_member(source, 'data.csv') as fd:
+            fd.write(data)
+    with zipfile.ZipFile(source_filename) as source, zipfile.ZipFile(target_filename, 'w') as target:
+        target.writestr('first.txt', b'first')
+        info = copy_archive_member(source, 'data.csv', target)
+        # Members could be added afterwards
+        target.writestr('last.txt', b'last')
+    assert info.compress_size == source.getinfo('data.csv').compress_size
+    with zipfile.ZipFile(target_filename) as target:
+        assert target.testzip() is None
+        assert target.namelist() == ['first.txt', 'data.csv', 'last.txt']
+        assert target.getinfo('data.csv').compress_type == compression
+        assert target.read('data.csv') == data
+
+
+def test_copy_archive_member_zip64(tmpdir):
+    """
+    Highly compressible data could be larger than 4 GiB while its compressed size is not.
+    """
+    source_filename = str(tmpdir.join('source.zip'))
+    target_filename = str(tmpdir.join('target.zip'))
+    with zipfile.ZipFile(source_filename, 'w', zipfile.ZIP_DEFLATED) as source:
+        source.writestr('data.csv', b'x' * 1000)
+    with zipfile.ZipFile(source_filename) as source, zipfile.ZipFile(target_filename, 'w') as target:
+        source.getinfo('data.csv').file_size = 5 * 1024 ** 3
+        copy_archive_member(source, 'data.csv', target)
+    with zipfile.ZipFile(target_filename) as target:
+        info = target.getinfo('data.csv')
+        assert (info.file_size, info.compress_size) == (5 * 1024 ** 3, source.getinfo('data.csv').compress_size)
+
+
+def test_copy_archive_member_truncated(tmpdir):
+    source_filename = str(tmpdir.join('source.zip'))
+    with zipfile.ZipFile(source_filename, 'w', zipfile.ZIP_DEFLATED) as source:
+        source.writestr('data.csv', b'id,name\n1,Admin\n' * 1000)
+    with zipfile.ZipFile(source_filename) as source, zipfile.ZipFile(BytesIO(), 'w') as target:
+        # The member claims more data than there is in the file
+        source.getinfo('data.csv').compress_size = 1024 ** 2
+        with pytest.raises(zipfile.BadZipFile, match='Truncated member: data.csv'):
+            copy_archive_member(source, 'data.csv', target)
+
+
+def test_zipfile_internals():
+    """
+    ``copy_archive_member`` relies on these internals of ``zipfile``.
+    """
+    for name in ('_FH_FILENAME_LENGTH', '_FH_EXTRA_FIELD_LENGTH', 'structFileHeader', 'sizeFileHeader'):
+        assert hasattr(zipfile, name)
+    with zipfile.ZipFile(BytesIO(), 'w') as archive:
+        archive.writestr('data.csv', b'data')
+        assert archive._didModify is True
+        assert archive.start_dir == archive.fp.tell()
+        assert archive.NameToInfo == {'data.csv': archive.filelist[0]}
+
+
+def test_copy_archive_member_last(tmpdir):
+    """
+    The central directory is written after the copied member, if it is the last one.
+    """
+    source_filename = str(tmpdir.join('source.zip'))
+    target_filename = str(tmpdir.join('target.zip'))
+    with zipfile.ZipFile(source_filename, 'w', zipfile.ZIP_DEFLATED) as source:
+        source.writestr('data.csv', b'id,name\n1,Admin\n')
+    with zipfile.ZipFile(source_filename) as source, zipfile.ZipFile(target_filename, 'w') as target:
+        copy_archive_member(source, 'data.csv', target)
+    with zipfile.ZipFile(target_filename) as target:
+        assert target.testzip() is None
+        assert target.read('data.csv') == b'id,name\n1,Admin\n'
+
+
+def test_pipelined():
+    output = BytesIO()
+    with pipelined(output, queue_size=1) as fd:
+        for _ in range(1000):
+            fd.write(b'x' * 100)
+    assert output.getvalue() == b'x' * 100000
+
+
+class BrokenFile:
+
+    def write(self, data):
+        raise OSError('No space left on device')
+
+
+def test_pipelined_error():
+    """
+    Errors from the writing thread are raised in the calling thread.
+    """
+    with pytest.raises(OSError, match='No space left on device'):
+        with pipelined(BrokenFile(), queue_size=1) as fd:
+            for _ in range(1000):
+                fd.write(b'x' * 1000)
@@ -0,0 +1,375 @@
+# coding: utf-8
+import asyncio
+import shutil
+import subprocess
+import time
+from pathlib import Path
+from tempfile import TemporaryFile
+
+import attr
+
+from .compression import get_compression
+from .postgresql import SEQUENCES_SQL, PostgreSQLBackend
+from .stats import Stats
+from .utils import COPY_CHUNK_SIZE, HashingWriter, open_archive_member
+
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+
+class AsyncReader:
+    """
+    Asynchronous iterator over chunks of the given file. Chunks are read in the default executor of the event loop,
+    because reading could include decompression.
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await asyncio.get_event_loop().run_in_executor(None, self.fd.read, self.chunk_size)
+        if not chunk:
+            raise StopAsyncIteration
+        return chunk
+
+
+def get_copy_rows(status):
+    """
+    The number of rows from the command status, e.g. ``COPY 5``.
+    """
+    return int(status.split()[-1])
+
+
+@attr.s(cmp=False)
+class AsyncPostgreSQLBackend(PostgreSQLBackend):
+    """
+    ``dump``, ``load`` and ``recreate_database`` are coroutines, that don't block the event loop. Queries and ``COPY``
+    are executed via ``asyncpg``, ``pg_dump`` is run as an asyncio subprocess. Compression and copying of archive
+    members run in the default executor of the event loop. Multiple dumps / loads could run concurrently in a single
+    thread, every one with its own backend instance.
+
+    Parallel workers, materialized tables, incremental dumps, the table cache, budgets, selective loading and template
+    databases are supported only by ``PostgreSQLBackend``. Inherited methods, that query the database synchronously,
+    raise ``ValueError``.
+    """
+    async_connections = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+    # Foreign keys, table names and the server version, that are used by the synchronous selection logic
+    metadata = attr.ib(default=None, init=False, repr=False)
+    async_connection_options = {
+        'default': {},
+        'maintenance': {
+            'database': 'postgres',
+        },
+    }
+    async_copy_options = {
+        'csv': {'format': 'csv', 'header': True},
+        'binary': {'format': 'binary'},
+    }
+
+    def __attrs_post_init__(self):
+        if asyncpg is None:
+            raise ValueError('Async backend requires "asyncpg" package. Install it via "pip install xdump[asyncpg]"')
+
+    # Connection
+
+    async def get_async_connection(self, name='default'):
+        if name not in self.async_connections:
+            options = self.async_connection_options[name]
+            self.async_connections[name] = await asyncpg.connect(
+                database=options.get('database', self.dbname),
+                user=self.user,
+                password=self.password,
+                host=self.host,
+                port=self.port,
+            )
+        return self.async_connections[name]
+
+    async def aclose(self, *names):
+        """
+        Closes connections with the given names (all by default).
+        """
+        for name in names or list(self.async_connections):
+            connection = self.async_connections.pop(name, None)
+            if connection is not None:
+                await connection.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+    async def run_async(self, sql, *params, using='default'):
+        connection = await self.get_async_connection(using)
+        start = time.perf_counter()
+        result = await connection.fetch(sql, *params)
+        self.stats.add_query(sql, time.perf_counter() - start)
+        return [dict(record) for record in result]
+
+    async def run_dump_async(self, *args):
+        """
+        Writes the ``pg_dump`` output to a temporary file as it is produced, so it is not held in memory. The process is
+        killed if the coroutine is cancelled.
+        """
+        command = self.get_dump_command(*args)
+        process = await asyncio.create_subprocess_exec(
+            *command, stdout=asyncio.subprocess.PIPE, env=self.run_dump_environment
+        )
+        output = TemporaryFile()
+        try:
+            while True:
+                chunk = await process.stdout.read(COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                output.write(chunk)
+            if await process.wait():
+                raise subprocess.CalledProcessError(process.returncode, command)
+        except BaseException:
+            output.close()
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+        output.seek(0)
+        return output
+
+    async def run_setup_file_async(self, sql):
+        connection = await self.get_async_connection()
+        if not sql:
+            return
+        await connection.execute(sql.decode())
+        # Newer versions of ``pg_dump`` empty the search path of the session and qualify all names
+        await connection.execute('RESET search_path')
+
+    # Metadata for the synchronous logic
+
+    async def load_metadata(self):
+        """
+        Loads everything, that is queried by the inherited logic of selecting related rows and building the manifest.
+        Foreign keys are loaded once, like in the synchronous backend.
+        """
+        metadata = {
+            'tables': [row['table_name'] for row in await self.run_async(self.tables_sql)],
+            'server_version': (await self.run_async('SHOW server_version'))[0]['server_version'],
+        }
+        if self.metadata is None:
+            metadata['foreign_keys'] = await self.run_async(self.relations_sql)
+        else:
+            metadata['foreign_keys'] = self.metadata['foreign_keys']
+        self.metadata = metadata
+
+    def cache_clear(self):
+        super().cache_clear()
+        self.metadata = None
+
+    @property
+    def tables(self):
+        return iter(self.metadata['tables'])
+
+    def get_all_foreign_keys(self):
+        return self.metadata['foreign_keys']
+
+    def get_server_version(self):
+        return self.metadata['server_version']
+
+    def materialize_component(self, component, full_tables, partial_tables):
+        """
+        Temporary tables are not supported. Tables referencing each other are allowed only if none of them is selected.
+        """
+        for table in component:
+            if table in partial_tables or self.get_selection_sources(table, component, full_tables, partial_tables):
+                raise ValueError(
+                    'Tables referencing each other are not supported by the async backend: {0}'.format(
+                        ', '.join(component)
+                    )
+                )
+        return []
+
+    # Unsupported synchronous methods
+
+    def get_cursor(self, name='default'):
+        """
+        All synchronous queries go through this method, e.g. ``run``, ``execute`` and ``transaction``.
+        """
+        raise ValueError('Synchronous queries are not supported by the async backend, use "run_async" instead')
+
+    def close(self, *names):
+        raise ValueError('Synchronous connections are not supported by the async backend, use "aclose" instead')
+
+    def load_template(self, *args, **kwargs):
+        raise ValueError('Template databases are not supported by the async backend')
+
+    def create_template(self, *args, **kwargs):
+        raise ValueError('Template databases are not supported by the async backend')
+
+    def ensure_loaded(self, *table_names):
+        raise ValueError('Lazy loading is not supported by the async backend')
+
+    # Dumping the data
+
+    async def dump(self, filename, full_tables=(), partial_tables=None, stats=None, format='csv',
+                   compression='deflate', compression_level=None, sequences='all'):
+        """
+        Creates a dump in the same format as ``PostgreSQLBackend.dump``. All data is selected in a single transaction.
+        """
+        self.set_data_format(format)
+        self.set_sequences(sequences)
+        self.compression = get_compression(compression, compression_level)
+        partial_tables = self.get_partial_tables(partial_tables or {})
+        self.stats = stats = stats or Stats()
+        self.watermarks = {}
+        self.incremental = False
+        self.cache = None
+        self.budget = None
+        self.related_foreign_keys = {}
+        self.dump_options = {
+            'full_tables': list(full_tables),
+            'partial_tables': dict(partial_tables),
+            'workers': 1,
+            'materialize': False,
+            'compression_level': compression_level,
+            'sequences': sequences,
+        }
+        connection = await self.get_async_connection()
+        setup_dumps = []
+        try:
+            async with connection.transaction(isolation='repeatable_read', readonly=True):
+                with self.compression.open_archive(filename) as file:
+                    with stats.phase('initial_setup'):
+                        await self.load_metadata()
+                        setup_dumps = await self.start_initial_setup_async()
+                    with stats.phase('related_data'):
+                        self.add_related_data(full_tables, partial_tables)
+                    with stats.phase('data'):
+                        for table_name in full_tables:
+                            await self.write_data_file_async(file, table_name, self.get_full_table_sql(table_name))
+                        for table_name, sql in partial_tables.items():
+                            await self.write_data_file_async(file, table_name, sql)
+                        for filename, future in setup_dumps:
+                            with await future as output:
+                                await self.run_in_executor(self.write_setup_file, file, filename, output)
+                        sequences = await self.dump_sequences_async(self.get_sequence_tables())
+                        file.writestr(self.sequences_filename, sequences)
+                    self.write_manifest(file)
+        finally:
+            await self.discard_setup_dumps(setup_dumps)
+        return stats
+
+    def write_setup_file(self, file, filename, output):
+        with open_archive_member(file, filename) as fd:
+            shutil.copyfileobj(output, fd)
+
+    async def run_in_executor(self, function, *args):
+        """
+        Runs blocking file operations, e.g. compression, in the default executor of the event loop.
+        """
+        return await asyncio.get_event_loop().run_in_executor(None, function, *args)
+
+    async def start_initial_setup_async(self):
+        """
+        ``pg_dump`` processes for the schema and post-data run concurrently with the data export. They use the snapshot
+        of the current transaction. Returns filenames and futures of their outputs.
+        """
+        snapshot = (await self.run_async('SELECT pg_export_snapshot()'))[0]['pg_export_snapshot']
+        dumps = (
+            (self.schema_filename, self.get_schema_options()),
+            (self.post_data_filename, self.get_schema_options(section='post-data')),
+        )
+        return [
+            (filename, asyncio.ensure_future(self.run_dump_async('--snapshot={0}'.format(snapshot), *options)))
+            for filename, options in dumps
+        ]
+
+    async def discard_setup_dumps(self, setup_dumps):
+        """
+        ``pg_dump`` processes, that are still running because of an error, are killed and their outputs are removed.
+        """
+        futures = [future for _, future in setup_dumps]
+        for future in futures:
+            future.cancel()
+        for result in await asyncio.gather(*futures, return_exceptions=True):
+            if hasattr(result, 'close'):
+                result.close()
+
+    async def dump_sequences_async(self, tables=None):
+        sequences = self.filter_sequences(await self.run_async(SEQUENCES_SQL), tables)
+        if not sequences:
+            return b''
+        return self.get_setval_script(await self.run_async(self.get_sequence_values_sql(sequences)))
+
+    async def write_data_file_async(self, file, table_name, sql):
+        """
+        Streams the result of the given sql directly to the archive member.
+        """
+        filename = self.get_data_filename(table_name)
+        with self.stats.table(table_name, sql) as table:
+            with self.compression.open_data_member(file, filename) as fd, HashingWriter(fd) as hashing:
+                table.set_rows(await self.export_to_file_async(sql, hashing, format=self.data_format))
+            table.checksum = hashing.checksum
+            table.set_sizes(file.getinfo(filename), getattr(fd, 'uncompressed_size', None))
+
+    async def export_to_file_async(self, sql, fd, format='csv'):
+        connection = await self.get_async_connection()
+
+        async def write(data):
+            await self.run_in_executor(fd.write, data)
+
+        status = await connection.copy_from_query(sql, output=write, **self.async_copy_options[format])
+        return get_copy_rows(status)
+
+    # Database re-creation
+
+    async def recreate_database(self, owner=None):
+        await self.aclose('default')
+        maintenance = await self.get_async_connection('maintenance')
+        await maintenance.execute(
+            'SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE datname = $1', self.dbname
+        )
+        await maintenance.execute('DROP DATABASE IF EXISTS {0}'.format(self.dbname))
+        await maintenance.execute('CREATE DATABASE {0} WITH OWNER {1}'.format(self.dbname, owner or self.user))
+        self.cache_clear()
+
+    # Loading the dump
+
+    async def load(self, filename, stats=None):
+        """
+        Loads schema, sequences and data into the database. The data is loaded in a single transaction.
+        """
+        self.stats = stats = stats or Stats()
+        with self.open_archive(filename) as archive:
+            if self.manifest.get('incremental'):
+                raise ValueError('Incremental dumps are not supported by the async backend')
+            connection = await self.get_async_connection()
+            with stats.phase('initial_setup'):
+                for name in self.initial_setup_files:
+                    await self.run_setup_file_async(archive.read(name))
+            with stats.phase('data'):
+                async with connection.transaction():
+                    for name in self.get_data_members(archive):
+                        await self.load_archive_member_async(archive, name)
+            with stats.phase('final_setup'):
+                namelist = archive.namelist()
+                for name in self.final_setup_files:
+                    # Archives made by previous versions have the whole schema in the initial setup files
+                    if name in namelist:
+                        async with connection.transaction():
+                            await self.run_setup_file_async(archive.read(name))
+        return stats
+
+    async def load_archive_member_async(self, archive, name):
+        info = archive.getinfo(name)
+        with self.stats.table(Path(name).stem) as table, self.compression.read_data_member(archive, info) as fd:
+            table.set_rows(await self.load_data_file_async(table.name, fd, format=self.data_format))
+            table.set_sizes(info, getattr(fd, 'uncompressed_size', None))
+
+    async def load_data_file_async(self, table_name, fd, format='csv'):
+        connection = await self.get_async_connection()
+        status = await connection.copy_to_table(table_name, source=AsyncReader(fd), **self.async_copy_options[format])
+        return get_copy_rows(status)
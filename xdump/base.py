@@ -1,11 +1,35 @@
 # coding: utf-8
+import json
+import os
+import threading
+import time
 import zipfile
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from functools import lru_cache
+from functools import partial
+from io import BytesIO
+from itertools import chain
+from operator import attrgetter
 from pathlib import Path
+from tempfile import TemporaryFile
 
 import attr
 
+from .budget import BudgetExceeded, BudgetWriter
+from .compression import DeflateCompression, get_compression
+from .connections import ConnectionPool
+from .sampling import Sample
+from .stats import Stats, TableStats
+from .utils import (
+    HashingWriter,
+    copy_archive_member,
+    get_checksum,
+    pipelined,
+    quote_value,
+    strongly_connected_components,
+)
+
 
 @attr.s(cmp=False)
 class BaseBackend:
@@ -14,23 +38,126 @@ class BaseBackend:
     password = attr.ib()
     host = attr.ib()
     port = attr.ib(convert=str)
+    stats = attr.ib(default=attr.Factory(Stats), init=False, repr=False)
+    # Pools of idle connections and cursors of connections in use by their names
+    pools = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+    cursors = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+    # Foreign keys in the database by referencing and referenced table names, they are loaded on demand
+    relations = attr.ib(default=None, init=False, repr=False)
+    reverse_relations = attr.ib(default=None, init=False, repr=False)
+    # Primary keys by table names, they are loaded on demand
+    primary_keys = attr.ib(default=attr.Factory(dict), init=False, repr=False)
     connections = {'default': {}}
+    # Idle connections of every name, that are kept for reuse. None means no limit
+    max_idle_connections = None
+    # Base class of exceptions of the database driver
+    database_error = Exception
     schema_filename = 'dump/schema.sql'
+    manifest_filename = 'dump/manifest.json'
     initial_setup_files = (schema_filename, )
+    final_setup_files = ()
+    # Files, that are written to incremental dumps instead of the initial setup and are loaded after the data
+    incremental_setup_files = ()
     data_dir = 'dump/data/'
+    # Primary keys of all selected rows of tables with watermarks in incremental dumps. Used to find deleted rows
+    keys_dir = 'dump/keys/'
+    # Supported formats of data files and their extensions
+    data_formats = {'csv': '.csv'}
+    data_format = 'csv'
+    # Sequences, which states are dumped
+    sequences_options = ('all', 'full_tables', 'dumped')
+    sequences = 'all'
+    compression = DeflateCompression()
+    watermarks = {}
+    incremental = False
+    # Options of the current dump / the manifest of the loaded archive
+    dump_options = {}
+    manifest = {}
+    cache = None
+    budget = None
+    # Estimates of selections by table names and queries, that are checked against the budget during the dump
+    budget_estimates = {}
+    # Foreign keys, via which related rows of every table are selected
+    related_foreign_keys = {}
+    # Tables, which data should be loaded (None means all tables), and tables, which data is loaded already
+    selected_tables = None
+    loaded_tables = set()
+    # The archive, which tables are loaded on demand
+    lazy_filename = None
+    # Complete templates and templates, that are being loaded
+    template_prefix = 'xdump_template_'
+    template_loading_prefix = 'xdump_loading_'
+    # Selects the current watermark value of the query result
+    watermark_sql = 'SELECT MAX(T.{column}) AS value FROM ({sql}) T'
     tables_sql = None
-    non_recursive_relations_query = None
-    recursive_relations_query = None
+    relations_sql = None
 
     # Connection
 
-    @lru_cache()
+    def get_pool(self, name='default'):
+        """
+        Idle connections with the given name, that are reused by following dumps / loads and worker threads.
+        """
+        if name not in self.pools:
+            self.pools[name] = ConnectionPool(
+                partial(self.connect, **self.connections[name]),
+                self.check_connection,
+                self.reset_connection,
+                self.max_idle_connections,
+            )
+        return self.pools[name]
+
     def get_connection(self, name='default'):
-        return self.connect(**self.connections[name])
+        return self.get_cursor(name).connection
 
-    @lru_cache()
     def get_cursor(self, name='default'):
-        return self.get_connection(name).cursor()
+        """
+        The same connection is used for the given name until it is released.
+        """
+        if name not in self.cursors:
+            self.cursors[name] = self.get_pool(name).acquire().cursor()
+        return self.cursors[name]
+
+    def release_connections(self, *names):
+        """
+        Returns connections with the given names (all by default) to their pools.
+        """
+        for name in names or list(self.cursors):
+            cursor = self.cursors.pop(name, None)
+            if cursor is not None:
+                self.get_pool(name).release(cursor.connection)
+
+    def close(self, *names):
+        """
+        Closes connections with the given names (all by default), including idle ones.
+        """
+        names = names or list(self.pools)
+        self.release_connections(*names)
+        for name in names:
+            self.get_pool(name).close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def check_connection(self, connection):
+        """
+        Idle connections could be closed by the server or the network.
+        """
+        try:
+            connection.cursor().execute('SELECT 1')
+            connection.rollback()
+        except self.database_error:
+            return False
+        return True
+
+    def reset_connection(self, connection):
+        """
+        Finishes the current transaction before the connection is reused.
+        """
+        connection.rollback()
 
     def connect(self, *args, **kwargs):
         """
@@ -44,8 +171,39 @@ class BaseBackend:
         return kwargs
 
     def cache_clear(self):
-        self.get_cursor.cache_clear()
-        self.get_connection.cache_clear()
+        self.release_connections()
+        self.relations = None
+        self.reverse_relations = None
+        self.primary_keys = {}
+
+    def map_concurrently(self, function, items, workers, connect):
+        """
+        Calls ``function(connection, item)`` for every item in a pool of ``workers`` threads and yields results in the
+        order of items. Every thread has its own connection, which is taken by ``connect`` from the pool of default
+        connections and returned there afterwards.
+        """
+        local = threading.local()
+        connections = []
+
+        def call(item):
+            if not hasattr(local, 'connection'):
+                local.connection = connect()
+                connections.append(local.connection)
+            return function(local.connection, item)
+
+        try:
+            with ThreadPoolExecutor(workers) as executor:
+                futures = [executor.submit(call, item) for item in items]
+                try:
+                    for future in futures:
+                        yield future.result()
+                finally:
+                    # Items, that are not started yet, are skipped if one of them failed
+                    for future in futures:
+                        future.cancel()
+        finally:
+            for connection in connections:
+                self.get_pool().release(connection)
 
     # Low-level commands executors
 
@@ -55,9 +213,18 @@ class BaseBackend:
         """
         raise NotImplementedError
 
-    def run(self, sql, params=None, using='default'):
+    def execute(self, sql, params=None, using='default'):
+        """
+        Executes the given SQL and returns the cursor.
+        """
         cursor = self.get_cursor(using)
+        start = time.perf_counter()
         cursor.execute(sql, params)
+        self.stats.add_query(sql, time.perf_counter() - start)
+        return cursor
+
+    def run(self, sql, params=None, using='default'):
+        cursor = self.execute(sql, params, using)
         try:
             return cursor.fetchall()
         except Exception as exc:
@@ -75,48 +242,364 @@ class BaseBackend:
         yield
         self.run('COMMIT')
 
+    def rollback(self):
+        self.run('ROLLBACK')
+
     # Dumping the data
 
-    def dump(self, filename, full_tables=(), partial_tables=None):
+    def dump(self, filename, full_tables=(), partial_tables=None, workers=1, materialize=False, stats=None,
+             format='csv', compression='deflate', compression_level=None, watermarks=None, base=None, cache=None,
+             sequences='all', budget=None):
         """
         Creates a dump, which could be used to restore the database.
+        Returns ``Stats`` instance with timings of all phases and statistics of every table.
+
+        If ``workers`` is more than one, then tables are exported concurrently via separate connections.
+        If ``materialize`` is True, then primary keys of selected rows are stored in temporary tables.
+        ``stats`` could be given to track the progress via its callback.
+        ``format`` is the format of data files, it is stored in the archive manifest.
+        ``compression`` is one of ``stored``, ``deflate``, ``bzip2``, ``lzma``, ``zstd`` or ``lz4``.
+        The last two require extra packages to be installed.
+
+        ``watermarks`` is a mapping of table names to columns, which values grow when rows are added or changed -
+        ``updated_at`` timestamps or monotonic primary keys. Their maximal values are stored in the manifest.
+        If ``base`` archive is given, then an incremental dump is created - only rows with watermarks not lower than
+        ones from the base archive are exported, together with primary keys of all selected rows to detect deleted
+        ones. Tables without watermarks are exported completely. The schema is not dumped.
+
+        ``cache`` is a ``TableCache`` instance. Data files of completely dumped tables are taken from it if the tables
+        were not changed since they were cached.
+
+        ``sequences`` selects sequences, which states are dumped (PostgreSQL only): ``all`` sequences in the database,
+        ones owned by ``full_tables`` or by all ``dumped`` tables, including partial ones.
+
+        Values of ``partial_tables`` are SQL queries or ``Sample`` instances.
+
+        ``budget`` is a ``Budget`` instance, that limits selected rows and sizes of data files. ``BudgetExceeded`` is
+        raised before exporting if estimates are over the budget or as soon as the budget is exceeded during exporting.
+        """
+        if workers > 1 and materialize:
+            raise ValueError('Temporary tables are not visible to worker connections')
+        self.set_data_format(format)
+        self.set_sequences(sequences)
+        self.compression = get_compression(compression, compression_level)
+        partial_tables = self.get_partial_tables(partial_tables or {})
+        self.stats = stats = stats or Stats()
+        self.watermarks = {}
+        self.incremental = base is not None
+        self.cache = cache
+        self.budget = budget
+        self.related_foreign_keys = {}
+        self.budget_estimates = {}
+        if budget is not None:
+            budget.reset()
+        self.dump_options = {
+            'full_tables': list(full_tables),
+            'partial_tables': dict(partial_tables),
+            'workers': workers,
+            'materialize': materialize,
+            'compression_level': compression_level,
+            'sequences': sequences,
+        }
+        try:
+            with self.compression.open_archive(filename) as file:
+                with stats.phase('initial_setup'):
+                    if self.incremental:
+                        self.write_incremental_setup(file)
+                    else:
+                        self.write_initial_setup(file)
+                # Selected tables are checked before related rows are selected, materialization could be expensive.
+                # Incremental dumps select only changed rows, they are known after watermarks are applied
+                if not self.incremental:
+                    self.check_budget(full_tables, partial_tables)
+                with stats.phase('related_data'):
+                    materialized = self.add_related_data(full_tables, partial_tables, materialize)
+                if workers > 1 and materialized:
+                    raise ValueError(
+                        'Tables referencing each other are stored in temporary tables, which are not visible to '
+                        'worker connections: {0}'.format(', '.join(materialized))
+                    )
+                if watermarks or self.incremental:
+                    with stats.phase('watermarks'):
+                        partial_tables = self.apply_watermarks(
+                            file, full_tables, partial_tables, watermarks or {}, base
+                        )
+                    full_tables = ()
+                self.check_budget(full_tables, partial_tables)
+                with stats.phase('data'):
+                    if workers > 1:
+                        self.write_tables_concurrently(file, full_tables, partial_tables, workers)
+                    else:
+                        self.write_full_tables(file, full_tables)
+                        self.write_partial_tables(file, partial_tables)
+                    self.finish_initial_setup(file)
+                self.write_manifest(file)
+        except BudgetExceeded as exc:
+            exc.paths = self.get_selection_paths(exc.table_name)
+            raise
+        finally:
+            self.discard_initial_setup()
+            # Nothing was changed, but the next dump should not reuse the snapshot of this transaction
+            self.rollback()
+        return stats
+
+    def set_data_format(self, format):
+        if format not in self.data_formats:
+            raise ValueError(
+                'Unsupported data format: {0}. Available formats: {1}'.format(
+                    format, ', '.join(sorted(self.data_formats))
+                )
+            )
+        self.data_format = format
+
+    def set_sequences(self, sequences):
+        if sequences not in self.sequences_options:
+            raise ValueError(
+                'Unsupported sequences option: {0}. Available options: {1}'.format(
+                    sequences, ', '.join(self.sequences_options)
+                )
+            )
+        self.sequences = sequences
+
+    def get_partial_tables(self, partial_tables):
+        """
+        Replaces samples with SQL queries.
+        """
+        return {
+            table_name: self.get_sample_sql(table_name, sql) if isinstance(sql, Sample) else sql
+            for table_name, sql in partial_tables.items()
+        }
+
+    def get_sample_sql(self, table_name, sample):
+        if sample.by:
+            return self.get_stratified_sample_sql(table_name, sample)
+        return self.get_table_sample_sql(table_name, sample)
+
+    def get_table_sample_sql(self, table_name, sample):
+        raise NotImplementedError
+
+    def get_stratified_sample_sql(self, table_name, sample):
+        """
+        Rows of every group are numbered in random order via window functions, first ``percent`` of them are selected.
+        Rows are identified by the ``row_id_column`` of the backend.
         """
-        partial_tables = partial_tables or {}
-        with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as file:
-            self.write_initial_setup(file)
-            self.add_related_data(full_tables, partial_tables)
-            self.write_full_tables(file, full_tables)
-            self.write_partial_tables(file, partial_tables)
+        return '''
+            SELECT
+                *
+            FROM {table_name}
+            WHERE {row_id} IN (
+                SELECT {row_id} FROM (
+                    SELECT
+                        {row_id},
+                        row_number() OVER (PARTITION BY {by} ORDER BY {order}) AS xdump_number,
+                        count(*) OVER (PARTITION BY {by}) AS xdump_count
+                    FROM {table_name}
+                ) T
+                WHERE (xdump_number - 1) * 100 < xdump_count * {percent}
+            )'''.format(
+            table_name=table_name,
+            row_id=self.row_id_column,
+            by=', '.join(sample.by),
+            order=self.get_random_expression(sample.seed),
+            percent=sample.percent,
+        )
 
-    def add_related_data(self, full_tables, partial_tables):
+    def get_random_expression(self, seed=None):
+        """
+        Random value for every row. The same seed produces the same values for the unchanged table.
+        """
+        raise NotImplementedError
+
+    def add_related_data(self, full_tables, partial_tables, materialize=False):
         """
         Updates selects for partial tables to grab all objects, that are referenced by full / partial tables.
+        Tables are processed in the order of their dependencies, so every table is processed only once.
+        Tables, that reference each other, are processed together via temporary tables.
+        Returns names of tables, which selected rows are stored in temporary tables.
+        """
+        materialized = []
+        for component in self.get_dependency_components(full_tables):
+            if materialize or len(component) > 1:
+                materialized.extend(self.materialize_component(component, full_tables, partial_tables))
+            else:
+                self.update_partial_table(component[0], full_tables, partial_tables)
+        return materialized
+
+    def get_dependency_components(self, full_tables):
+        """
+        Strongly connected components of the foreign keys graph in the order of their dependencies - every table goes
+        after all tables, that reference it. Tables from ``full_tables`` are selected completely and are excluded.
         """
-        for table in self.tables:
-            self.update_partial_tables(table, full_tables, partial_tables)
+        dependencies = {
+            table: {
+                foreign_key['table_name'] for foreign_key in self.get_referencing_foreign_keys(table)
+                if foreign_key['table_name'] not in full_tables
+            }
+            for table in self.tables
+            if table not in full_tables
+        }
+        return strongly_connected_components(dependencies)
 
-    def update_partial_tables(self, table, full_tables, partial_tables):
-        self.update_recursive_relations(table, full_tables, partial_tables)
-        self.update_non_recursive_relations(table, full_tables, partial_tables)
+    def get_selection_sources(self, table, component, full_tables, partial_tables):
+        """
+        Queries, that select rows of the given table, referenced from tables outside of the given component.
+        """
+        sources = [partial_tables[table]] if table in partial_tables else []
+        for foreign_key in self.get_referencing_foreign_keys(table):
+            if foreign_key['table_name'] not in component:
+                sql = self.get_related_data_sql(foreign_key, full_tables, partial_tables)
+                if sql:
+                    sources.append(sql)
+                    self.related_foreign_keys.setdefault(table, []).append(foreign_key)
+        return sources
 
-    def update_recursive_relations(self, table, full_tables, partial_tables):
-        for foreign_key in self.get_foreign_keys(table, full_tables, recursive=True):
-            if table in partial_tables:
-                partial_tables[table] = RECURSIVE_QUERY_TEMPLATE.format(
-                    source=partial_tables[table], target=table, **foreign_key
+    def get_selection_paths(self, table):
+        """
+        Chains of foreign keys, via which rows of the given table are selected, e.g.
+        ``groups <- employees.group_id <- tickets.author_id``. Only the first referencing table is followed further.
+        """
+        paths = []
+        for foreign_key in self.related_foreign_keys.get(table, ()):
+            path, seen = [table], {table}
+            while foreign_key is not None and foreign_key['table_name'] not in seen:
+                path.append('{table_name}.{column_name}'.format(**foreign_key))
+                seen.add(foreign_key['table_name'])
+                foreign_key = next(iter(self.related_foreign_keys.get(foreign_key['table_name'], ())), None)
+            paths.append(' <- '.join(path))
+        return paths
+
+    def update_partial_table(self, table, full_tables, partial_tables):
+        sources = self.get_selection_sources(table, [table], full_tables, partial_tables)
+        if not sources:
+            return
+        if len(sources) == 1:
+            sql = sources[0]
+        else:
+            sql = ' UNION '.join('SELECT * FROM ({0}) S'.format(source) for source in sources)
+        recursive_foreign_keys = self.get_foreign_keys(table, full_tables, recursive=True)
+        if recursive_foreign_keys:
+            sql = RECURSIVE_QUERY_TEMPLATE.format(
+                source=sql,
+                table_name=table,
+                condition=' OR '.join(
+                    'recursive_cte.{column_name} = T.{foreign_column_name}'.format(**foreign_key)
+                    for foreign_key in recursive_foreign_keys
                 )
+            )
+        partial_tables[table] = sql
 
-    def update_non_recursive_relations(self, table, full_tables, partial_tables):
-        for foreign_key in self.get_foreign_keys(table, full_tables):
-            sql = self.get_related_data_sql(foreign_key, full_tables, partial_tables)
-            if sql:
-                foreign_table = foreign_key['foreign_table_name']
-                if foreign_table in partial_tables:
-                    partial_tables[foreign_table] += 'UNION ' + sql
-                else:
-                    partial_tables[foreign_table] = sql
-                # Now we select more than before for given table, so we have to do check related data for it.
-                self.update_partial_tables(foreign_table, full_tables, partial_tables)
+    def materialize_component(self, component, full_tables, partial_tables):
+        """
+        Stores primary keys of selected rows of tables from the given component in temporary tables, together with
+        columns of foreign keys to other tables of the component. Keys of referenced rows are added until no new rows
+        appear, every round follows only rows, that were added since the previous round for the same table.
+        Only tables, that are reached by the selection, get temporary tables.
+        """
+        internal_foreign_keys = {
+            table: [
+                foreign_key for foreign_key in self.get_relations().get(table, ())
+                if foreign_key['foreign_table_name'] in component
+            ]
+            for table in component
+        }
+        columns = {}
+        temporary_tables = {}
+        for table in component:
+            sources = self.get_selection_sources(table, component, full_tables, partial_tables)
+            if sources:
+                columns[table] = self.get_materialized_columns(table, internal_foreign_keys[table])
+                temporary_tables[table] = self.create_materialized_table(
+                    table, columns[table], internal_foreign_keys[table], sources
+                )
+        # Rows are numbered by the round, that added them. Rows up to ``followed[table]`` are already followed
+        followed = dict.fromkeys(temporary_tables, -1)
+        step = 0
+        worklist = list(temporary_tables)
+        while worklist:
+            table = worklist.pop(0)
+            previous, followed[table] = followed[table], step
+            for foreign_key in internal_foreign_keys[table]:
+                target = foreign_key['foreign_table_name']
+                if target not in temporary_tables:
+                    columns[target] = self.get_materialized_columns(target, internal_foreign_keys[target])
+                    temporary_tables[target] = self.create_materialized_table(
+                        target, columns[target], internal_foreign_keys[target], []
+                    )
+                    followed[target] = -1
+                step += 1
+                cursor = self.execute(self.get_related_insert_sql(
+                    target, columns[target], temporary_tables[table], temporary_tables[target], previous, step,
+                    foreign_key
+                ))
+                if cursor.rowcount > 0 and target not in worklist:
+                    worklist.append(target)
+        materialized = []
+        for table in component:
+            temporary_table = temporary_tables.get(table)
+            if temporary_table is None:
+                continue
+            if table in partial_tables or self.run('SELECT 1 FROM {0} LIMIT 1'.format(temporary_table)):
+                self.run('ANALYZE {0}'.format(temporary_table))
+                partial_tables[table] = self.get_materialized_sql(table, columns[table], temporary_table)
+                materialized.append(table)
+        return materialized
+
+    def get_materialized_columns(self, table, foreign_keys):
+        """
+        Primary key columns and columns of the given foreign keys. Rows of tables without primary keys are stored
+        completely.
+        """
+        primary_key = self.get_cached_primary_key(table)
+        if not primary_key:
+            return [column[0] for column in self.execute('SELECT * FROM {0} WHERE 1 = 0'.format(table)).description]
+        foreign_key_columns = {foreign_key['column_name'] for foreign_key in foreign_keys} - set(primary_key)
+        return primary_key + sorted(foreign_key_columns)
+
+    def create_materialized_table(self, table, columns, foreign_keys, sources):
+        """
+        Temporary table with the given columns of the selected rows and the ``xdump_step`` column with the round, that
+        added the row. Primary keys and columns of the given foreign keys are indexed.
+        """
+        temporary_table = self.get_temporary_table_name(table)
+        columns_sql = ', '.join(columns)
+        if sources:
+            sql = ' UNION '.join('SELECT {0} FROM ({1}) S'.format(columns_sql, source) for source in sources)
+        else:
+            sql = 'SELECT {0} FROM {1} WHERE 1 = 0'.format(columns_sql, table)
+        self.run('CREATE TEMPORARY TABLE {0} AS SELECT S.*, 0 AS xdump_step FROM ({1}) S'.format(temporary_table, sql))
+        primary_key = self.get_cached_primary_key(table)
+        if primary_key:
+            self.run('CREATE UNIQUE INDEX {0}_pkey ON {0} ({1})'.format(temporary_table, ', '.join(primary_key)))
+        for column in sorted({foreign_key['column_name'] for foreign_key in foreign_keys} - set(primary_key)):
+            self.run('CREATE INDEX {0}_{1} ON {0} ({1})'.format(temporary_table, column))
+        self.run('CREATE INDEX {0}_xdump_step ON {0} (xdump_step)'.format(temporary_table))
+        return temporary_table
+
+    def get_related_insert_sql(self, table, columns, source, target, followed, step, foreign_key):
+        """
+        Adds keys of rows, that are referenced by rows of ``source`` added after the ``followed`` round.
+        Rows are compared by the primary key if the table has one and completely otherwise.
+        """
+        primary_key = self.get_cached_primary_key(table)
+        if primary_key:
+            template = RELATED_INSERT_TEMPLATE
+            condition = ' AND '.join('X.{0} = T.{0}'.format(column) for column in primary_key)
+        else:
+            template = RELATED_ROWS_INSERT_TEMPLATE
+            condition = None
+        return template.format(
+            source=source, target=target, columns=', '.join(columns), followed=followed, step=step,
+            condition=condition, **foreign_key
+        )
+
+    def get_materialized_sql(self, table, columns, temporary_table):
+        primary_key = ', '.join(self.get_cached_primary_key(table))
+        if not primary_key:
+            return 'SELECT {0} FROM {1}'.format(', '.join(columns), temporary_table)
+        return 'SELECT * FROM {0} WHERE ({1}) IN (SELECT {1} FROM {2})'.format(table, primary_key, temporary_table)
+
+    def get_temporary_table_name(self, table):
+        return 'xdump_{0}'.format(table)
 
     @property
     def tables(self):
@@ -126,12 +609,48 @@ class BaseBackend:
         for result in self.run(self.tables_sql):
             yield result['table_name']
 
+    def get_relations(self):
+        """
+        Graph of all foreign keys in the database - a mapping of table names to foreign keys in these tables.
+        It is loaded once and reused by all following dumps until ``cache_clear``.
+        """
+        if self.relations is None:
+            relations = defaultdict(list)
+            for foreign_key in self.get_all_foreign_keys():
+                relations[foreign_key['table_name']].append(foreign_key)
+            self.relations = relations
+        return self.relations
+
+    def get_reverse_relations(self):
+        """
+        A mapping of table names to foreign keys, that reference these tables.
+        """
+        if self.reverse_relations is None:
+            relations = defaultdict(list)
+            for foreign_keys in self.get_relations().values():
+                for foreign_key in foreign_keys:
+                    relations[foreign_key['foreign_table_name']].append(foreign_key)
+            self.reverse_relations = relations
+        return self.reverse_relations
+
+    def get_referencing_foreign_keys(self, table):
+        return self.get_reverse_relations().get(table, ())
+
+    def get_all_foreign_keys(self):
+        """
+        Loads all foreign keys in the database.
+        """
+        return [dict(foreign_key) for foreign_key in self.run(self.relations_sql)]
+
     def get_foreign_keys(self, table, full_tables=(), recursive=False):
         """
         Looks for foreign keys in the given table. Excluding ones, that will be dumped in ``full_tables``.
         """
-        query = self.recursive_relations_query if recursive else self.non_recursive_relations_query
-        return self.run(query, {'table_name': table, 'full_tables': list(full_tables)})
+        return [
+            foreign_key for foreign_key in self.get_relations().get(table, ())
+            if foreign_key['foreign_table_name'] not in full_tables and
+            (foreign_key['foreign_table_name'] == table) is recursive
+        ]
 
     def get_related_data_sql(self, foreign_key, full_tables, partial_tables):
         """
@@ -152,9 +671,59 @@ class BaseBackend:
                 SELECT {column_name} FROM {source}
             )'''.format(source=source, **foreign_key)
 
+    def check_budget(self, full_tables, partial_tables):
+        """
+        Fails before exporting if selections are estimated to exceed the budget.
+        Queries, that were estimated by previous checks of the same dump, are not estimated again.
+        """
+        if self.budget is None or self.budget.estimate is None:
+            return
+        queries = OrderedDict((table_name, self.get_full_table_sql(table_name)) for table_name in full_tables)
+        queries.update(partial_tables)
+        with self.stats.phase('budget'):
+            estimates = OrderedDict()
+            for table_name, sql in queries.items():
+                if (table_name, sql) not in self.budget_estimates:
+                    self.budget_estimates[table_name, sql] = self.estimate_selection(sql)
+                estimates[table_name] = self.budget_estimates[table_name, sql]
+            self.budget.check_estimates(estimates)
+
+    def estimate_selection(self, sql):
+        """
+        The number of rows, selected by the given query, and their size in bytes if it is known.
+        """
+        return self.run('SELECT COUNT(*) AS count FROM ({0}) T'.format(sql))[0]['count'], None
+
+    def spend_budget(self, table):
+        """
+        Sizes are spent while the data is written, rows are known after the whole table is exported.
+        """
+        if self.budget is not None:
+            self.budget.spend(table.name, rows=table.rows or 0, size=table.size if table.cached else 0)
+
+    def get_budget_writer(self, fd, table_name):
+        if self.budget is None:
+            return fd
+        return BudgetWriter(fd, self.budget, table_name)
+
     def write_initial_setup(self, file):
         self.write_schema(file)
 
+    def write_incremental_setup(self, file):
+        """
+        Writes files, that should be loaded after the data of an incremental dump.
+        """
+
+    def finish_initial_setup(self, file):
+        """
+        Writes setup files, that are produced in the background while the data is exported.
+        """
+
+    def discard_initial_setup(self):
+        """
+        Stops producing setup files in the background if the dump failed before they were written.
+        """
+
     def write_schema(self, file):
         """
         Writes a DB schema, functions, etc to the archive.
@@ -167,17 +736,304 @@ class BaseBackend:
         Writes a complete tables dump to the archive.
         """
         for table_name in tables:
-            self.write_data_file(file, table_name, 'SELECT * FROM {0}'.format(table_name))
+            self.write_data_file(file, table_name, self.get_full_table_sql(table_name))
+
+    def get_full_table_sql(self, table_name):
+        return 'SELECT * FROM {0}'.format(table_name)
 
     def write_partial_tables(self, file, config):
         for table_name, sql in config.items():
             self.write_data_file(file, table_name, sql)
 
+    def get_data_filename(self, table_name):
+        return '{0}{1}{2}'.format(self.data_dir, table_name, self.data_formats[self.data_format])
+
+    def get_keys_filename(self, table_name):
+        return '{0}{1}{2}'.format(self.keys_dir, table_name, self.data_formats[self.data_format])
+
+    # Incremental dumps
+
+    def apply_watermarks(self, file, full_tables, partial_tables, watermarks, base=None):
+        """
+        Records current values of watermarks and restricts selections of tables to rows, that were added or changed
+        since the ``base`` dump. Primary keys of all selected rows of these tables are written to the archive.
+        Watermarks are supported only for tables, that are dumped completely.
+        Returns an ordered mapping of all dumped tables to their queries.
+        """
+        queries = OrderedDict((table_name, self.get_full_table_sql(table_name)) for table_name in full_tables)
+        queries.update(partial_tables)
+        previous_watermarks = self.read_base_watermarks(base) if base is not None else {}
+        for table_name, column in watermarks.items():
+            if table_name not in queries:
+                raise ValueError('Table with a watermark is not dumped: {0}'.format(table_name))
+            # Rows of partial tables could be selected later without changing their watermarks
+            if table_name not in full_tables:
+                raise ValueError('Table with a watermark is not dumped completely: {0}'.format(table_name))
+            primary_key = self.get_cached_primary_key(table_name)
+            if not primary_key:
+                raise ValueError('Table with a watermark has no primary key: {0}'.format(table_name))
+            sql = queries[table_name]
+            self.watermarks[table_name] = {'column': column, 'value': self.get_watermark(table_name, sql, column)}
+            previous = previous_watermarks.get(table_name, {})
+            # Otherwise all rows are exported and the table is replaced completely on loading
+            if previous.get('column') == column and previous.get('value') is not None:
+                keys_sql = 'SELECT {0} FROM ({1}) T'.format(', '.join(primary_key), sql)
+                self.export_to_archive(file, self.get_keys_filename(table_name), keys_sql)
+                queries[table_name] = self.get_changed_rows_sql(table_name, sql, column, previous['value'])
+        return queries
+
+    def read_base_watermarks(self, base):
+        with zipfile.ZipFile(base) as archive:
+            return self.read_manifest(archive).get('watermarks', {})
+
+    def get_watermark(self, table_name, sql, column):
+        """
+        The current value of the watermark. It is stored in the manifest and should be JSON serializable.
+        """
+        return self.run(self.watermark_sql.format(sql=sql, column=column))[0]['value']
+
+    def get_changed_rows_sql(self, table_name, sql, column, value):
+        """
+        Selects rows with the watermark not lower than the given one.
+        The comparison is not strict - rows, that were changed at the moment of the previous dump, are exported again.
+        """
+        return 'SELECT * FROM ({0}) T WHERE T.{1} >= {2}'.format(sql, column, quote_value(value))
+
+    def get_primary_key(self, table_name):
+        """
+        Names of primary key columns of the given table.
+        """
+        raise NotImplementedError
+
+    def get_cached_primary_key(self, table_name):
+        """
+        Primary key of the given table, that is loaded once and reused by all following dumps until ``cache_clear``.
+        """
+        if table_name not in self.primary_keys:
+            self.primary_keys[table_name] = self.get_primary_key(table_name)
+        return self.primary_keys[table_name]
+
+    def get_manifest(self):
+        """
+        Describes the dump, that is required to load it properly.
+        Data files are listed in the order of foreign key dependencies with their row counts, sizes and checksums, so
+        loaders could plan the work and verify the archive.
+        """
+        manifest = {
+            'format': self.data_format,
+            'compression': self.compression.name,
+            'server_version': self.get_server_version(),
+            'options': self.dump_options,
+            'tables': [
+                {
+                    'name': table.name,
+                    'filename': self.get_data_filename(table.name),
+                    'rows': table.rows,
+                    'size': table.size,
+                    'compressed_size': table.compressed_size,
+                    'checksum': table.checksum,
+                    'references': self.get_referenced_tables(table.name),
+                }
+                for table in self.get_tables_order(self.stats.tables.values(), key=attrgetter('name'))
+            ],
+        }
+        if self.watermarks:
+            manifest['watermarks'] = self.watermarks
+        if self.incremental:
+            manifest['incremental'] = True
+        return manifest
+
+    def get_server_version(self):
+        raise NotImplementedError
+
+    def get_referenced_tables(self, table_name):
+        """
+        Tables, that are referenced by foreign keys of the given table. Their data should be loaded before it.
+        """
+        return sorted(
+            {
+                foreign_key['foreign_table_name'] for foreign_key in self.get_relations().get(table_name, ())
+                if foreign_key['foreign_table_name'] != table_name
+            }
+        )
+
+    def get_tables_order(self, items, key=None):
+        """
+        Sorts the given tables in the order of their foreign key dependencies - referenced tables go first.
+        Unknown tables go last.
+        """
+        components = reversed(self.get_dependency_components(()))
+        positions = {table: position for position, table in enumerate(chain.from_iterable(components))}
+        key = key or (lambda item: item)
+        return sorted(items, key=lambda item: positions.get(key(item), len(positions)))
+
+    def write_manifest(self, file):
+        file.writestr(self.manifest_filename, json.dumps(self.get_manifest(), indent=2, sort_keys=True))
+
+    def read_manifest(self, archive):
+        """
+        Archives made by previous versions have no manifest.
+        """
+        if self.manifest_filename not in archive.namelist():
+            return {}
+        return json.loads(archive.read(self.manifest_filename).decode())
+
+    def is_incremental(self, filename):
+        """
+        Incremental dumps are loaded on top of the database, that is restored from their base dumps.
+        """
+        with zipfile.ZipFile(filename) as archive:
+            return self.read_manifest(archive).get('incremental', False)
+
     def write_data_file(self, file, table_name, sql):
-        data = self.export_to_csv(sql)
-        file.writestr('{0}{1}.csv'.format(self.data_dir, table_name), data)
+        """
+        Streams the result of the given sql directly to the archive member without buffering it in memory.
+        The data is compressed in a separate thread, while the next chunk is fetched from the database.
+        """
+        filename = self.get_data_filename(table_name)
+        key = self.get_cache_key(table_name, sql)
+        with self.stats.table(table_name, sql) as table:
+            if key is not None and self.copy_from_cache(file, table, key):
+                self.spend_budget(table)
+                return
+            rows, size, table.checksum = self.export_to_archive(file, filename, sql, table_name)
+            table.set_rows(rows)
+            table.set_sizes(file.getinfo(filename), size)
+            self.spend_budget(table)
+            if key is not None:
+                self.store_in_cache(file, table, key)
+
+    def export_to_archive(self, file, filename, sql, table_name=None):
+        """
+        Exports the result of the given sql to the archive member.
+        Returns the number of exported rows, the uncompressed size if the data is compressed before writing and the
+        checksum of the data. Data of ``table_name`` is counted against the budget.
+        """
+        with self.compression.open_data_member(file, filename) as fd, HashingWriter(fd) as hashing:
+            with pipelined(hashing) as output:
+                if table_name is not None:
+                    output = self.get_budget_writer(output, table_name)
+                rows = self.export_to_file(sql, output, format=self.data_format)
+        return rows, getattr(fd, 'uncompressed_size', None), hashing.checksum
+
+    def write_tables_concurrently(self, file, full_tables, partial_tables, workers):
+        """
+        Exports tables in parallel via ``workers`` connections, which share the snapshot of the main transaction.
+        Only one archive member could be written at a time, therefore every table is compressed by its worker into a
+        temporary archive and then its compressed data is copied to the resulting archive as is.
+        """
+        snapshot = self.export_snapshot()
+        queries = [(table_name, self.get_full_table_sql(table_name)) for table_name in full_tables]
+        queries.extend(partial_tables.items())
+        keys = {table_name: self.get_cache_key(table_name, sql) for table_name, sql in queries}
+        queries = self.copy_cached_tables(file, queries, keys)
+
+        def export(connection, query):
+            table = TableStats(*query)
+            filename = self.get_data_filename(table.name)
+            output = TemporaryFile()
+            with table.measure(), self.compression.open_archive(output) as archive:
+                with self.compression.open_data_member(archive, filename) as fd, HashingWriter(fd) as hashing:
+                    writer = self.get_budget_writer(hashing, table.name)
+                    table.set_rows(
+                        self.export_to_file(table.sql, writer, connection=connection, format=self.data_format)
+                    )
+            table.checksum = hashing.checksum
+            self.spend_budget(table)
+            return table, output, getattr(fd, 'uncompressed_size', None)
+
+        results = self.map_concurrently(export, queries, workers, lambda: self.connect_to_snapshot(snapshot))
+        for table, output, size in results:
+            filename = self.get_data_filename(table.name)
+            with table.measure(), output, zipfile.ZipFile(output) as archive:
+                info = copy_archive_member(archive, filename, file)
+                table.set_sizes(info, size)
+                if keys[table.name] is not None:
+                    self.store_in_cache(archive, table, keys[table.name])
+            self.stats.add_table(table)
+
+    def copy_cached_tables(self, file, queries, keys):
+        """
+        Copies cached tables to the archive and returns queries of other tables.
+        """
+        remaining = []
+        for query in queries:
+            key = keys[query[0]]
+            table = TableStats(*query)
+            with table.measure():
+                is_cached = key is not None and self.copy_from_cache(file, table, key)
+            if is_cached:
+                self.spend_budget(table)
+                self.stats.add_table(table)
+            else:
+                remaining.append(query)
+        return remaining
+
+    # Cache of data files
+
+    def get_cache_key(self, table_name, sql):
+        """
+        Only tables, that are dumped completely, are cached. Returns None if the table could not be cached.
+        """
+        if self.cache is None or sql != self.get_full_table_sql(table_name):
+            return None
+        fingerprint = self.get_table_fingerprint(table_name)
+        if fingerprint is None:
+            return None
+        return self.cache.get_key(
+            self.dbname, self.host, self.port, table_name, fingerprint, self.data_format, self.compression.name,
+            self.compression.level
+        )
+
+    def get_table_fingerprint(self, table_name):
+        """
+        A cheap value, that changes whenever the table is changed. None means, that changes could not be detected.
+        """
+        return None
+
+    def copy_from_cache(self, file, table, key):
+        """
+        Copies the cached data file of the table to the archive. Returns False if it is not cached.
+        """
+        result = self.cache.copy(key, self.get_data_filename(table.name), file)
+        if result is None:
+            return False
+        info, metadata = result
+        table.set_rows(metadata['rows'])
+        table.set_sizes(info, metadata['size'])
+        table.checksum = metadata['checksum']
+        table.cached = True
+        return True
+
+    def store_in_cache(self, archive, table, key):
+        metadata = {'rows': table.rows, 'size': table.size, 'checksum': table.checksum}
+        self.cache.store(key, archive, self.get_data_filename(table.name), metadata)
+
+    def export_snapshot(self):
+        """
+        Makes the snapshot of the current transaction available for other connections.
+        """
+        raise NotImplementedError
+
+    def connect_to_snapshot(self, snapshot):
+        """
+        Takes a connection from the pool, that sees the same data as the transaction, which exported the given snapshot.
+        """
+        raise NotImplementedError
 
     def export_to_csv(self, sql):
+        """
+        Exports the result of the given sql to CSV and returns it as bytes.
+        """
+        with BytesIO() as output:
+            self.export_to_file(sql, output)
+            return output.getvalue()
+
+    def export_to_file(self, sql, fd, connection=None, format='csv'):
+        """
+        Writes the result of the given sql in the given format to the given binary file-like object and returns the
+        number of exported rows if it is known. The default connection is used unless another one is given.
+        """
         raise NotImplementedError
 
     # Database re-creation
@@ -188,6 +1044,7 @@ class BaseBackend:
         """
         if owner is None:
             owner = self.user
+        self.close('default')
         self.drop_database(self.dbname)
         self.create_database(self.dbname, owner)
         self.cache_clear()
@@ -198,15 +1055,213 @@ class BaseBackend:
     def create_database(self, dbname, *args, **kwargs):
         raise NotImplementedError
 
+    # Template databases
+
+    def load_template(self, filename, workers=1, stats=None, max_templates=3):
+        """
+        Recreates the database as a copy of the template database, that is loaded from the given archive only once.
+        Templates are named by the hash of the archive content. Only ``max_templates`` most recently used templates
+        are kept, others are dropped.
+        Returns ``Stats`` instance, which includes statistics of loading the template if it didn't exist.
+        """
+        if self.is_incremental(filename):
+            raise ValueError('Incremental dumps could not be used as templates')
+        self.stats = stats = stats or Stats()
+        with open(filename, 'rb') as fd:
+            digest = get_checksum(fd).split(':')[1][:16]
+        template = self.template_prefix + digest
+        with stats.phase('template'):
+            if template not in self.get_templates():
+                # Parallel processes load the same archive into their own temporary databases
+                temporary = '{0}{1}_{2}'.format(self.template_loading_prefix, digest, os.getpid())
+                self.create_template(template, temporary, filename, workers, stats)
+        with stats.phase('clone'):
+            self.clone_template(template)
+        self.drop_old_templates(max_templates)
+        return stats
+
+    def create_template(self, template, temporary, filename, workers, stats):
+        """
+        Loads the archive into the temporary database, which is renamed afterwards, so incomplete templates are not
+        used if loading fails. The temporary database is dropped if another process has created the template first.
+        """
+        backend = attr.evolve(self, dbname=self.get_template_dbname(temporary))
+        # Leftovers of a failed loading
+        self.drop_template(temporary)
+        backend.create_database(backend.dbname, self.user)
+        backend.load(filename, workers=workers, stats=stats)
+        backend.close()
+        if template in self.get_templates():
+            self.drop_template(temporary)
+        else:
+            self.rename_template(temporary, template)
+
+    def drop_old_templates(self, max_templates):
+        templates = self.get_templates()
+        for template in sorted(templates, key=templates.get, reverse=True)[max_templates:]:
+            self.drop_template(template)
+
+    def get_template_dbname(self, template):
+        raise NotImplementedError
+
+    def get_templates(self):
+        """
+        A mapping of existing templates to timestamps of their last usage.
+        """
+        raise NotImplementedError
+
+    def rename_template(self, old, new):
+        raise NotImplementedError
+
+    def clone_template(self, template):
+        """
+        Recreates the database as a copy of the given template and marks the template as used.
+        """
+        raise NotImplementedError
+
+    def drop_template(self, template):
+        raise NotImplementedError
+
     # Loading the dump
 
-    def load(self, filename):
+    def load(self, filename, workers=1, stats=None, tables=None, exclude=(), lazy=False):
         """
         Loads schema, sequences and data into the database.
+        Returns ``Stats`` instance with timings of all phases and statistics of every table.
+
+        If ``workers`` is more than one, then tables are loaded concurrently via separate connections.
+        ``stats`` could be given to track the progress via its callback.
+
+        Only data of ``tables`` (all by default) without ``exclude`` is loaded, together with data of all tables, that
+        they reference. If ``lazy`` is True, then no data is loaded, tables are loaded on demand via ``ensure_loaded``.
+
+        Incremental dumps are applied to the existing database in a single transaction, ``workers`` are not used.
+        """
+        self.stats = stats = stats or Stats()
+        archive = self.open_archive(filename)
+        self.loaded_tables = set()
+        self.lazy_filename = filename if lazy else None
+        self.selected_tables = set() if lazy else self.get_selected_tables(archive, tables, exclude)
+        if self.manifest.get('incremental'):
+            with stats.phase('data'):
+                self.load_incremental(archive)
+            with stats.phase('final_setup'):
+                for filename in self.incremental_setup_files:
+                    self.run_setup_file(archive.read(filename))
+            return stats
+        with stats.phase('initial_setup'):
+            self.initial_setup(archive)
+        with stats.phase('data'):
+            if workers > 1:
+                self.load_data_concurrently(archive, workers)
+            else:
+                self.load_data(archive)
+        with stats.phase('final_setup'):
+            self.final_setup(archive, workers)
+        return stats
+
+    def ensure_loaded(self, *table_names):
+        """
+        Loads data of the given tables and all tables, that they reference, from the lazily loaded archive unless it is
+        loaded already. Referenced tables are loaded first, so foreign keys are satisfied.
+        """
+        if self.lazy_filename is None:
+            raise ValueError('No archive is loaded lazily')
+        with self.open_archive(self.lazy_filename) as archive:
+            self.selected_tables = self.get_selected_tables(archive, table_names) - self.loaded_tables
+            if self.selected_tables:
+                self.load_data(archive)
+                self.loaded_tables.update(self.selected_tables)
+
+    def get_selected_tables(self, archive, tables=None, exclude=()):
+        """
+        Names of tables, which data should be loaded - the given ones (all by default) without excluded ones, together
+        with tables, that they reference. Returns None if all tables should be loaded.
+        References are taken from the manifest. Archives made by previous versions have no references.
+        """
+        if tables is None and not exclude:
+            return None
+        available = self.get_archive_tables(archive)
+        missing = set(tables or ()) - set(available)
+        if missing:
+            raise ValueError('Tables are not in the archive: {0}'.format(', '.join(sorted(missing))))
+        references = {table['name']: table.get('references', ()) for table in self.manifest.get('tables', ())}
+        selected = set(available if tables is None else tables) - set(exclude)
+        worklist = sorted(selected)
+        while worklist:
+            table = worklist.pop()
+            for referenced_table in references.get(table, ()):
+                if referenced_table in exclude:
+                    raise ValueError(
+                        'Table {0} is referenced by {1}, therefore it could not be excluded'.format(
+                            referenced_table, table
+                        )
+                    )
+                if referenced_table not in selected:
+                    selected.add(referenced_table)
+                    worklist.append(referenced_table)
+        return selected
+
+    def get_archive_tables(self, archive):
+        return [Path(name).stem for name in self.get_archive_members(archive)]
+
+    def open_archive(self, filename):
+        """
+        Opens the archive for reading and configures the backend according to its manifest.
         """
         archive = zipfile.ZipFile(filename)
-        self.initial_setup(archive)
-        self.load_data(archive)
+        self.manifest = manifest = self.read_manifest(archive)
+        self.set_data_format(manifest.get('format', 'csv'))
+        # Compression methods, that are supported by zip natively, are detected by ``zipfile``
+        self.compression = get_compression(manifest.get('compression', 'deflate'))
+        self.selected_tables = None
+        return archive
+
+    def get_data_members(self, archive):
+        """
+        Names of data files of selected tables.
+        """
+        members = self.get_archive_members(archive)
+        if self.selected_tables is None:
+            return members
+        return [name for name in members if Path(name).stem in self.selected_tables]
+
+    def get_archive_members(self, archive):
+        """
+        Names of all data files in the archive. Tables go in the order of their foreign key dependencies if the
+        manifest lists them, archives made by previous versions are loaded in the order of their members.
+        """
+        if 'tables' in self.manifest:
+            return [table['filename'] for table in self.manifest['tables']]
+        return [name for name in archive.namelist() if name.startswith(self.data_dir)]
+
+    def verify(self, filename, checksums=False):
+        """
+        Checks, that all data files from the manifest are in the archive and have expected sizes. The data is not
+        decompressed unless ``checksums`` is True, then checksums of all data files are compared as well.
+        Raises ``ValueError`` with all found problems.
+        """
+        errors = []
+        with self.open_archive(filename) as archive:
+            namelist = set(archive.namelist())
+            for table in self.manifest.get('tables', ()):
+                if table['filename'] not in namelist:
+                    errors.append('{0}: missing'.format(table['filename']))
+                    continue
+                info = archive.getinfo(table['filename'])
+                if info.compress_size != table['compressed_size']:
+                    errors.append(
+                        '{0}: size {1} does not match {2}'.format(
+                            table['filename'], info.compress_size, table['compressed_size']
+                        )
+                    )
+                elif checksums and table['checksum']:
+                    with self.compression.read_data_member(archive, info) as fd:
+                        checksum = get_checksum(fd)
+                    if checksum != table['checksum']:
+                        errors.append('{0}: checksum does not match'.format(table['filename']))
+        if errors:
+            raise ValueError('Archive is damaged: {0}'.format('; '.join(errors)))
 
     def initial_setup(self, archive):
         """
@@ -219,20 +1274,128 @@ class BaseBackend:
     def run_setup_file(self, sql):
         return self.run(sql)
 
+    def final_setup(self, archive, workers=1):
+        """
+        Creates indexes, constraints, etc. after all data is loaded.
+        """
+        namelist = archive.namelist()
+        for filename in self.final_setup_files:
+            # Archives made by previous versions have the whole schema in the initial setup files
+            if filename in namelist:
+                sql = archive.read(filename)
+                if workers > 1:
+                    self.run_setup_file_concurrently(sql, workers)
+                else:
+                    with self.transaction():
+                        self.run_setup_file(sql)
+
+    def run_setup_file_concurrently(self, sql, workers):
+        """
+        Runs independent statements from the given setup file in parallel via ``workers`` connections.
+        """
+        raise NotImplementedError
+
     def load_data(self, archive):
         """
         Loads all data from data files inside the archive to the database.
         """
         with self.transaction():
-            for name in archive.namelist():
-                if name.startswith(self.data_dir):
-                    fd = archive.open(name)
-                    table_name = Path(name).stem
-                    self.load_data_file(table_name, fd)
+            for name in self.get_data_members(archive):
+                self.load_archive_member(archive, name)
+
+    def load_archive_member(self, archive, name, connection=None, table_name=None):
+        """
+        Loads a single data file from the archive and collects its statistics.
+        The data is loaded into ``table_name`` if it is given.
+        """
+        info = archive.getinfo(name)
+        with self.stats.table(Path(name).stem) as table, self.compression.read_data_member(archive, info) as fd:
+            table.set_rows(
+                self.load_data_file(table_name or table.name, fd, connection=connection, format=self.data_format)
+            )
+            table.set_sizes(info, getattr(fd, 'uncompressed_size', None))
+
+    def load_incremental(self, archive):
+        """
+        Applies changes from an incremental dump. Rows are deleted and inserted in arbitrary order, therefore foreign
+        keys are dropped and created again afterwards in the same transaction, which validates all rows.
+        """
+        foreign_keys = self.drop_foreign_keys()
+        self.apply_changes(archive)
+        self.create_foreign_keys(foreign_keys)
+
+    def apply_changes(self, archive):
+        namelist = archive.namelist()
+        for name in self.get_data_members(archive):
+            table_name = Path(name).stem
+            keys_filename = self.get_keys_filename(table_name)
+            if keys_filename in namelist:
+                self.apply_table_changes(archive, name, keys_filename)
+            else:
+                self.run('DELETE FROM {0}'.format(table_name))
+                self.load_archive_member(archive, name)
 
-    def load_data_file(self, table_name, fd):
+    def apply_table_changes(self, archive, name, keys_filename):
         """
-        Loads a data file into the database.
+        Deletes rows, which keys are not in the dump anymore, and replaces changed rows with their new versions.
+        """
+        table_name = Path(name).stem
+        columns = self.get_primary_key(table_name)
+        primary_key = ', '.join(columns)
+        changes = 'xdump_changes_{0}'.format(table_name)
+        keys = 'xdump_keys_{0}'.format(table_name)
+        self.run('CREATE TEMPORARY TABLE {0} AS SELECT * FROM {1} WHERE 1 = 0'.format(changes, table_name))
+        self.run('CREATE TEMPORARY TABLE {0} AS SELECT {1} FROM {2} WHERE 1 = 0'.format(keys, primary_key, table_name))
+        self.load_archive_member(archive, name, table_name=changes)
+        with self.compression.read_data_member(archive, keys_filename) as fd:
+            self.load_data_file(keys, fd, format=self.data_format)
+        # The index is built after loading and the planner should know the number of keys to choose an anti-join
+        self.run('CREATE UNIQUE INDEX {0}_pkey ON {0} ({1})'.format(keys, primary_key))
+        self.run('ANALYZE {0}'.format(keys))
+        condition = ' AND '.join('{0}.{2} = {1}.{2}'.format(keys, table_name, column) for column in columns)
+        self.run('DELETE FROM {0} WHERE NOT EXISTS (SELECT 1 FROM {1} WHERE {2})'.format(table_name, keys, condition))
+        self.run('DELETE FROM {0} WHERE ({1}) IN (SELECT {1} FROM {2})'.format(table_name, primary_key, changes))
+        self.run('INSERT INTO {0} SELECT * FROM {1}'.format(table_name, changes))
+        self.run('DROP TABLE {0}'.format(changes))
+        self.run('DROP TABLE {0}'.format(keys))
+
+    def load_data_concurrently(self, archive, workers):
+        """
+        Loads data files in parallel via ``workers`` connections, every table in its own transaction.
+        Since tables are loaded in arbitrary order, foreign keys are dropped for the time of loading and created again
+        afterwards, which validates all loaded rows.
+        """
+        foreign_keys = self.drop_foreign_keys()
+        # Other connections should see the loaded schema. The driver should know, that the transaction is finished
+        self.get_connection().commit()
+        # Data files compressed by third-party libraries have their uncompressed sizes in the manifest only
+        sizes = {table['filename']: table['size'] for table in self.manifest.get('tables', ())}
+        members = self.get_data_members(archive)
+        # The largest tables go first to keep all workers busy until the end
+        members.sort(key=lambda name: sizes.get(name, archive.getinfo(name).file_size), reverse=True)
+
+        def load(connection, name):
+            # Zip files could not be safely read from multiple threads
+            with connection, zipfile.ZipFile(archive.filename) as local_archive:
+                self.load_archive_member(local_archive, name, connection=connection)
+
+        for _ in self.map_concurrently(load, members, workers, self.get_pool().acquire):
+            pass
+        self.create_foreign_keys(foreign_keys)
+
+    def drop_foreign_keys(self):
+        """
+        Drops all foreign keys and returns data, that is required to create them again.
+        """
+        raise NotImplementedError
+
+    def create_foreign_keys(self, foreign_keys):
+        raise NotImplementedError
+
+    def load_data_file(self, table_name, fd, connection=None, format='csv'):
+        """
+        Loads a data file in the given format into the database and returns the number of loaded rows if it is known.
+        The default connection is used unless another one is given.
         """
         raise NotImplementedError
 
@@ -243,7 +1406,22 @@ WITH RECURSIVE recursive_cte AS (
   UNION
   SELECT T.*
   FROM {table_name} T
-  INNER JOIN recursive_cte ON (recursive_cte.{column_name} = T.{foreign_column_name})
+  INNER JOIN recursive_cte ON ({condition})
 )
 SELECT * FROM recursive_cte
 '''
+RELATED_INSERT_TEMPLATE = '''
+INSERT INTO {target} ({columns}, xdump_step)
+SELECT {columns}, {step} FROM {foreign_table_name} T
+WHERE {foreign_column_name} IN (SELECT {column_name} FROM {source} WHERE xdump_step > {followed})
+AND NOT EXISTS (SELECT 1 FROM {target} X WHERE {condition})
+'''
+RELATED_ROWS_INSERT_TEMPLATE = '''
+INSERT INTO {target} ({columns}, xdump_step)
+SELECT S.*, {step} FROM (
+  SELECT {columns} FROM {foreign_table_name}
+  WHERE {foreign_column_name} IN (SELECT {column_name} FROM {source} WHERE xdump_step > {followed})
+  EXCEPT
+  SELECT {columns} FROM {target}
+) S
+'''
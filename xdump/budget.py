@@ -0,0 +1,131 @@
+# coding: utf-8
+import io
+import threading
+from collections import defaultdict
+
+import attr
+
+
+class BudgetExceeded(ValueError):
+    """
+    The dump selects more rows / bytes than allowed by the budget of ``table_name`` or by the budget of the whole dump.
+    ``paths`` are chains of foreign keys, via which rows of the table are selected, e.g.
+    ``groups <- employees.group_id``.
+    """
+
+    def __init__(self, table_name, unit, value, limit, is_total=False, estimated=False):
+        super().__init__(table_name, unit, value, limit)
+        self.table_name = table_name
+        self.unit = unit
+        self.value = value
+        self.limit = limit
+        self.is_total = is_total
+        self.estimated = estimated
+        self.paths = []
+
+    def __str__(self):
+        if self.is_total:
+            message = 'Dump exceeds the budget of {0} {1} on table {2}'.format(self.limit, self.unit, self.table_name)
+        else:
+            message = 'Table {0} exceeds the budget of {1} {2}'.format(self.table_name, self.limit, self.unit)
+        message += ': {0}{1}'.format(self.value, ' (estimated)' if self.estimated else '')
+        if self.paths:
+            message += '. Rows are selected via {0}'.format(', '.join(self.paths))
+        return message
+
+
+@attr.s(frozen=True)
+class Limit:
+    """
+    Maximal number of ``rows`` and ``size`` in bytes of uncompressed data. None means no limit.
+    """
+    rows = attr.ib(default=None)
+    size = attr.ib(default=None)
+
+    def check(self, table_name, rows, size=None, is_total=False, estimated=False):
+        for unit, value, limit in (('rows', rows, self.rows), ('bytes', size, self.size)):
+            if value is not None and limit is not None and value > limit:
+                raise BudgetExceeded(table_name, unit, value, limit, is_total=is_total, estimated=estimated)
+
+
+@attr.s(cmp=False)
+class Budget:
+    """
+    Limits of the whole dump (``rows`` and ``size``) and of single tables, e.g. ``{'events': Limit(rows=10000)}``.
+
+    Selections are checked before exporting with ``estimate`` method: ``explain`` takes estimates of the query planner
+    (PostgreSQL only, other databases count rows), ``count`` counts selected rows, None skips the check. During
+    exporting sizes are checked as the data is written and rows are checked after every table.
+    A budget is spent by a single dump at a time.
+    """
+    estimate_methods = ('explain', 'count', None)
+
+    rows = attr.ib(default=None)
+    size = attr.ib(default=None)
+    tables = attr.ib(default=attr.Factory(dict))
+    estimate = attr.ib(default='explain')
+    # Rows and bytes, that are spent by every table and by the whole dump
+    spent = attr.ib(default=attr.Factory(lambda: defaultdict(lambda: [0, 0])), init=False, repr=False)
+    spent_total = attr.ib(default=attr.Factory(lambda: [0, 0]), init=False, repr=False)
+    lock = attr.ib(default=attr.Factory(threading.Lock), init=False, repr=False)
+
+    def __attrs_post_init__(self):
+        if self.estimate not in self.estimate_methods:
+            raise ValueError(
+                'Unsupported estimate method: {0}. Available methods: {1}'.format(
+                    self.estimate, ', '.join(str(method) for method in self.estimate_methods)
+                )
+            )
+
+    @property
+    def total(self):
+        return Limit(self.rows, self.size)
+
+    def get_limit(self, table_name):
+        return self.tables.get(table_name, Limit())
+
+    def reset(self):
+        with self.lock:
+            self.spent.clear()
+            self.spent_total = [0, 0]
+
+    def check_estimates(self, estimates):
+        """
+        Checks estimated rows and sizes of tables, sizes could be unknown (None).
+        """
+        rows, size = 0, 0
+        for table_name, (table_rows, table_size) in estimates.items():
+            self.get_limit(table_name).check(table_name, table_rows, table_size, estimated=True)
+            rows += table_rows
+            size = None if size is None or table_size is None else size + table_size
+            self.total.check(table_name, rows, size, is_total=True, estimated=True)
+
+    def spend(self, table_name, rows=0, size=0):
+        with self.lock:
+            for spent in (self.spent[table_name], self.spent_total):
+                spent[0] += rows
+                spent[1] += size
+            table_spent, total_spent = list(self.spent[table_name]), list(self.spent_total)
+        self.get_limit(table_name).check(table_name, *table_spent)
+        self.total.check(table_name, *total_spent, is_total=True)
+
+
+class BudgetWriter(io.RawIOBase):
+    """
+    Spends the budget of the table on everything, that is written to the underlying file.
+    The underlying file is not closed.
+    """
+
+    def __init__(self, fd, budget, table_name):
+        super().__init__()
+        self.fd = fd
+        self.budget = budget
+        self.table_name = table_name
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.budget.spend(self.table_name, size=len(data))
+        self.fd.write(data)
+        return len(data)
@@ -0,0 +1,90 @@
+# coding: utf-8
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+from pathlib import Path
+
+import attr
+
+from .utils import copy_archive_member
+
+
+@attr.s(cmp=False)
+class TableCache:
+    """
+    Local cache of compressed data files of tables, that are dumped completely.
+
+    Entries are keyed by fingerprints of tables, which change when tables are changed. Cached data files are copied to
+    new archives as is, without querying the database and compressing the data again. The least recently used entries
+    are removed when the total size of the cache exceeds ``max_size`` bytes.
+    """
+    directory = attr.ib(convert=Path)
+    max_size = attr.ib(default=None)
+    metadata_filename = 'metadata.json'
+
+    def __attrs_post_init__(self):
+        os.makedirs(str(self.directory), exist_ok=True)
+
+    def get_key(self, *parts):
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get_path(self, key):
+        return self.directory / '{0}.zip'.format(key)
+
+    def copy(self, key, filename, archive):
+        """
+        Copies the cached data file to the given archive.
+        Returns its ``ZipInfo`` instance and metadata or None if there is no such entry.
+        """
+        path = self.get_path(key)
+        try:
+            with zipfile.ZipFile(str(path)) as source:
+                metadata = json.loads(source.read(self.metadata_filename).decode())
+                info = copy_archive_member(source, filename, archive)
+        except (FileNotFoundError, KeyError, zipfile.BadZipFile):
+            return None
+        # Marks the entry as recently used
+        os.utime(str(path))
+        return info, metadata
+
+    def store(self, key, archive, filename, metadata):
+        """
+        Stores the data file from the given archive in the cache as is.
+        The entry is written to a temporary file first, so concurrent dumps never see incomplete entries.
+        """
+        fd, temporary = tempfile.mkstemp(suffix='.tmp', dir=str(self.directory))
+        try:
+            with os.fdopen(fd, 'w+b') as output, zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as target:
+                copy_archive_member(archive, filename, target)
+                target.writestr(self.metadata_filename, json.dumps(metadata))
+            os.replace(temporary, str(self.get_path(key)))
+        except Exception:
+            os.remove(temporary)
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits into ``max_size``.
+        """
+        if self.max_size is None:
+            return
+        entries = []
+        # Entries could be removed by concurrent dumps at any moment
+        for path in self.directory.glob('*.zip'):
+            try:
+                entries.append((path.stat(), path))
+            except FileNotFoundError:
+                pass
+        entries.sort(key=lambda entry: entry[0].st_mtime)
+        total_size = sum(stat.st_size for stat, _ in entries)
+        for stat, path in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total_size -= stat.st_size
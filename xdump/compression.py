@@ -0,0 +1,247 @@
+# coding: utf-8
+import io
+import sys
+import zipfile
+from contextlib import contextmanager
+
+import attr
+
+from .utils import open_archive_member
+
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+
+class CompressedWriter(io.RawIOBase):
+    """
+    Compresses everything, that is written to it, and writes the result to the underlying file.
+    The underlying file is not closed.
+    """
+
+    def __init__(self, fd, compressor):
+        super().__init__()
+        self.fd = fd
+        self.compressor = compressor
+        # Size of the uncompressed data
+        self.uncompressed_size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self.fd.write(self.compressor.compress(data))
+        self.uncompressed_size += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.fd.write(self.compressor.flush())
+        super().close()
+
+
+class DecompressedReader(io.RawIOBase):
+    """
+    Reads and decompresses the underlying file by chunks.
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, fd, decompressor):
+        super().__init__()
+        self.fd = fd
+        self.decompressor = decompressor
+        self.buffer = memoryview(b'')
+        # Size of the uncompressed data
+        self.uncompressed_size = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, target):
+        """
+        Decompressed chunks could be much larger than the target, they are consumed via a memoryview without copying
+        the rest of the chunk on every read.
+        """
+        while not self.buffer:
+            chunk = self.fd.read(self.chunk_size)
+            if not chunk:
+                return 0
+            self.buffer = memoryview(self.decompressor.decompress(chunk))
+        size = min(len(target), len(self.buffer))
+        target[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        self.uncompressed_size += size
+        return size
+
+
+@attr.s(cmp=False)
+class Compression:
+    """
+    Compression method, that is supported by the zip format natively.
+    """
+    level = attr.ib(default=None)
+    name = None
+    method = None
+    supports_level = True
+
+    def __attrs_post_init__(self):
+        if self.level is not None:
+            if not self.supports_level:
+                raise ValueError('{0} compression does not support levels'.format(self.name))
+            if sys.version_info[:2] < (3, 7):
+                raise ValueError('Compression level is supported only on Python 3.7+')
+
+    def open_archive(self, filename):
+        kwargs = {}
+        if self.level is not None:
+            kwargs['compresslevel'] = self.level
+        return zipfile.ZipFile(filename, 'w', self.method, **kwargs)
+
+    @contextmanager
+    def open_data_member(self, archive, filename):
+        """
+        Opens the archive member for writing a data file.
+        """
+        with open_archive_member(archive, filename) as fd:
+            yield fd
+
+    @contextmanager
+    def read_data_member(self, archive, name):
+        with archive.open(name) as fd:
+            yield fd
+
+
+class StoredCompression(Compression):
+    name = 'stored'
+    method = zipfile.ZIP_STORED
+    supports_level = False
+
+
+class DeflateCompression(Compression):
+    name = 'deflate'
+    method = zipfile.ZIP_DEFLATED
+
+
+class BZip2Compression(Compression):
+    name = 'bzip2'
+    method = zipfile.ZIP_BZIP2
+
+
+class LZMACompression(Compression):
+    name = 'lzma'
+    method = zipfile.ZIP_LZMA
+    supports_level = False
+
+
+class ContainerCompression(Compression):
+    """
+    Data files are compressed via a third-party library and stored in the archive without zip compression.
+    Other archive members are small and they are deflated.
+    """
+    method = zipfile.ZIP_DEFLATED
+    library = None
+    package = None
+
+    def __attrs_post_init__(self):
+        if self.library is None:
+            raise ValueError(
+                '{0} compression requires "{1}" package. Install it via "pip install xdump[{0}]"'.format(
+                    self.name, self.package
+                )
+            )
+
+    def open_archive(self, filename):
+        return zipfile.ZipFile(filename, 'w', self.method)
+
+    def get_compressor(self):
+        raise NotImplementedError
+
+    def get_decompressor(self):
+        raise NotImplementedError
+
+    @contextmanager
+    def open_data_member(self, archive, filename):
+        with open_archive_member(archive, filename, zipfile.ZIP_STORED) as fd:
+            with CompressedWriter(fd, self.get_compressor()) as writer:
+                yield writer
+
+    @contextmanager
+    def read_data_member(self, archive, name):
+        with archive.open(name) as fd, DecompressedReader(fd, self.get_decompressor()) as reader:
+            yield reader
+
+
+class ZstdCompression(ContainerCompression):
+    name = 'zstd'
+    library = zstandard
+    package = 'zstandard'
+
+    def get_compressor(self):
+        kwargs = {}
+        if self.level is not None:
+            kwargs['level'] = self.level
+        return zstandard.ZstdCompressor(**kwargs).compressobj()
+
+    def get_decompressor(self):
+        return zstandard.ZstdDecompressor().decompressobj()
+
+
+class LZ4Compressor:
+    """
+    Makes LZ4 frame compressor compatible with ``zlib`` compression objects.
+    """
+
+    def __init__(self, level):
+        self.compressor = lz4_frame.LZ4FrameCompressor(compression_level=level)
+        self.header = self.compressor.begin()
+
+    def compress(self, data):
+        output = self.header + self.compressor.compress(data)
+        self.header = b''
+        return output
+
+    def flush(self):
+        return self.header + self.compressor.flush()
+
+
+class LZ4Compression(ContainerCompression):
+    name = 'lz4'
+    library = lz4_frame
+    package = 'lz4'
+
+    def get_compressor(self):
+        return LZ4Compressor(self.level or 0)
+
+    def get_decompressor(self):
+        return lz4_frame.LZ4FrameDecompressor()
+
+
+COMPRESSIONS = {
+    compression.name: compression
+    for compression in (
+        StoredCompression,
+        DeflateCompression,
+        BZip2Compression,
+        LZMACompression,
+        ZstdCompression,
+        LZ4Compression,
+    )
+}
+
+
+def get_compression(name, level=None):
+    try:
+        compression_class = COMPRESSIONS[name]
+    except KeyError:
+        raise ValueError(
+            'Unsupported compression: {0}. Available compressions: {1}'.format(name, ', '.join(sorted(COMPRESSIONS)))
+        )
+    return compression_class(level)
@@ -0,0 +1,69 @@
+# coding: utf-8
+import threading
+from contextlib import contextmanager
+
+import attr
+
+
+def close_quietly(connection):
+    """
+    Broken connections could fail on closing as well.
+    """
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+
+@attr.s(cmp=False)
+class ConnectionPool:
+    """
+    Idle connections, that are reused instead of connecting to the database again.
+
+    ``check`` is called for an idle connection before it is given out, broken connections are closed and replaced with
+    new ones. ``reset`` is called when a connection is returned to the pool, connections, that could not be reset, are
+    closed. At most ``max_idle`` connections are kept. Connections could be acquired and released from multiple threads.
+    """
+    connect = attr.ib()
+    check = attr.ib()
+    reset = attr.ib()
+    max_idle = attr.ib(default=None)
+    idle = attr.ib(default=attr.Factory(list), init=False)
+    lock = attr.ib(default=attr.Factory(threading.Lock), init=False, repr=False)
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                connection = self.idle.pop()
+            if self.check(connection):
+                return connection
+            close_quietly(connection)
+        return self.connect()
+
+    def release(self, connection):
+        try:
+            self.reset(connection)
+        except Exception:
+            close_quietly(connection)
+            return
+        with self.lock:
+            if self.max_idle is None or len(self.idle) < self.max_idle:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            close_quietly(connection)
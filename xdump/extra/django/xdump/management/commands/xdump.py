@@ -1,9 +1,96 @@
 # coding: utf-8
+from xdump.cache import TableCache
+from xdump.compression import COMPRESSIONS
+
 from ..core import XDumpCommand
 
 
 class Command(XDumpCommand):
     help = 'Creates an SQL dump with latest data.'
 
-    def _handle(self, filename, backend):
-        backend.dump(filename, **self.get_dump_kwargs())
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            '-w', '--workers',
+            action='store',
+            dest='workers',
+            help='Number of connections to export tables in parallel.',
+            required=False,
+            type=int,
+            default=1,
+        )
+        parser.add_argument(
+            '-m', '--materialize',
+            action='store_true',
+            dest='materialize',
+            help='Store primary keys of selected rows in temporary tables.',
+            required=False,
+            default=False,
+        )
+        parser.add_argument(
+            '-f', '--format',
+            action='store',
+            dest='format',
+            help='Format of data files. Binary format is supported only by PostgreSQL.',
+            required=False,
+            choices=('csv', 'binary'),
+            default='csv',
+        )
+        parser.add_argument(
+            '-c', '--compression',
+            action='store',
+            dest='compression',
+            help='Compression of the archive. "zstd" and "lz4" require extra packages.',
+            required=False,
+            choices=sorted(COMPRESSIONS),
+            default='deflate',
+        )
+        parser.add_argument(
+            '--compression-level',
+            action='store',
+            dest='compression_level',
+            help='Compression level. The default level of the chosen compression is used if not specified.',
+            required=False,
+            type=int,
+            default=None,
+        )
+        parser.add_argument(
+            '--base',
+            action='store',
+            dest='base',
+            help='Path to the previous dump. Only rows, that were changed since it, are dumped for tables with '
+                 'watermarks.',
+            required=False,
+            default=None,
+        )
+        parser.add_argument(
+            '--cache',
+            action='store',
+            dest='cache',
+            help='Directory to cache data files of completely dumped tables, which are not changed between dumps.',
+            required=False,
+            default=None,
+        )
+        parser.add_argument(
+            '--cache-size',
+            action='store',
+            dest='cache_size',
+            help='Maximal size of the cache in bytes. The least recently used entries are removed.',
+            required=False,
+            type=int,
+            default=None,
+        )
+
+    def _handle(self, filename, backend, options):
+        return backend.dump(
+            filename,
+            workers=options['workers'],
+            materialize=options['materialize'],
+            format=options['format'],
+            compression=options['compression'],
+            compression_level=options['compression_level'],
+            base=options['base'],
+            cache=TableCache(options['cache'], options['cache_size']) if options['cache'] else None,
+            stats=self.get_stats(options),
+            **self.get_dump_kwargs()
+        )
@@ -1,10 +1,73 @@
 # coding: utf-8
+from django.core.management.base import CommandError
+
 from ..core import XDumpCommand
 
 
 class Command(XDumpCommand):
     help = 'Loads an SQL dump.'
 
-    def _handle(self, filename, backend):
-        backend.recreate_database()
-        backend.load(filename)
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            '-w', '--workers',
+            action='store',
+            dest='workers',
+            help='Number of connections to load tables in parallel.',
+            required=False,
+            type=int,
+            default=1,
+        )
+        parser.add_argument(
+            '-t', '--table',
+            action='append',
+            dest='tables',
+            help='Load data only of the given table and tables, that it references. Could be given multiple times.',
+            required=False,
+            default=None,
+        )
+        parser.add_argument(
+            '-e', '--exclude',
+            action='append',
+            dest='exclude',
+            help='Do not load data of the given table. Could be given multiple times.',
+            required=False,
+            default=None,
+        )
+        parser.add_argument(
+            '--template',
+            action='store_true',
+            dest='template',
+            help='Load the dump into a template database once and copy it on the following loads.',
+            default=False,
+        )
+        parser.add_argument(
+            '--max-templates',
+            action='store',
+            dest='max_templates',
+            help='Number of most recently used template databases to keep.',
+            required=False,
+            type=int,
+            default=3,
+        )
+
+    def _handle(self, filename, backend, options):
+        if options['template']:
+            if options['tables'] or options['exclude']:
+                raise CommandError('Template databases contain all tables, --table and --exclude are not supported')
+            return backend.load_template(
+                filename,
+                workers=options['workers'],
+                stats=self.get_stats(options),
+                max_templates=options['max_templates'],
+            )
+        # Incremental dumps are applied on top of the existing data
+        if not backend.is_incremental(filename):
+            backend.recreate_database()
+        return backend.load(
+            filename,
+            workers=options['workers'],
+            stats=self.get_stats(options),
+            tables=options['tables'],
+            exclude=options['exclude'] or (),
+        )
@@ -3,6 +3,8 @@ from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.utils.module_loading import import_string
 
+from xdump.stats import Stats
+
 
 class XDumpCommand(BaseCommand):
 
@@ -28,14 +30,65 @@ class XDumpCommand(BaseCommand):
             required=False,
             default=None,
         )
+        parser.add_argument(
+            '--stats',
+            action='store_true',
+            dest='stats',
+            help='Show timings of all phases and statistics of every table at the end.',
+            required=False,
+            default=False,
+        )
+        parser.add_argument(
+            '--progress',
+            action='store_true',
+            dest='progress',
+            help='Show phases and tables as they are processed.',
+            required=False,
+            default=False,
+        )
 
     def handle(self, filename, **options):
         backend = self.get_xdump_backend(options['alias'], options['backend'])
-        self._handle(filename, backend)
+        stats = self._handle(filename, backend, options)
+        if options['stats']:
+            self.write_stats(stats, options['verbosity'])
 
-    def _handle(self, filename, backend):
+    def _handle(self, filename, backend, options):
         raise NotImplementedError
 
+    def get_stats(self, options):
+        callback = self.write_progress if options['progress'] else None
+        return Stats(callback=callback)
+
+    def write_progress(self, event, value):
+        if event == 'phase_started':
+            self.stdout.write('Started {0}'.format(value))
+        elif event == 'table_finished':
+            self.stdout.write(self.format_table_stats(value))
+
+    def write_stats(self, stats, verbosity=1):
+        """
+        Writes timings of all phases and statistics of tables, the slowest tables go first.
+        SQL queries are shown with verbosity more than 1.
+        """
+        for name, seconds in stats.phases.items():
+            self.stdout.write('{0}: {1:.3f}s'.format(name, seconds))
+        for table in sorted(stats.tables.values(), key=lambda table: table.seconds, reverse=True):
+            self.stdout.write(self.format_table_stats(table))
+            if verbosity > 1 and table.sql:
+                self.stdout.write(table.sql)
+        self.stdout.write(
+            'Total: {0} rows, {1} bytes ({2} compressed) in {3:.3f}s'.format(
+                stats.rows, stats.size, stats.compressed_size, stats.seconds
+            )
+        )
+
+    def format_table_stats(self, table):
+        return '{0}: {1} rows, {2} bytes ({3} compressed) in {4:.3f}s{5}'.format(
+            table.name, '?' if table.rows is None else table.rows, table.size, table.compressed_size, table.seconds,
+            ' (cached)' if table.cached else ''
+        )
+
     def get_xdump_backend(self, alias='default', backend=None):
         configuration = self.get_database_configuration(alias)
         if backend is None:
@@ -63,4 +116,6 @@ class XDumpCommand(BaseCommand):
         return {
             'full_tables': settings.XDUMP['FULL_TABLES'],
             'partial_tables': settings.XDUMP['PARTIAL_TABLES'],
+            'watermarks': settings.XDUMP.get('WATERMARKS'),
+            'budget': settings.XDUMP.get('BUDGET'),
         }
@@ -1,39 +1,159 @@
 # coding: utf-8
 import os
+import re
+import shutil
 import subprocess
-from io import BytesIO
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryFile
 
 import psycopg2
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, ISOLATION_LEVEL_REPEATABLE_READ
 from psycopg2.extras import RealDictConnection
 
 from .base import BaseBackend
-from .utils import make_options
+from .utils import copy_archive_member, open_archive_member, quote_value
 
 
-SEQUENCES_SQL = "SELECT relname FROM pg_class WHERE relkind = 'S'"
-BASE_RELATIONS_QUERY = '''
+# Schema-qualified names of sequences and tables, that own them via serial or identity columns. Temporary sequences
+# of other sessions could not be read
+SEQUENCES_SQL = '''
 SELECT
-    tc.constraint_name, tc.table_name, kcu.column_name,
-    ccu.table_name AS foreign_table_name,
-    ccu.column_name AS foreign_column_name
-FROM
-    information_schema.table_constraints AS tc
-    JOIN information_schema.key_column_usage AS kcu
-      ON tc.constraint_name = kcu.constraint_name
-    JOIN information_schema.constraint_column_usage AS ccu
-      ON ccu.constraint_name = tc.constraint_name
+    quote_ident(N.nspname) || '.' || quote_ident(S.relname) AS name,
+    T.relname AS table_name
+FROM pg_class S
+    JOIN pg_namespace N ON N.oid = S.relnamespace
+    LEFT JOIN pg_depend D
+      ON D.classid = 'pg_class'::regclass AND D.objid = S.oid AND D.refclassid = 'pg_class'::regclass AND
+         D.deptype IN ('a', 'i')
+    LEFT JOIN pg_class T ON T.oid = D.refobjid
+WHERE S.relkind = 'S' AND NOT pg_is_other_temp_schema(N.oid)
+ORDER BY N.nspname, S.relname
+'''
+SEQUENCE_VALUE_SQL = 'SELECT {literal}::text AS name, last_value, is_called FROM {name}'
+RELATIONS_SQL = '''
+SELECT
+    C.constraint_name,
+    referencing.relname AS table_name,
+    referencing_column.attname AS column_name,
+    referenced.relname AS foreign_table_name,
+    referenced_column.attname AS foreign_column_name
+FROM (
+    SELECT
+        conname AS constraint_name,
+        conrelid,
+        confrelid,
+        unnest(conkey) AS conkey,
+        unnest(confkey) AS confkey
+    FROM pg_constraint
+    WHERE contype = 'f'
+) C
+    JOIN pg_class referencing ON referencing.oid = C.conrelid
+    JOIN pg_attribute referencing_column
+      ON referencing_column.attrelid = C.conrelid AND referencing_column.attnum = C.conkey
+    JOIN pg_class referenced ON referenced.oid = C.confrelid
+    JOIN pg_attribute referenced_column
+      ON referenced_column.attrelid = C.confrelid AND referenced_column.attnum = C.confkey
+ORDER BY referencing.relname, C.constraint_name
+'''
+FOREIGN_KEYS_SQL = '''
+SELECT
+    conrelid::regclass AS table_name,
+    quote_ident(conname) AS constraint_name,
+    pg_get_constraintdef(oid) AS definition
+FROM pg_constraint
 WHERE
-    constraint_type = 'FOREIGN KEY' AND
-    tc.table_name {operator} ccu.table_name AND
-    tc.table_name = %(table_name)s AND
-    NOT(ccu.table_name = ANY(%(full_tables)s))
+    contype = 'f' AND
+    connamespace NOT IN (
+        SELECT oid FROM pg_namespace WHERE nspname IN ('pg_catalog', 'information_schema')
+    )
+'''
+PRIMARY_KEY_SQL = '''
+SELECT attname AS column_name
+FROM pg_index
+    JOIN pg_attribute ON attrelid = indrelid AND attnum = ANY(indkey)
+WHERE indrelid = %s::regclass AND indisprimary
+ORDER BY attnum
+'''
+# Columns, including dropped ones, change without rewriting the table, e.g. on ``ADD COLUMN ... DEFAULT``. The file
+# node changes when the table is truncated or rewritten. Statistics counters of inserted, updated and deleted rows are
+# reported by other sessions after their transactions end, with a small delay
+TABLE_FINGERPRINT_SQL = '''
+SELECT
+    N.nspname AS schema,
+    C.relfilenode,
+    (
+        SELECT array_agg(
+            concat_ws(' ', A.attname, format_type(A.atttypid, A.atttypmod), CASE WHEN A.attisdropped THEN 'dropped' END)
+            ORDER BY A.attnum
+        )
+        FROM pg_attribute A
+        WHERE A.attrelid = C.oid AND A.attnum > 0
+    ) AS columns,
+    S.n_tup_ins,
+    S.n_tup_upd,
+    S.n_tup_del,
+    D.stats_reset::text AS stats_reset,
+    current_setting('track_counts') = 'on' AS track_counts
+FROM pg_class C
+    JOIN pg_namespace N ON N.oid = C.relnamespace
+    JOIN pg_stat_user_tables S ON S.relid = C.oid
+    JOIN pg_stat_database D ON D.datname = current_database()
+WHERE C.oid = %s::regclass
+'''
+# Without statistics changes are detected by scanning the table within the snapshot of the dump. Rows of transactions,
+# that are still running, could get lower ``xmin`` values than the maximal one, then they could be missed
+TABLE_SCAN_FINGERPRINT_SQL = '''
+SELECT
+    COUNT(*) AS count,
+    MAX(xmin::text::bigint) AS xmin,
+    txid_snapshot_xmin(txid_current_snapshot()) % 4294967296 AS snapshot_xmin
+FROM {0}
 '''
+# The oldest transaction, that is still running or not visible for the current snapshot. Only 32 bits are stored in
+# ``xmin`` system column, therefore the epoch is dropped
+XMIN_WATERMARK_SQL = 'SELECT txid_snapshot_xmin(txid_current_snapshot()) % 4294967296 AS value'
+# Every object in the ``pg_dump`` output is preceded by a comment like this one
+DUMP_ENTRY_RE = re.compile(r'^--\n-- Name: .*; Type: (?P<type>.+); Schema: .*\n--\n', re.MULTILINE)
+SEARCH_PATH_RE = re.compile(r'^SET search_path = .*;$', re.MULTILINE)
+# Post-data entries, that are independent of each other. Other entries could depend on them
+CONCURRENT_ENTRY_TYPES = ('INDEX', 'CONSTRAINT')
+
+
+def split_dump(sql):
+    """
+    Splits the ``pg_dump`` output to the header with session settings and a list of (object type, SQL) pairs.
+    Every entry is prefixed with the search path, that was active for it in the original output.
+    """
+    matches = list(DUMP_ENTRY_RE.finditer(sql))
+    if not matches:
+        return sql, []
+    header = sql[:matches[0].start()]
+    entries = []
+    search_path = ''
+    for match, next_match in zip(matches, matches[1:] + [None]):
+        end = next_match.start() if next_match else len(sql)
+        entries.append((match.group('type'), search_path + sql[match.end():end]))
+        # Older versions of ``pg_dump`` switch the schema between entries
+        search_paths = SEARCH_PATH_RE.findall(sql, match.end(), end)
+        if search_paths:
+            search_path = search_paths[-1] + '\n'
+    return header, entries
 
 
 class PostgreSQLBackend(BaseBackend):
     sequences_filename = 'dump/sequences.sql'
     initial_setup_files = BaseBackend.initial_setup_files + (sequences_filename, )
+    post_data_filename = 'dump/post_data.sql'
+    final_setup_files = (post_data_filename, )
+    incremental_setup_files = (sequences_filename, )
+    # Filenames, processes and futures of ``pg_dump`` outputs, that are produced in the background during the dump
+    background_dumps = ()
+    # Binary format skips text encoding / decoding of values, but it requires the same column types on loading
+    data_formats = {'csv': '.csv', 'binary': '.bin'}
+    copy_options = {'csv': 'CSV HEADER', 'binary': '(FORMAT binary)'}
+    database_error = psycopg2.Error
     connections = {
         'default': {
             'isolation_level': ISOLATION_LEVEL_REPEATABLE_READ,
@@ -50,8 +170,11 @@ class PostgreSQLBackend(BaseBackend):
         table_schema NOT IN ('pg_catalog', 'information_schema') AND
         table_schema NOT LIKE 'pg_toast%'
     '''
-    non_recursive_relations_query = BASE_RELATIONS_QUERY.format(operator='!=')
-    recursive_relations_query = BASE_RELATIONS_QUERY.format(operator='=')
+    relations_sql = RELATIONS_SQL
+    # Values are converted to text to store them in the manifest
+    watermark_sql = 'SELECT MAX(T.{column})::text AS value FROM ({sql}) T'
+    # Physical location of the row, which doesn't change within the dump transaction
+    row_id_column = 'ctid'
 
     def connect(self, isolation_level, **kwargs):
         kwargs = self.get_connection_kwargs(**kwargs)
@@ -69,6 +192,25 @@ class PostgreSQLBackend(BaseBackend):
         if str(exc) != 'no results to fetch':
             raise exc
 
+    def reset_connection(self, connection):
+        """
+        Session state, e.g. the search path set by ``pg_dump`` output or temporary tables, is discarded as well.
+        """
+        connection.rollback()
+        autocommit = connection.autocommit
+        connection.autocommit = True
+        try:
+            connection.cursor().execute('DISCARD ALL')
+        finally:
+            connection.autocommit = autocommit
+
+    def rollback(self):
+        """
+        ``psycopg2`` doesn't track transactions finished via SQL. Otherwise it doesn't start a new transaction with the
+        configured isolation level and every following statement is executed in its own transaction.
+        """
+        self.get_cursor().connection.rollback()
+
     @property
     def run_dump_environment(self):
         environ = os.environ.copy()
@@ -76,61 +218,241 @@ class PostgreSQLBackend(BaseBackend):
             environ['PGPASSWORD'] = self.password
         return environ
 
+    def get_dump_command(self, *args):
+        return (
+            'pg_dump',
+            '-U', self.user,
+            '-h', self.host,
+            '-p', self.port,
+            '-d', self.dbname,
+        ) + args
+
     def run_dump(self, *args, **kwargs):
-        process = subprocess.Popen(
-            (
-                'pg_dump',
-                '-U', self.user,
-                '-h', self.host,
-                '-p', self.port,
-                '-d', self.dbname,
-            ) + args,
-            stdout=subprocess.PIPE,
-            env=self.run_dump_environment
-        )
+        process = subprocess.Popen(self.get_dump_command(*args), stdout=subprocess.PIPE, env=self.run_dump_environment)
         return process.communicate()[0]
 
     def write_initial_setup(self, file):
-        super().write_initial_setup(file)
-        self.write_sequences(file)
+        """
+        ``pg_dump`` processes for the schema and post-data run in the background while the data is exported.
+        They use the snapshot of the current transaction, so the schema matches the data.
+        """
+        snapshot = '--snapshot={0}'.format(self.export_snapshot())
+        dumps = (
+            (self.schema_filename, self.get_schema_options()),
+            (self.post_data_filename, self.get_schema_options(section='post-data')),
+        )
+        executor = ThreadPoolExecutor(len(dumps))
+        self.background_dumps = []
+        for filename, options in dumps:
+            command = self.get_dump_command(snapshot, *options)
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, env=self.run_dump_environment)
+            self.background_dumps.append(
+                (filename, process, executor.submit(self.spool_dump, filename, command, process))
+            )
+        executor.shutdown(wait=False)
 
-    def dump_schema(self):
+    def spool_dump(self, filename, command, process):
         """
-        Produces SQL for the schema of the database.
+        Compresses the ``pg_dump`` output into a temporary archive as it is produced, so it is not held in memory.
+        """
+        output = TemporaryFile()
+        try:
+            with process.stdout, self.compression.open_archive(output) as archive:
+                with open_archive_member(archive, filename) as fd:
+                    shutil.copyfileobj(process.stdout, fd)
+            if process.wait():
+                raise subprocess.CalledProcessError(process.returncode, command)
+        except BaseException:
+            output.close()
+            raise
+        return output
+
+    def finish_initial_setup(self, file):
+        """
+        Compressed outputs are copied as is. Archive members could be written only one at a time, therefore they go
+        after the data files. Sequences are captured at the end, when all dumped tables are known.
+        """
+        background_dumps, self.background_dumps = self.background_dumps, ()
+        for filename, _, future in background_dumps:
+            with future.result() as output, zipfile.ZipFile(output) as archive:
+                copy_archive_member(archive, filename, file)
+        self.write_sequences(file, self.get_sequence_tables())
+
+    def discard_initial_setup(self):
         """
-        return self.run_dump(
+        ``pg_dump`` processes, that are still running because of an error, are killed and their outputs are removed.
+        """
+        background_dumps, self.background_dumps = self.background_dumps, ()
+        for _, process, _ in background_dumps:
+            if process.poll() is None:
+                process.kill()
+        for _, _, future in background_dumps:
+            if future.exception() is None:
+                future.result().close()
+
+    def get_schema_options(self, section='pre-data'):
+        return (
             '-s',  # Schema-only
             '-x',  # Do not dump privileges
+            '--section={0}'.format(section),
         )
 
-    def get_sequences(self):
+    def dump_schema(self, section='pre-data'):
+        """
+        Produces SQL for the schema of the database.
+        Indexes, constraints, etc. are in the ``post-data`` section, they are created after the data is loaded.
+        """
+        return self.run_dump(*self.get_schema_options(section))
+
+    def get_sequences(self, tables=None):
         """
         To be able to modify our loaded dump we need to load exact sequences states.
+        Returns schema-qualified names of sequences, that are owned by the given tables (all sequences by default).
+        """
+        return self.filter_sequences(self.run(SEQUENCES_SQL), tables)
+
+    def filter_sequences(self, sequences, tables=None):
+        return [sequence['name'] for sequence in sequences if tables is None or sequence['table_name'] in tables]
+
+    def get_sequence_tables(self):
+        """
+        Tables, which sequences are dumped according to the ``sequences`` option of the dump. None means all sequences.
         """
-        return [row['relname'] for row in self.run(SEQUENCES_SQL)]
+        if self.sequences == 'full_tables':
+            return set(self.dump_options['full_tables'])
+        if self.sequences == 'dumped':
+            return set(self.stats.tables)
+        return None
 
-    def dump_sequences(self):
-        sequences = self.get_sequences()
-        return self.run_dump(
-            '-a',  # Data-only
-            *make_options('-t', sequences)
+    def get_sequence_values_sql(self, sequences):
+        """
+        Reads states of all given sequences with a single query.
+        """
+        return ' UNION ALL '.join(
+            SEQUENCE_VALUE_SQL.format(name=sequence, literal=quote_value(sequence)) for sequence in sequences
         )
 
-    def write_sequences(self, file):
-        sequences = self.dump_sequences()
+    def get_setval_script(self, values):
+        return ''.join(
+            'SELECT pg_catalog.setval({0}, {1}, {2});\n'.format(
+                quote_value(value['name']), value['last_value'], 'true' if value['is_called'] else 'false'
+            )
+            for value in values
+        ).encode()
+
+    def dump_sequences(self, tables=None):
+        """
+        Produces ``setval`` calls, that restore states of sequences, which are owned by the given tables (all sequences
+        by default).
+        """
+        sequences = self.get_sequences(tables)
+        if not sequences:
+            return b''
+        return self.get_setval_script(self.run(self.get_sequence_values_sql(sequences)))
+
+    def write_sequences(self, file, tables=None):
+        sequences = self.dump_sequences(tables)
         file.writestr(self.sequences_filename, sequences)
 
-    def copy_expert(self, *args, **kwargs):
-        cursor = self.get_cursor()
-        return cursor.copy_expert(*args, **kwargs)
+    def run_setup_file(self, sql):
+        """
+        The sequences file is empty if there are no sequences to restore.
+        """
+        if sql:
+            return super().run_setup_file(sql)
+
+    def copy_expert(self, *args, connection=None, **kwargs):
+        if connection is None:
+            cursor = self.get_cursor()
+        else:
+            cursor = connection.cursor()
+        cursor.copy_expert(*args, **kwargs)
+        return cursor.rowcount
+
+    def export_to_file(self, sql, fd, connection=None, format='csv'):
+        """
+        Exports the result of the given sql with a help of COPY statement.
+        """
+        return self.copy_expert(
+            'COPY ({0}) TO STDOUT WITH {1}'.format(sql, self.copy_options[format]), fd, connection=connection
+        )
+
+    def get_server_version(self):
+        return self.run('SHOW server_version')[0]['server_version']
+
+    def get_primary_key(self, table_name):
+        return [row['column_name'] for row in self.run(PRIMARY_KEY_SQL, [table_name])]
+
+    def estimate_selection(self, sql):
+        """
+        The query planner estimates rows and their average width without executing the query. Estimates of complex
+        selections could be far from the actual values, ``count`` method of the budget is more precise.
+        """
+        if self.budget is None or self.budget.estimate != 'explain':
+            return super().estimate_selection(sql)
+        plan = self.run('EXPLAIN (FORMAT JSON) {0}'.format(sql))[0]['QUERY PLAN'][0]['Plan']
+        return plan['Plan Rows'], plan['Plan Rows'] * plan['Plan Width']
 
-    def export_to_csv(self, sql):
+    def get_table_sample_sql(self, table_name, sample):
         """
-        Exports the result of the given sql to CSV with a help of COPY statement.
+        ``system`` method reads only sampled pages, therefore the cost is proportional to the sample size. Samples with
+        the same seed are the same until the table is physically changed.
         """
-        with BytesIO() as output:
-            self.copy_expert('COPY ({0}) TO STDOUT WITH CSV HEADER'.format(sql), output)
-            return output.getvalue()
+        sql = 'SELECT * FROM {0} TABLESAMPLE {1} ({2})'.format(table_name, sample.method.upper(), sample.percent)
+        if sample.seed is not None:
+            sql += ' REPEATABLE ({0})'.format(sample.seed)
+        return sql
+
+    def get_random_expression(self, seed=None):
+        if seed is None:
+            return 'random()'
+        return "md5(ctid::text || '{0}')".format(seed)
+
+    def get_table_fingerprint(self, table_name):
+        """
+        Catalog data and statistics counters are checked without reading the table. If statistics are not collected,
+        then the table is scanned and it is not cached while older transactions, than its latest change, are running.
+        """
+        fingerprint = dict(self.run(TABLE_FINGERPRINT_SQL, [table_name])[0])
+        if fingerprint.pop('track_counts'):
+            return fingerprint
+        scan = self.run(TABLE_SCAN_FINGERPRINT_SQL.format(table_name))[0]
+        if scan['xmin'] is not None and scan['snapshot_xmin'] <= scan['xmin']:
+            return None
+        fingerprint.update(count=scan['count'], xmin=scan['xmin'])
+        return fingerprint
+
+    def get_watermark(self, table_name, sql, column):
+        """
+        ``xmin`` watermark tracks all changes without a dedicated column, but it doesn't survive the transaction IDs
+        wraparound.
+        """
+        if column == 'xmin':
+            return self.run(XMIN_WATERMARK_SQL)[0]['value']
+        return super().get_watermark(table_name, sql, column)
+
+    def get_changed_rows_sql(self, table_name, sql, column, value):
+        """
+        ``xmin`` is not selected by ``*``, therefore rows are selected from the table itself and are limited to the
+        rows of the original query by their primary keys.
+        """
+        if column != 'xmin':
+            return super().get_changed_rows_sql(table_name, sql, column, value)
+        condition = 'xmin::text::bigint >= {0}'.format(value)
+        if sql != self.get_full_table_sql(table_name):
+            condition += ' AND ({0}) IN (SELECT {0} FROM ({1}) T)'.format(
+                ', '.join(self.get_cached_primary_key(table_name)), sql
+            )
+        return 'SELECT * FROM {0} WHERE {1}'.format(table_name, condition)
+
+    def export_snapshot(self):
+        return self.run('SELECT pg_export_snapshot()')[0]['pg_export_snapshot']
+
+    def connect_to_snapshot(self, snapshot):
+        connection = self.get_pool().acquire()
+        # Should be the first statement in the transaction
+        connection.cursor().execute('SET TRANSACTION SNAPSHOT %s', [snapshot])
+        return connection
 
     def recreate_database(self, owner=None):
         self.drop_connections(self.dbname)
@@ -145,5 +467,76 @@ class PostgreSQLBackend(BaseBackend):
     def create_database(self, dbname, owner):
         self.run('CREATE DATABASE {0} WITH OWNER {1}'.format(dbname, owner), using='maintenance')
 
-    def load_data_file(self, table_name, fd):
-        self.copy_expert('COPY {0} FROM STDIN WITH CSV HEADER'.format(table_name), fd)
+    def get_template_dbname(self, template):
+        return template
+
+    def get_templates(self):
+        """
+        The last usage time is stored in the database comment.
+        """
+        templates = self.run(
+            "SELECT datname, shobj_description(oid, 'pg_database') AS last_used FROM pg_database "
+            "WHERE datname LIKE %s",
+            [self.template_prefix.replace('_', '\\_') + '%'],
+            'maintenance'
+        )
+        return {template['datname']: float(template['last_used'] or 0) for template in templates}
+
+    def rename_template(self, old, new):
+        self.drop_connections(old)
+        self.run('ALTER DATABASE {0} RENAME TO {1}'.format(old, new), using='maintenance')
+
+    def clone_template(self, template):
+        """
+        Copies the template on the file level. The template should have no connections.
+        """
+        self.close('default')
+        self.drop_connections(self.dbname)
+        self.drop_database(self.dbname)
+        self.drop_connections(template)
+        self.run(
+            'CREATE DATABASE {0} WITH OWNER {1} TEMPLATE {2}'.format(self.dbname, self.user, template),
+            using='maintenance'
+        )
+        self.run("COMMENT ON DATABASE {0} IS '{1}'".format(template, time.time()), using='maintenance')
+        self.cache_clear()
+
+    def drop_template(self, template):
+        self.drop_connections(template)
+        self.drop_database(template)
+
+    def load_data_file(self, table_name, fd, connection=None, format='csv'):
+        return self.copy_expert(
+            'COPY {0} FROM STDIN WITH {1}'.format(table_name, self.copy_options[format]), fd, connection=connection
+        )
+
+    def run_setup_file_concurrently(self, sql, workers):
+        """
+        Indexes and unique constraints are created in parallel. Other entries, e.g. foreign keys, comments, attached
+        index partitions or replica identities, are executed afterwards in the original order in a single transaction,
+        since they could depend on indexes and foreign keys lock both referencing and referenced tables.
+        """
+        header, entries = split_dump(sql.decode())
+        statements = [header + entry for entry_type, entry in entries if entry_type in CONCURRENT_ENTRY_TYPES]
+
+        def execute(connection, statement):
+            with connection, connection.cursor() as cursor:
+                cursor.execute(statement)
+
+        for _ in self.map_concurrently(execute, statements, workers, self.get_pool().acquire):
+            pass
+        other = [entry for entry_type, entry in entries if entry_type not in CONCURRENT_ENTRY_TYPES]
+        if other:
+            with self.transaction():
+                self.run(header + ''.join(other))
+
+    def drop_foreign_keys(self):
+        foreign_keys = self.run(FOREIGN_KEYS_SQL)
+        for foreign_key in foreign_keys:
+            self.run('ALTER TABLE {table_name} DROP CONSTRAINT {constraint_name}'.format(**foreign_key))
+        return foreign_keys
+
+    def create_foreign_keys(self, foreign_keys):
+        with self.transaction():
+            for foreign_key in foreign_keys:
+                self.run('ALTER TABLE {table_name} ADD CONSTRAINT {constraint_name} {definition}'.format(**foreign_key))
@@ -0,0 +1,35 @@
+# coding: utf-8
+import attr
+
+
+def to_columns(value):
+    if value is None or isinstance(value, str):
+        return (value, ) if value else ()
+    return tuple(value)
+
+
+@attr.s(frozen=True)
+class Sample:
+    """
+    Random ``percent`` of rows of a partial table, e.g. ``{'events': Sample(percent=1, seed=42)}``.
+
+    ``method`` is ``system`` (random blocks of rows) or ``bernoulli`` (random rows). The same ``seed`` selects the same
+    rows from the unchanged table. Rows are sampled within every group of ``by`` columns if they are given, at least one
+    row of every group is selected.
+    """
+    methods = ('system', 'bernoulli')
+
+    percent = attr.ib()
+    method = attr.ib(default='bernoulli')
+    seed = attr.ib(default=None)
+    by = attr.ib(default=(), convert=to_columns)
+
+    def __attrs_post_init__(self):
+        if not 0 < self.percent <= 100:
+            raise ValueError('Sample percent should be in (0, 100] range: {0}'.format(self.percent))
+        if self.method not in self.methods:
+            raise ValueError(
+                'Unsupported sampling method: {0}. Available methods: {1}'.format(self.method, ', '.join(self.methods))
+            )
+        if self.seed is not None and not isinstance(self.seed, int):
+            raise ValueError('Sample seed should be an integer: {0}'.format(self.seed))
@@ -1,9 +1,13 @@
 # coding: utf-8
+import os
+import shutil
 import sqlite3
 import subprocess
 import sys
-from csv import DictReader, DictWriter
-from io import StringIO
+from contextlib import ExitStack, contextmanager
+from csv import reader as csv_reader, writer as csv_writer
+from io import TextIOWrapper
+from itertools import islice
 from pathlib import Path
 
 from .base import BaseBackend
@@ -21,6 +25,18 @@ def force_string(value):
 
 class SQLiteBackend(BaseBackend):
     tables_sql = "SELECT name AS table_name FROM sqlite_master WHERE type='table'"
+    # Number of rows, that are fetched at once during exporting
+    export_batch_size = 10000
+    # Number of rows, that are inserted via a single ``executemany`` call during loading
+    load_batch_size = 10000
+    database_error = sqlite3.Error
+    # Directory for template databases next to the database file
+    templates_dir = '.xdump_templates'
+    row_id_column = 'rowid'
+    # Samples are taken by comparing 32-bit hashes of row ids with the threshold
+    sample_range = 2 ** 32
+    # Whether the database is created by this backend and no data is loaded yet
+    is_new = False
 
     def connect(self, *args, **kwargs):
         connection = sqlite3.connect(self.dbname)
@@ -31,9 +47,9 @@ class SQLiteBackend(BaseBackend):
         process = subprocess.Popen(('sqlite3', ) + args, stdout=subprocess.PIPE)
         return process.communicate()[0]
 
-    def run(self, sql, params=(), using='default'):
+    def execute(self, sql, params=None, using='default'):
         sql = force_string(sql)
-        return super().run(sql, params, using)
+        return super().execute(sql, params or (), using)
 
     def run_many(self, sql):
         sql = force_string(sql)
@@ -44,40 +60,113 @@ class SQLiteBackend(BaseBackend):
         cursor = self.get_cursor()
         cursor.execute('BEGIN IMMEDIATE')
 
-    def get_foreign_keys(self, table, full_tables=(), recursive=False):
-        for foreign_key in self.run('PRAGMA foreign_key_list({})'.format(table)):
-            if foreign_key['table'] in full_tables:
-                continue
-            if foreign_key['table'] == table and not recursive:
-                continue
-            if foreign_key['table'] != table and recursive:
-                continue
-            yield {
+    @contextmanager
+    def immediate_transaction(self):
+        """
+        Commits changes of the block or rolls them back if it fails, so the connection is not left in a transaction.
+        """
+        self.begin_immediate()
+        try:
+            yield
+        except BaseException:
+            self.rollback()
+            raise
+        self.run('COMMIT')
+
+    def get_all_foreign_keys(self):
+        foreign_keys = [
+            {
                 'foreign_table_name': foreign_key['table'],
                 'table_name': table,
                 'foreign_column_name': foreign_key['to'],
                 'column_name': foreign_key['from'],
             }
+            for table in list(self.tables)
+            for foreign_key in self.run('PRAGMA foreign_key_list({})'.format(table))
+        ]
         if sys.version_info[:2] < (3, 6):
             # Before 3.6 sqlite3 used to implicitly commit an open transaction in this case.
             self.begin_immediate()
+        return foreign_keys
+
+    def get_server_version(self):
+        return sqlite3.sqlite_version
+
+    def get_table_fingerprint(self, table_name):
+        """
+        SQLite has no per-table change counters, therefore any change of the database file invalidates all tables.
+        The write-ahead log is checked as well, since changes are not written to the database file until checkpoint.
+        Modification time could have a coarse granularity on some file systems, therefore the key could miss an update,
+        that is made shortly after the dump and leaves the number of rows unchanged.
+        """
+        files = []
+        for path in (Path(self.dbname), Path(self.dbname + '-wal')):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append([path.name, stat.st_mtime_ns, stat.st_size])
+        count = self.run('SELECT COUNT(*) AS count FROM {0}'.format(table_name))[0]['count']
+        return {'files': files, 'count': count}
 
-    def dump(self, *args, **kwargs):
+    def get_primary_key(self, table_name):
+        columns = [column for column in self.run('PRAGMA table_info({0})'.format(table_name)) if column['pk']]
+        return [column['name'] for column in sorted(columns, key=lambda column: column['pk'])]
+
+    def get_table_sample_sql(self, table_name, sample):
+        """
+        There is no ``TABLESAMPLE`` in SQLite, every row is selected with the given probability instead. Both sampling
+        methods select single rows.
+        """
+        return 'SELECT * FROM {0} WHERE {1} < {2}'.format(
+            table_name, self.get_random_expression(sample.seed), int(self.sample_range * sample.percent / 100)
+        )
+
+    def get_random_expression(self, seed=None):
+        """
+        Multiplicative hashing of row ids spreads consecutive rows evenly over the range. Row ids are mixed with the
+        seed via XOR (there is no such operator in SQLite), adding it would keep the order of hashes.
+        """
+        mask = self.sample_range - 1
+        if seed is None:
+            return '(random() & {0})'.format(mask)
+        return '((((rowid | {0}) - (rowid & {0})) * 2654435761) & {1})'.format(seed & mask, mask)
+
+    def dump(self, filename, full_tables=(), partial_tables=None, workers=1, **kwargs):
+        """
+        Snapshots of transactions could not be shared between connections, therefore tables are exported sequentially.
+        """
+        if workers > 1:
+            raise ValueError('parallel export is not supported by SQLite')
         self.begin_immediate()
-        super().dump(*args, **kwargs)
+        return super().dump(filename, full_tables, partial_tables, workers, **kwargs)
 
     def dump_schema(self):
         return self.run_dump(self.dbname, '.schema')
 
-    def export_to_csv(self, sql):
-        with StringIO() as output:
-            cursor = self.get_cursor()
+    def export_to_file(self, sql, fd, connection=None, format='csv'):
+        """
+        Fetches rows in batches as plain tuples, so neither the whole table nor per-row dictionaries are kept in memory.
+        """
+        output = TextIOWrapper(fd, encoding='utf-8', newline='')
+        try:
+            if connection is None:
+                connection = self.get_cursor().connection
+            # A separate cursor shares the transaction, but doesn't affect the row factory of the default one
+            cursor = connection.cursor()
+            cursor.row_factory = None
             cursor.execute(sql)
-            data = cursor.fetchall()
-            writer = DictWriter(output, fieldnames=[column[0] for column in cursor.description], lineterminator='\n')
-            writer.writeheader()
-            writer.writerows(data)
-            return output.getvalue().encode()
+            writer = csv_writer(output, lineterminator='\n')
+            writer.writerow([column[0] for column in cursor.description])
+            rows = 0
+            for batch in iter(lambda: cursor.fetchmany(self.export_batch_size), []):
+                writer.writerows(batch)
+                rows += len(batch)
+            output.flush()
+            return rows
+        finally:
+            # The wrapper should not close the underlying file.
+            output.detach()
 
     def drop_database(self, dbname):
         try:
@@ -88,26 +177,99 @@ class SQLiteBackend(BaseBackend):
     def create_database(self, dbname, *args, **kwargs):
         with sqlite3.connect(dbname):
             pass
+        if dbname == self.dbname:
+            self.is_new = True
+
+    def get_template_dbname(self, template):
+        """
+        Templates are stored in a directory next to the database file.
+        """
+        directory = Path(self.dbname).parent / self.templates_dir
+        directory.mkdir(exist_ok=True)
+        return str(directory / '{0}.sqlite'.format(template))
+
+    def get_templates(self):
+        """
+        The last usage time is the modification time of the template file.
+        """
+        return {
+            path.stem: path.stat().st_mtime
+            for path in (Path(self.dbname).parent / self.templates_dir).glob(self.template_prefix + '*.sqlite')
+        }
+
+    def rename_template(self, old, new):
+        os.replace(self.get_template_dbname(old), self.get_template_dbname(new))
+
+    def clone_template(self, template):
+        """
+        The template file is copied over the database file, the modification time of the template marks it as used.
+        """
+        filename = self.get_template_dbname(template)
+        self.close('default')
+        shutil.copyfile(filename, self.dbname)
+        os.utime(filename)
+        self.cache_clear()
+
+    def drop_template(self, template):
+        self.drop_database(self.get_template_dbname(template))
 
     def run_setup_file(self, sql):
         self.run_many(sql)
 
     def load_data(self, archive):
         """
-        Loads all data from data files inside the archive to the database.
+        Loads all data from data files inside the archive to the database in a single transaction.
+        Writes are unsafe only if all data is loaded into the new database, lazy and selective loading keep the journal.
         """
-        for name in archive.namelist():
-            if name.startswith(self.data_dir):
-                fd = archive.open(name)
-                filename = Path(name).stem
-                self.load_data_file(filename, fd)
+        is_new, self.is_new = self.is_new, False
+        with ExitStack() as stack:
+            if is_new and self.selected_tables is None:
+                stack.enter_context(self.unsafe_writes())
+            # The transaction is finished before pragmas are restored, they could not be changed inside of it
+            with self.immediate_transaction():
+                for name in self.get_data_members(archive):
+                    self.load_archive_member(archive, name)
 
-    def load_data_file(self, table_name, fd):
-        reader = DictReader(fd.read().decode().split('\n'), delimiter=',')
-        fields = ','.join(reader.fieldnames)
-        placeholders = ('?,' * len(reader.fieldnames))[:-1]
-        cursor = self.get_cursor()
-        cursor.executemany(
-            'INSERT INTO {0} ({1}) VALUES ({2})'.format(table_name, fields, placeholders),
-            [[line[k] for k in reader.fieldnames] for line in reader]
-        )
+    def load_incremental(self, archive):
+        """
+        Foreign keys are not enforced by SQLite by default, changes are applied in a single transaction.
+        """
+        with self.immediate_transaction():
+            self.apply_changes(archive)
+
+    @contextmanager
+    def unsafe_writes(self):
+        """
+        Turns off the rollback journal and syncing to the disk. Only for loading into a new database, that has nothing
+        to recover if loading fails.
+        """
+        journal_mode = self.run('PRAGMA journal_mode')[0]['journal_mode']
+        synchronous = self.run('PRAGMA synchronous')[0]['synchronous']
+        self.run('PRAGMA journal_mode = OFF')
+        self.run('PRAGMA synchronous = OFF')
+        try:
+            yield
+        finally:
+            self.run('PRAGMA journal_mode = {0}'.format(journal_mode))
+            self.run('PRAGMA synchronous = {0}'.format(synchronous))
+
+    def load_data_file(self, table_name, fd, connection=None, format='csv'):
+        """
+        Reads the data file incrementally and inserts rows in batches, so the memory usage doesn't depend on its size.
+        """
+        source = TextIOWrapper(fd, encoding='utf-8', newline='')
+        try:
+            reader = csv_reader(source)
+            fields = next(reader, None)
+            if fields is None:
+                return 0
+            sql = 'INSERT INTO {0} ({1}) VALUES ({2})'.format(table_name, ','.join(fields), ','.join('?' * len(fields)))
+            cursor = self.get_cursor() if connection is None else connection.cursor()
+            rows = 0
+            for batch in iter(lambda: list(islice(reader, self.load_batch_size)), []):
+                cursor.executemany(sql, batch)
+                rows += len(batch)
+            return rows
+        finally:
+            # The wrapper should not close the underlying file.
+            source.detach()
@@ -0,0 +1,110 @@
+# coding: utf-8
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import attr
+
+
+@attr.s(cmp=False)
+class TableStats:
+    """
+    Statistics of exporting / loading a single table.
+    ``size`` and ``compressed_size`` are sizes of the corresponding archive member.
+    ``checksum`` of the uncompressed data is calculated during exporting.
+    ``cached`` is True if the data file is taken from the cache.
+    """
+    name = attr.ib()
+    sql = attr.ib(default=None)
+    seconds = attr.ib(default=0)
+    rows = attr.ib(default=None)
+    size = attr.ib(default=0)
+    compressed_size = attr.ib(default=0)
+    checksum = attr.ib(default=None)
+    cached = attr.ib(default=False)
+
+    @contextmanager
+    def measure(self):
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.seconds += time.perf_counter() - start
+
+    def set_rows(self, rows):
+        # Some drivers report -1 if the number of rows is unknown
+        if rows is not None and rows >= 0:
+            self.rows = rows
+
+    def set_sizes(self, info, size=None):
+        """
+        Takes sizes from the given ``ZipInfo`` instance.
+        ``size`` is given if the data is compressed before it is written to the archive.
+        """
+        self.size = info.file_size if size is None else size
+        self.compressed_size = info.compress_size
+
+
+@attr.s(cmp=False)
+class Stats:
+    """
+    Wall time of every phase, statistics of every table and executed SQL queries of a single dump / load.
+
+    ``callback`` is called as things happen with the event name and the phase name or ``TableStats`` instance:
+    ``phase_started`` and ``phase_finished`` for phases, ``table_finished`` for tables. Tables could be processed in
+    multiple threads, therefore the callback should be thread-safe.
+    """
+    callback = attr.ib(default=None)
+    phases = attr.ib(default=attr.Factory(OrderedDict), init=False)
+    tables = attr.ib(default=attr.Factory(OrderedDict), init=False)
+    queries = attr.ib(default=attr.Factory(list), init=False)
+    lock = attr.ib(default=attr.Factory(threading.Lock), init=False, repr=False)
+
+    def notify(self, event, value):
+        if self.callback is not None:
+            self.callback(event, value)
+
+    @contextmanager
+    def phase(self, name):
+        self.notify('phase_started', name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - start
+        self.notify('phase_finished', name)
+
+    @contextmanager
+    def table(self, name, sql=None):
+        """
+        Measures processing of the given table. Rows and sizes should be set on the yielded ``TableStats`` instance.
+        """
+        with TableStats(name, sql).measure() as table:
+            yield table
+        self.add_table(table)
+
+    def add_table(self, table):
+        with self.lock:
+            self.tables[table.name] = table
+        self.notify('table_finished', table)
+
+    def add_query(self, sql, seconds):
+        with self.lock:
+            self.queries.append((sql, seconds))
+
+    @property
+    def seconds(self):
+        return sum(self.phases.values())
+
+    @property
+    def rows(self):
+        return sum(table.rows or 0 for table in self.tables.values())
+
+    @property
+    def size(self):
+        return sum(table.size for table in self.tables.values())
+
+    @property
+    def compressed_size(self):
+        return sum(table.compressed_size for table in self.tables.values())
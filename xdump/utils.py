@@ -1,5 +1,19 @@
 # coding: utf-8
+import hashlib
+import io
 import itertools
+import struct
+import sys
+import threading
+import time
+import zipfile
+from contextlib import contextmanager
+from io import BytesIO
+from queue import Queue
+
+
+DATA_DESCRIPTOR_FLAG = 0x08
+COPY_CHUNK_SIZE = 64 * 1024
 
 
 def make_options(option_key, container):
@@ -7,3 +21,225 @@ def make_options(option_key, container):
     Creates a list of options from the given list of values.
     """
     return itertools.chain.from_iterable([(option_key, value) for value in container])
+
+
+def quote_value(value):
+    """
+    Makes an SQL literal from the given value. Strings are quoted, numbers are used as is.
+    """
+    if isinstance(value, str):
+        return "'{0}'".format(value.replace("'", "''"))
+    return str(value)
+
+
+def strongly_connected_components(graph):
+    """
+    Finds strongly connected components in the given graph - a mapping of nodes to nodes they depend on.
+    Components are returned in the order of their dependencies - every component goes after all components, that it
+    depends on. Nodes of every component are sorted.
+    """
+    state = TarjanState(graph)
+    for node in sorted(graph):
+        if node not in state.index:
+            state.visit(node)
+    return state.components
+
+
+class TarjanState:
+    """
+    Iterative version of Tarjan's algorithm, deep graphs don't hit the recursion limit.
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.index = {}
+        self.lowlink = {}
+        self.stack = []
+        self.on_stack = set()
+        self.components = []
+
+    def push(self, node):
+        self.index[node] = self.lowlink[node] = len(self.index)
+        self.stack.append(node)
+        self.on_stack.add(node)
+        return node, iter(sorted(self.graph[node]))
+
+    def visit(self, root):
+        work = [self.push(root)]
+        while work:
+            node, dependencies = work[-1]
+            for dependency in dependencies:
+                if dependency not in self.graph:
+                    continue
+                if dependency not in self.index:
+                    work.append(self.push(dependency))
+                    break
+                elif dependency in self.on_stack:
+                    self.lowlink[node] = min(self.lowlink[node], self.index[dependency])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    self.lowlink[parent] = min(self.lowlink[parent], self.lowlink[node])
+                if self.lowlink[node] == self.index[node]:
+                    self.pop_component(node)
+
+    def pop_component(self, node):
+        position = self.stack.index(node)
+        component = self.stack[position:]
+        del self.stack[position:]
+        self.on_stack.difference_update(component)
+        self.components.append(sorted(component))
+
+
+@contextmanager
+def open_archive_member(archive, filename, compress_type=None):
+    """
+    Opens a member of the given zip archive for writing.
+    The compression of the archive is used unless ``compress_type`` is given.
+    """
+    if compress_type is not None:
+        filename = zipfile.ZipInfo(filename, time.localtime()[:6])
+        filename.compress_type = compress_type
+        filename.external_attr = 0o600 << 16
+    if sys.version_info[:2] < (3, 6):
+        # Writing to archive members via file-like objects is available only since 3.6.
+        with BytesIO() as fd:
+            yield fd
+            archive.writestr(filename, fd.getvalue())
+    else:
+        # The size of the output is unknown in advance, so ZIP64 extensions are always enabled.
+        with archive.open(filename, 'w', force_zip64=True) as fd:
+            yield fd
+
+
+def copy_archive_member(source, name, target):
+    """
+    Copies the member of the source zip archive to the target one as is, without decompressing and compressing it again.
+    ``ZipFile`` has no public API to write already compressed data, therefore its internal state is updated the same way
+    as ``ZipFile.writestr`` does it in the supported CPython versions (``tests/test_utils.py`` checks it).
+    """
+    info = source.getinfo(name)
+    source.fp.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, source.fp.read(zipfile.sizeFileHeader))
+    source.fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], io.SEEK_CUR)
+    copied = zipfile.ZipInfo(info.filename, info.date_time)
+    copied.compress_type = info.compress_type
+    copied.external_attr = info.external_attr
+    copied.CRC = info.CRC
+    copied.compress_size = info.compress_size
+    copied.file_size = info.file_size
+    # Sizes are known in advance, therefore the data descriptor is not needed
+    copied.flag_bits = info.flag_bits & ~DATA_DESCRIPTOR_FLAG
+    # The archive could have been written to since the last member was added
+    target.fp.seek(getattr(target, 'start_dir', target.fp.tell()))
+    copied.header_offset = target.fp.tell()
+    # ZIP64 extensions are chosen by both, compressed and uncompressed sizes
+    target.fp.write(copied.FileHeader(zip64=None))
+    remaining = info.compress_size
+    while remaining:
+        chunk = source.fp.read(min(remaining, COPY_CHUNK_SIZE))
+        if not chunk:
+            raise zipfile.BadZipFile('Truncated member: {0}'.format(name))
+        target.fp.write(chunk)
+        remaining -= len(chunk)
+    target.start_dir = target.fp.tell()
+    target.filelist.append(copied)
+    target.NameToInfo[copied.filename] = copied
+    target._didModify = True
+    return copied
+
+
+class HashingWriter(io.RawIOBase):
+    """
+    Calculates the checksum of everything, that is written to the underlying file.
+    The underlying file is not closed.
+    """
+
+    def __init__(self, fd, algorithm='sha256'):
+        super().__init__()
+        self.fd = fd
+        self.algorithm = algorithm
+        self.hash = hashlib.new(algorithm)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.hash.update(data)
+        self.fd.write(data)
+        return len(data)
+
+    @property
+    def checksum(self):
+        return '{0}:{1}'.format(self.algorithm, self.hash.hexdigest())
+
+
+def get_checksum(fd, algorithm='sha256'):
+    """
+    Calculates the checksum of the given file in the same form as ``HashingWriter``.
+    """
+    hash = hashlib.new(algorithm)
+    for chunk in iter(lambda: fd.read(COPY_CHUNK_SIZE), b''):
+        hash.update(chunk)
+    return '{0}:{1}'.format(algorithm, hash.hexdigest())
+
+
+class QueueWriter(io.RawIOBase):
+    """
+    Passes written data to another thread via the given queue in chunks of ``chunk_size`` bytes.
+    """
+
+    def __init__(self, queue, chunk_size=COPY_CHUNK_SIZE):
+        super().__init__()
+        self.queue = queue
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.error = None
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        self.buffer.extend(data)
+        if len(self.buffer) >= self.chunk_size:
+            self.send()
+        return len(data)
+
+    def send(self):
+        if self.buffer:
+            self.queue.put(bytes(self.buffer))
+            del self.buffer[:]
+
+
+@contextmanager
+def pipelined(fd, queue_size=16):
+    """
+    Writes to the given file in a separate thread.
+    The calling thread could produce the next chunk of data while the previous one is written (and compressed).
+    """
+    queue = Queue(queue_size)
+    writer = QueueWriter(queue)
+
+    def consume():
+        try:
+            for chunk in iter(queue.get, None):
+                fd.write(chunk)
+        except Exception as exc:
+            writer.error = exc
+            # The producer should not be blocked on the full queue
+            for _ in iter(queue.get, None):
+                pass
+
+    thread = threading.Thread(target=consume)
+    thread.start()
+    try:
+        yield writer
+        writer.send()
+    finally:
+        queue.put(None)
+        thread.join()
+    if writer.error is not None:
+        raise writer.error